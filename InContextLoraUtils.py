@@ -1,28 +1,21 @@
-import json
-import os
-import random
 # import folder_paths
 # import comfy.sd
 # import comfy.utils
-import torch
 # from comfy import model_management
-import safetensors
-import numpy as np
-from skimage import util as sk_util
-from PIL import Image
-import cv2
+from .lazy import lazy_import
 
-RESOLUTION_CONFIG = {
-    1024: [
-        (1536, 1024), # 2.4
-    ]
-}
+torch = lazy_import("torch")
+np = lazy_import("numpy")
+cv2 = lazy_import("cv2")
 
-def resize(img,resolution,interpolation=cv2.INTER_CUBIC):
-    # print(img)
-    
-    # print(resolution)
-    return cv2.resize(img,resolution, interpolation=cv2.INTER_CUBIC)
+from . import metrics
+from .context_plan import INTER_CUBIC, get_budget_panel, get_pixel_budget, get_pixel_utilization, get_target_size, pack_grid, plan_letterbox
+from .executor import map_items
+from .result_cache import cached_node
+from .InContextUtils import as_backend_batch, as_output_dtype, broadcast_index, compose_batch, fill_panel, fit_panel, get_backend_ops, get_batch_size, get_color, get_interpolation, get_latent_mask
+
+def resize(img,resolution,interpolation=INTER_CUBIC,dst=None):
+    return cv2.resize(img,resolution, dst=dst, interpolation=interpolation)
 
     
 def create_image_from_color(width, height, color=(255, 255, 255)):
@@ -37,153 +30,13 @@ def create_image_from_color(width, height, color=(255, 255, 255)):
 def closest_mod_64(value):
     return value - (value % 64)
 
-def fit_image(image,mask=None,output_length=1536,patch_mode="auto"):
-    image = image.detach().cpu().numpy()
-    if mask is not None:
-        mask = mask.detach().cpu().numpy()
-    
-    # print("np.all(mask == 0)",np.all(mask == 0))
-    base_length = int(output_length /3 *2)
-    half_length = int(output_length /2)
-    image_height, image_width, _ = image.shape
-    # print("ori ", image_width, image_height)
-    # if image.size is None:
-    #     # convert tensor to pil image
-    #     image = Image.fromarray(np.uint8(image)).convert('RGB')
-    # image_width, image_height  = image.size
-    target_width = int(half_length)
-    target_height = int(base_length)
-    # print("patch_mode",patch_mode)
-    if patch_mode == "auto":
-        if image_width > image_height:
-            patch_mode = "patch_bottom"
-            target_width = int(base_length)
-            target_height = int(half_length)
-        else:
-            patch_mode = "patch_right"
-    elif patch_mode == "patch_bottom":
-        target_width = int(base_length)
-        target_height = int(half_length)
-    # print("patch_mode",patch_mode)
-        
-    # if image_width < target_width or image_height < target_height:
-    #     # print("image too small, resize to ", target_width, target_height)
-    #     if image_height > image_width:
-    #         new_width = int(image_width*(target_height/image_height))
-    #         new_height = target_height
-    #         # print(new_width,new_height)
-    #         image = resize(image, (new_width,new_height))
-    #         # print("mask",mask)
-    #         # print("mask.shape",mask.shape)
-    #         if mask is not None:
-    #             mask = resize(mask, (new_width,new_height),cv2.INTER_NEAREST_EXACT)
-    #     else:
-    #         new_width = target_width
-    #         new_height = int(image_height*(target_width/image_width))
-    #         # print(new_width,new_height)
-    #         image = resize(image, (new_width,new_height))
-    #
-    #         # print("mask",mask)
-    #         # print("mask.shape",mask.shape)
-    #         if mask is not None:
-    #             mask = resize(mask, (new_width,new_height),cv2.INTER_NEAREST_EXACT)
-    #
-    #     image_height, image_width, _ = image.shape
-    #
-    #     diff_x = target_width - image_width
-    #     # print("diff_x",diff_x)
-    #     diff_y = target_height - image_height
-    #     # print("diff_y",diff_y)
-    #     pad_x = abs(diff_x) // 2
-    #     pad_y = abs(diff_y) // 2
-    #     # add white pixels for padding
-    #     if diff_x > 0 or diff_y > 0:
-    #         resized_image = cv2.copyMakeBorder(
-    #             image,
-    #             pad_y, abs(diff_y) - pad_y,
-    #             pad_x, abs(diff_x) - pad_x,
-    #             cv2.BORDER_CONSTANT, value=(255, 255, 255)
-    #         )
-    #         if mask is not None:
-    #             resized_mask = cv2.copyMakeBorder(
-    #                 mask,
-    #                 pad_y, abs(diff_y) - pad_y,
-    #                 pad_x, abs(diff_x) - pad_x,
-    #                 cv2.BORDER_CONSTANT, value=(0, 0, 0)
-    #             )
-    #     # crop extra pixels for square
-    #     else:
-    #         resized_image = image[pad_y:image_height-pad_y, pad_x:image_width-pad_x]
-    #         resized_mask = mask[pad_y:image_height-pad_y, pad_x:image_width-pad_x]
-    #
-    # else:
-    #     # get resized image size
-    #     image_height, image_width, _ = image.shape
-    #     # print("new size",image_height, image_width)
-    #     # simple center crop
-    #     scale_ratio = target_width / target_height
-    #     image_ratio = image_width / image_height
-    #     # referenced kohya ss code
-    #     if image_ratio > scale_ratio:
-    #         up_scale = image_height / target_height
-    #     else:
-    #         up_scale = image_width / target_width
-    #     expanded_closest_size = (int(target_width * up_scale + 0.5), int(target_height * up_scale + 0.5))
-    #     diff_x = abs(expanded_closest_size[0] - image_width)
-    #     diff_y = abs(expanded_closest_size[1] - image_height)
-    #
-    #     crop_x =  diff_x // 2
-    #     crop_y =  diff_y // 2
-    #     cropped_image = image[crop_y:image_height-crop_y, crop_x:image_width-crop_x]
-    #     resized_image = resize(cropped_image, (target_width,target_height))
-    #
-    #     if mask is not None:
-    #         # print("mask",mask)
-    #         # print("mask.shape",mask.shape)
-    #         cropped_mask = mask[crop_y:image_height-crop_y, crop_x:image_width-crop_x]
-    #         resized_mask = resize(cropped_mask, (target_width,target_height),cv2.INTER_NEAREST_EXACT)
-
-    # 等比例缩放并填充逻辑
-    scale_ratio = min(target_width / image_width, target_height / image_height)
-
-    # 计算缩放后的尺寸
-    new_width = int(image_width * scale_ratio)
-    new_height = int(image_height * scale_ratio)
-
-    # 缩放图片
-    image = resize(image, (new_width, new_height))
-
-    if mask is not None:
-        mask = resize(mask, (new_width, new_height), cv2.INTER_NEAREST_EXACT)
-
-    # 计算填充的差值
-    diff_x = target_width - new_width
-    diff_y = target_height - new_height
-
-    # 计算填充上下左右的像素
-    pad_x = diff_x // 2
-    pad_y = diff_y // 2
-
-    # 添加白色填充到图片，黑色填充到掩码
-    resized_image = cv2.copyMakeBorder(
-        image,
-        pad_y, diff_y - pad_y,
-        pad_x, diff_x - pad_x,
-        cv2.BORDER_CONSTANT, value=(255, 255, 255)
-    )
-
-    if mask is not None:
-        resized_mask = cv2.copyMakeBorder(
-            mask,
-            pad_y, diff_y - pad_y,
-            pad_x, diff_x - pad_x,
-            cv2.BORDER_CONSTANT, value=(0, 0, 0)
-        )
-
-    else:
-        resized_mask = torch.zeros((target_width,target_height))
-    
-    return resized_image, resized_mask, target_width, target_height, patch_mode
+def fit_second_mask(mask, plan, policy="quality", resize=resize):
+    # an empty second mask marks the whole second panel
+    def write(view):
+        fit_panel(mask, plan, resize, get_interpolation(policy, plan.scale, True), 0)(view)
+        if not view.any():
+            view[...] = 1
+    return write
 
 class AddMaskForICLora:
     # def __init__(self):
@@ -208,91 +61,230 @@ class AddMaskForICLora:
                         "first_mask": ("MASK",),
                         "second_image": ("IMAGE",),
                         "second_mask": ("MASK",),
+                        # auto: the mod 64 bucket closest to the aspect ratio of the first image
+                        "patch_type": (["3:4", "auto"], {
+                            "default": "3:4",
+                        }),
+                        # quality: cubic, fast: linear and nearest for masks, auto: area averaging for 2x and larger downscales
+                        "interpolation": (["quality", "fast", "auto"], {
+                            "default": "quality",
+                        }),
+                        # CPU threads for the batch items and the cv2 / torch kernels, 0 uses ICLORA_THREADS or all cores
+                        "threads": ("INT", {
+                            "default": 0,
+                            "min": 0,
+                        }),
+                        # uint8: fit and concatenate 8 bit pixels, float16: half size IMAGE output
+                        "precision": (["float32", "uint8"], {
+                            "default": "float32",
+                        }),
+                        "output_dtype": (["float32", "float16"], {
+                            "default": "float32",
+                        }),
+                        # pixel budget of the two panel canvas, 0 keeps output_length, otherwise the largest panels with mod 64
+                        # sides within it are used, latent tokens are 16x16 pixels, the tighter budget applies
+                        "max_pixels": ("INT", {
+                            "default": 0,
+                            "min": 0,
+                        }),
+                        "max_latent_tokens": ("INT", {
+                            "default": 0,
+                            "min": 0,
+                        }),
+                        # torch: fit and concatenate on the device of the inputs, uint8 precision is cv2 only
+                        "backend": (["cv2", "torch"], {
+                            "default": "cv2",
+                        }),
                     }
                 }
-    RETURN_TYPES = ("IMAGE", "MASK", "INT", "INT", "INT", "INT", "INT", "INT")
-    RETURN_NAMES = ("IMAGE", "MASK", "x_offset", "y_offset", "target_width", "target_height", "total_width", "total_height")
+    RETURN_TYPES = ("IMAGE", "MASK", "INT", "INT", "INT", "INT", "INT", "INT", "FLOAT", "MASK", "INT")
+    RETURN_NAMES = ("IMAGE", "MASK", "x_offset", "y_offset", "target_width", "target_height", "total_width", "total_height", "pixel_utilization", "latent_mask", "pixel_count")
     FUNCTION = "add_mask"
     OUTPUT_NODE = True
 
     CATEGORY = "ICLoraUtils/AddMaskForICLora"
-    def add_mask(self, first_image, patch_mode, output_length, patch_color, first_mask=None, second_image=None, second_mask=None):
-        # patched_images = []
-        # patched_masks = []
+    @cached_node
+    def add_mask(self, first_image, patch_mode, output_length, patch_color, first_mask=None, second_image=None, second_mask=None, patch_type="3:4", threads=0, interpolation="quality", precision="float32", output_dtype="float32", max_pixels=0, max_latent_tokens=0, backend="cv2"):
         if output_length % 64 != 0:
             output_length = output_length - (output_length % 64)
+        budget = get_pixel_budget(max_pixels, max_latent_tokens)
+        if budget:
+            output_length, patch_type = get_budget_panel(budget, patch_type)
+        batch_size = get_batch_size(*[batch for batch in (first_image, first_mask, second_image, second_mask) if batch is not None])
         
-        image1 = first_image[0]
-        if first_mask is None:
-            image1_mask = torch.zeros((image1.shape[0], image1.shape[1]))
+        with metrics.stage("to_numpy", (first_image, first_mask, second_image, second_mask), backend=backend):
+            first_images = as_backend_batch(first_image, backend)
+            first_masks = as_backend_batch(first_mask, backend)
+            second_images = as_backend_batch(second_image, backend)
+            second_masks = as_backend_batch(second_mask, backend)
+        resize_, _ = get_backend_ops(backend)
+        _, image_height, image_width, _ = first_images.shape
+        first_plan = plan_letterbox(image_width, image_height, output_length, patch_mode, patch_type)
+        target_width, target_height, fitted_patch_mode = first_plan.target_width, first_plan.target_height, first_plan.patch_mode
+        if second_images is None:
+            # the blank patch is already at the target size
+            second_plan = plan_letterbox(target_width, target_height, output_length, fitted_patch_mode, patch_type, target_width, target_height)
         else:
-            image1_mask = first_mask[0]
+            second_plan = plan_letterbox(second_images.shape[2], second_images.shape[1], output_length, fitted_patch_mode, patch_type, target_width, target_height)
+        
+        slots = []
+        for i in range(batch_size):
+            first_key = (broadcast_index(first_image, i), broadcast_index(first_mask, i))
+            write_image = fit_panel(first_images[first_key[0]], first_plan, resize_, get_interpolation(interpolation, first_plan.scale), (255, 255, 255))
+            if first_masks is None:
+                write_mask = fill_panel(0)
+            else:
+                write_mask = fit_panel(first_masks[first_key[1]], first_plan, resize_, get_interpolation(interpolation, first_plan.scale, True), 0)
+            first_writers = (write_image, write_mask)
             
-        image1,image1_mask,target_width,target_height,patch_mode = fit_image(image1,image1_mask,output_length,patch_mode)
-        if second_image is not None:
-            image2 = second_image[0]
-            if second_mask is None:
-                image2_mask = torch.zeros((image2.shape[0], image2.shape[1]))
+            second_key = (broadcast_index(second_image, i), broadcast_index(second_mask, i))
+            if second_images is None:
+                write_image = fill_panel(get_color(patch_color))
             else:
-                image2_mask = second_mask[0]
-            image2,image2_mask,_,_,_ = fit_image(image2,image2_mask,output_length,patch_mode)
-            # print("image2_mask",image2_mask)
-            # print("image2_mask.shape",image2_mask.shape)
-        else:
-            image2 = create_image_from_color(target_width,target_height, color=patch_color)
-            image2 = torch.from_numpy(image2)
-            if second_mask is None:
-                image2_mask = torch.zeros((image2.shape[0], image2.shape[1]))
+                write_image = fit_panel(second_images[second_key[0]], second_plan, resize_, get_interpolation(interpolation, second_plan.scale), (255, 255, 255))
+            if second_masks is None:
+                write_mask = fill_panel(1)
             else:
-                image2_mask = second_mask[0]
-            image2,image2_mask,_,_,_ = fit_image(image2,image2_mask,output_length)
-            
+                write_mask = fit_second_mask(second_masks[second_key[1]], second_plan, interpolation, resize_)
+            slots.append((first_key, second_key, first_writers, (write_image, write_mask)))
         
+        device = first_images.device if backend == "torch" else None
+        return_images, return_masks = compose_batch(slots, fitted_patch_mode, (target_width, target_height), (target_width, target_height), threads, precision, device)
+        return_images = as_output_dtype(return_images, output_dtype)
         min_y = 0
-        # max_y = 100
         min_x = 0
-        # max_x = 100
-        
-        # print("image1.shape")
-        # print(image1.shape)
-        # print("image2.shape")
-        # print(image2.shape)
-        if second_mask is None or np.all(image2_mask == 0):
-            # print("second_mask is None",second_mask is None)
-            # print("np.all(image2_mask[0] == 0)",np.all(image2_mask == 0))
-            image2_mask = torch.ones((image1.shape[0], image1.shape[1]))
-            
-        if patch_mode == "patch_right":
-            concatenated_image = np.hstack((image1, image2))
-            concatenated_mask = np.hstack((image1_mask, image2_mask))
+        if fitted_patch_mode == "patch_right":
             min_x = 50
         else:
-            concatenated_image = np.vstack((image1, image2))
-            concatenated_mask = np.vstack((image1_mask, image2_mask))
             min_y = 50
-        # mask = torch.zeros((concatenated_image.shape[0], concatenated_image.shape[1]))
-        min_y = int(min_y / 100.0 * concatenated_image.shape[0])
-        # max_y = int(max_y / 100.0 * concatenated_image.shape[0])
-        min_x = int(min_x / 100.0 * concatenated_image.shape[1])
-        # max_x = int(max_x / 100.0 * concatenated_image.shape[1])
-        # mask[min_y:max_y+1, min_x:max_x+1] = 1
-        # print(mask.shape)
-        # print(mask)
+        min_y = int(min_y / 100.0 * return_images.shape[1])
+        min_x = int(min_x / 100.0 * return_images.shape[2])
+        
+        return (return_images, return_masks, min_x, min_y, target_width, target_height, return_images.shape[2], return_images.shape[1], get_pixel_utilization(first_plan), get_latent_mask(return_masks), return_images.shape[1] * return_images.shape[2])
+
+def get_cell_rect(index, columns, cell_width, cell_height):
+    return (index % columns) * cell_width, (index // columns) * cell_height
+
+# reference panels and one target panel packed into a single grid canvas, the target is the last cell
+# every panel is fitted once into a preallocated canvas, the references are shared by the whole batch
+class ConcatReferenceGrid:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+                    "required": {
+                        # every item of the batch is one reference panel
+                        "reference_images": ("IMAGE",),
+                        "patch_type": (["3:4", "1:1", "9:16", "auto"], {
+                            "default": "3:4",
+                        }),
+                        "output_length": ("INT", {
+                            "default": 1536,
+                        }),
+                        "patch_color": (["#FF0000", "#00FF00","#0000FF", "#FFFFFF"], {
+                            "default": "#FF0000",
+                        }),
+                    },
+                    "optional":{
+                        # references of other sizes
+                        "reference_images_2": ("IMAGE",),
+                        "reference_images_3": ("IMAGE",),
+                        "target_image": ("IMAGE",),
+                        "target_mask": ("MASK",),
+                        # quality: cubic, fast: linear and nearest for masks, auto: area averaging for 2x and larger downscales
+                        "interpolation": (["quality", "fast", "auto"], {
+                            "default": "quality",
+                        }),
+                        # CPU threads for the batch items and the cv2 / torch kernels, 0 uses ICLORA_THREADS or all cores
+                        "threads": ("INT", {
+                            "default": 0,
+                            "min": 0,
+                        }),
+                    }
+                }
+    RETURN_TYPES = ("IMAGE", "MASK", "INT", "INT", "INT", "INT", "INT", "INT", "CONTEXT_WINDOW_PLAN", "FLOAT", "MASK")
+    RETURN_NAMES = ("IMAGE", "MASK", "x_offset", "y_offset", "target_width", "target_height", "total_width", "total_height", "plan", "pixel_utilization", "latent_mask")
+    FUNCTION = "concat_reference_grid"
+
+    CATEGORY = "ICLoraUtils/ConcatReferenceGrid"
+    @cached_node
+    def concat_reference_grid(self, reference_images, patch_type, output_length, patch_color, reference_images_2=None, reference_images_3=None, target_image=None, target_mask=None, threads=0, interpolation="quality"):
+        if output_length % 64 != 0:
+            output_length = output_length - (output_length % 64)
+        targets = [batch for batch in (target_image, target_mask) if batch is not None]
+        batch_size = get_batch_size(*targets) if targets else 1
+        
+        with metrics.stage("to_numpy", (reference_images, reference_images_2, reference_images_3, target_image, target_mask)):
+            references = [reference for batch in (reference_images, reference_images_2, reference_images_3) if batch is not None
+                          for reference in batch.detach().cpu().numpy()]
+            target_images = None if target_image is None else target_image.detach().cpu().numpy()
+            target_masks = None if target_mask is None else target_mask.detach().cpu().numpy()
+        
+        # all cells share the panel size of the target, or of the first reference without a target
+        source_height, source_width = (target_images if target_images is not None else references)[0].shape[:2]
+        _, patch_mode, cell_width, cell_height = get_target_size(source_width, source_height, output_length, "auto", patch_type)
+        cell_width, cell_height = max(closest_mod_64(cell_width), 64), max(closest_mod_64(cell_height), 64)
+        columns, rows = pack_grid(len(references) + 1, cell_width, cell_height)
+        target_x, target_y = get_cell_rect(len(references), columns, cell_width, cell_height)
         
-        return_masks = torch.from_numpy(concatenated_mask)[None,]
+        images = torch.empty((batch_size, rows * cell_height, columns * cell_width, 3), dtype=torch.float32)
+        masks = torch.zeros((batch_size, rows * cell_height, columns * cell_width), dtype=torch.float32)
+        image_canvas = images.numpy()
+        mask_canvas = masks.numpy()
         
-        concatenated_image = np.clip(255. * concatenated_image, 0, 255).astype(np.float32) / 255.0
-        concatenated_image = torch.from_numpy(concatenated_image)[None,]
+        with metrics.stage("concat", image_canvas):
+            def write_reference(i):
+                reference = references[i]
+                plan = plan_letterbox(reference.shape[1], reference.shape[0], output_length, patch_mode, patch_type, cell_width, cell_height)
+                x, y = get_cell_rect(i, columns, cell_width, cell_height)
+                fit_panel(reference, plan, resize, get_interpolation(interpolation, plan.scale), (255, 255, 255))(image_canvas[0, y:y + cell_height, x:x + cell_width])
+                return get_pixel_utilization(plan)
+            content = sum(map_items(write_reference, len(references), threads))
+            # the cells after the target stay empty, white like the letterbox padding
+            for i in range(len(references) + 1, columns * rows):
+                x, y = get_cell_rect(i, columns, cell_width, cell_height)
+                fill_panel(1)(image_canvas[0, y:y + cell_height, x:x + cell_width])
+            image_canvas[1:] = image_canvas[0]
+            
+            if target_images is None:
+                target_plan = plan_letterbox(cell_width, cell_height, output_length, patch_mode, patch_type, cell_width, cell_height)
+            else:
+                target_plan = plan_letterbox(target_images.shape[2], target_images.shape[1], output_length, patch_mode, patch_type, cell_width, cell_height)
+            content += get_pixel_utilization(target_plan)
+            written = {}
+            for i in range(batch_size):
+                written.setdefault((broadcast_index(target_image, i), broadcast_index(target_mask, i)), i)
+            writes = list(written.items())
+            
+            def write_target(index):
+                key, i = writes[index]
+                image_view = image_canvas[i, target_y:target_y + cell_height, target_x:target_x + cell_width]
+                mask_view = mask_canvas[i, target_y:target_y + cell_height, target_x:target_x + cell_width]
+                if target_images is None:
+                    fill_panel(get_color(patch_color))(image_view)
+                else:
+                    fit_panel(target_images[key[0]], target_plan, resize, get_interpolation(interpolation, target_plan.scale), (255, 255, 255))(image_view)
+                if target_masks is None:
+                    fill_panel(1)(mask_view)
+                else:
+                    fit_second_mask(target_masks[key[1]], target_plan, interpolation)(mask_view)
+            map_items(write_target, len(writes), threads)
+            for i in range(batch_size):
+                source = written[(broadcast_index(target_image, i), broadcast_index(target_mask, i))]
+                if source != i:
+                    image_canvas[i, target_y:target_y + cell_height, target_x:target_x + cell_width] = image_canvas[source, target_y:target_y + cell_height, target_x:target_x + cell_width]
+                    mask_canvas[i, target_y:target_y + cell_height, target_x:target_x + cell_width] = mask_canvas[source, target_y:target_y + cell_height, target_x:target_x + cell_width]
         
-        # print('return_masks',return_masks.shape)
-        return_images = concatenated_image
-        # print('return_images',return_images.shape)
-        return (return_images, return_masks, min_x, min_y, target_width, target_height, concatenated_image.shape[1], concatenated_image.shape[0])
+        with metrics.stage("normalize", image_canvas):
+            np.clip(image_canvas, 0, 1, out=image_canvas)
+        utilization = content / (columns * rows)
+        return (images, masks, target_x, target_y, cell_width, cell_height, images.shape[2], images.shape[1], target_plan, utilization, get_latent_mask(masks))
 
 NODE_CLASS_MAPPINGS = {
     "AddMaskForICLora": AddMaskForICLora,
+    "ConcatReferenceGrid": ConcatReferenceGrid,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
     "AddMaskForICLora": "Add Mask For IC Lora",
+    "ConcatReferenceGrid": "Concatenate Reference Grid",
 }
\ No newline at end of file
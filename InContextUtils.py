@@ -1,10 +1,52 @@
 
-import torch
-import numpy as np
-import cv2
+import os
 
-def resize(img,resolution,interpolation=cv2.INTER_CUBIC):
-    return cv2.resize(img,resolution, interpolation=interpolation)
+from .lazy import lazy_import
+
+torch = lazy_import("torch")
+np = lazy_import("numpy")
+cv2 = lazy_import("cv2")
+
+from . import metrics
+from .buffer_pool import scratch_pool
+from .executor import map_items
+from .context_plan import INTER_CUBIC, apply_plan, apply_plan_into, cluster_boxes, crop_local_plan, get_affine_matrix, get_budget_panel, get_bucket_patch_mode, get_content_rects, get_matrix_source_rect, get_pixel_budget, get_pixel_utilization, get_plan_pixels, get_shared_bucket, get_target_size, is_full_crop, plan_context_window, plan_fit, track_boxes, warp_plan_into
+from .mask_bbox import get_mask_bboxes, get_mask_bboxes_coarse
+from .result_cache import cached_node
+from .window_reader import as_float_array, open_reader
+
+torch_backend = lazy_import(f"{__package__}.torch_backend")
+
+def resize(img,resolution,interpolation=INTER_CUBIC,dst=None):
+    return cv2.resize(img,resolution, dst=dst, interpolation=interpolation)
+
+def pad(img, top, bottom, left, right, value=0):
+    return cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=value)
+
+def warp(img, matrix, resolution, interpolation=INTER_CUBIC, dst=None):
+    # warpAffine has no exact nearest mode, its nearest rounds the same source coordinates
+    if interpolation == cv2.INTER_NEAREST_EXACT:
+        interpolation = cv2.INTER_NEAREST
+    return cv2.warpAffine(img, np.array(matrix, dtype=np.float64), resolution, dst=dst, flags=interpolation, borderMode=cv2.BORDER_REPLICATE)
+
+def get_interpolation(policy, scale, mask=False):
+    # cv2 flag for an interpolation policy, scale is source pixels per target pixel, above 1 downscales
+    # quality: cubic, fast: linear, auto: area averaging from a 2x downscale on, cubic below
+    # cubic and linear only read a few source pixels per output pixel, large downscales alias with them,
+    # area reads every source pixel, on float32 images it is slower than cubic but free of aliasing
+    if mask:
+        return cv2.INTER_NEAREST if policy == "fast" else cv2.INTER_NEAREST_EXACT
+    if policy == "fast":
+        return cv2.INTER_LINEAR
+    if policy == "auto" and scale >= 2:
+        return cv2.INTER_AREA
+    return cv2.INTER_CUBIC
+
+def get_backend_ops(backend):
+    # resize and pad for the selected backend, the torch versions share the cv2 signatures
+    if backend == "torch":
+        return torch_backend.resize, torch_backend.pad
+    return resize, pad
 
 def create_image_from_color(width, height, color=(255, 255, 255)):
     # OpenCV uses BGR, so convert hex color to BGR if necessary
@@ -19,27 +61,8 @@ def closest_mod_64(value):
     return value - (value % 64)
 
 def get_target_width_height(image, output_length, patch_mode, patch_type):
-    if output_length % 64 != 0:
-        output_length = output_length - (output_length % 64)
-    
-    # image = image.detach().cpu().numpy()
     image_height, image_width, _ = image.shape
-    
-    patch_ratio = [int(x) for x in patch_type.split(":")]
-    short_part = patch_ratio[0]
-    long_part = patch_ratio[1]
-    total = short_part * 2
-
-    if (patch_mode == "auto" and image_width > image_height) or patch_mode == "patch_bottom":
-        patch_mode = "patch_bottom"
-        target_width = int(output_length / total * long_part)
-        target_height = int(output_length / total * short_part)
-    else:
-        patch_mode = "patch_right"
-        target_width = int(output_length / total * short_part)
-        target_height = int(output_length / total * long_part)
-    
-    return output_length, patch_mode, target_width, target_height
+    return get_target_size(image_width, image_height, output_length, patch_mode, patch_type)
 
 class GetWidthHeightAndMode:
     @classmethod
@@ -53,7 +76,7 @@ class GetWidthHeightAndMode:
                         "patch_mode": (["auto", "patch_right", "patch_bottom"], {
                             "default": "auto",
                         }),
-                        "patch_type": (["1:1", "4:3", "9:16"], {
+                        "patch_type": (["1:1", "4:3", "9:16", "auto"], {
                             "default": "1:1",
                         }),
                     }
@@ -67,48 +90,317 @@ class GetWidthHeightAndMode:
         return (output_length, patch_mode, target_width, target_height, patch_type, )
     
 
-def get_padding(image, target_width, target_height):
-    image_height, image_width, _ = image.shape
-    # should scale down the target size to image level
-    scale = 1
-    if image_height > image_width:
-        scale = (target_height/image_height)
-        new_width = int(image_width*scale)
-        new_height = target_height
+def get_batch_size(*batches):
+    # batches of 1 are broadcast against the largest batch
+    batch_size = max(len(batch) for batch in batches)
+    for batch in batches:
+        if len(batch) != 1 and len(batch) != batch_size:
+            raise ValueError(f"Batch size mismatch: got {[len(batch) for batch in batches]}, expected 1 or {batch_size}")
+    return batch_size
+
+def broadcast_index(batch, index):
+    # missing inputs and batches of 1 always map to their first item
+    if batch is None or len(batch) == 1:
+        return 0
+    return index
+
+def get_panel_views(canvas, index, patch_mode, split):
+    # views of the first and second panel of one canvas item
+    if patch_mode == "patch_right":
+        return canvas[index, :, :split], canvas[index, :, split:]
+    return canvas[index, :split], canvas[index, split:]
+
+def compose_batch(slots, patch_mode, first_size, second_size, threads=0, precision="float32", device=None):
+    # slots hold (first_key, second_key, first_writers, second_writers) per output item
+    # writers are (write_image, write_mask) pairs filling a panel view, every distinct key is
+    # written once and broadcast slots copy the panel that is already in the canvas
+    # the writes go to separate views and run on the executor, the copies follow once they are done
+    # uint8 precision composes a uint8 canvas, fill_panel and fit_panel quantize float sources into it
+    # device keeps a float32 canvas on that torch device for the torch backend
+    first_width, first_height = first_size
+    second_width, second_height = second_size
+    if patch_mode == "patch_right":
+        height, width, split = first_height, first_width + second_width, first_width
     else:
-        scale = (target_width/image_width)
-        new_width = target_width
-        new_height = int(image_height*scale)
-    # print("image_width, image_height", image_width, image_height)
-    # print("target_width, target_height", target_width, target_height)
-    # print("new_width, new_height", new_width, new_height)
-    # print("scale", scale)
-    diff_x = (target_width - new_width) / scale
-    diff_y = (target_height - new_height) / scale
-    pad_x = diff_x // 2
-    pad_y = diff_y // 2
-    return pad_x, pad_y
-
-def get_cropping(image, target_width, target_height):
-    # get resized image size
-    image_height, image_width, _ = image.shape
-    # print("new size",image_height, image_width)
-    # simple center crop
-    scale_ratio = target_width / target_height
-    image_ratio = image_width / image_height
-    # referenced kohya ss code
-    if image_ratio > scale_ratio: 
-        up_scale = image_height / target_height
+        height, width, split = first_height + second_height, first_width, first_height
+    if device is not None:
+        images = torch.empty((len(slots), height, width, 3), dtype=torch.float32, device=device)
+        masks = torch.empty((len(slots), height, width), dtype=torch.float32, device=device)
+        image_canvas, mask_canvas = images, masks
     else:
-        up_scale = image_width / target_width
-    expanded_closest_size = (int(target_width * up_scale + 0.5), int(target_height * up_scale + 0.5))
-    diff_x = (expanded_closest_size[0] - image_width) / up_scale
-    diff_y = (expanded_closest_size[1] - image_height) / up_scale
+        images = torch.empty((len(slots), height, width, 3), dtype=torch.uint8 if precision == "uint8" else torch.float32)
+        masks = torch.empty((len(slots), height, width), dtype=torch.float32)
+        image_canvas = images.numpy()
+        mask_canvas = masks.numpy()
+    
+    written = {}
+    writes = []
+    copies = []
+    for i, (first_key, second_key, first_writers, second_writers) in enumerate(slots):
+        for panel, key, writers in ((0, first_key, first_writers), (1, second_key, second_writers)):
+            if (panel, key) in written:
+                copies.append((i, panel, written[(panel, key)]))
+            else:
+                writes.append((i, panel, writers))
+                written[(panel, key)] = i
+    
+    def write(index):
+        i, panel, (write_image, write_mask) = writes[index]
+        write_image(get_panel_views(image_canvas, i, patch_mode, split)[panel])
+        write_mask(get_panel_views(mask_canvas, i, patch_mode, split)[panel])
     
-    crop_x =  diff_x // 2
-    crop_y =  diff_y // 2    
-    return crop_x, crop_y
+    with metrics.stage("concat", image_canvas):
+        map_items(write, len(writes), threads)
+        for i, panel, source in copies:
+            get_panel_views(image_canvas, i, patch_mode, split)[panel][...] = get_panel_views(image_canvas, source, patch_mode, split)[panel]
+            get_panel_views(mask_canvas, i, patch_mode, split)[panel][...] = get_panel_views(mask_canvas, source, patch_mode, split)[panel]
     
+    # normalize in place, same as np.clip(255. * x, 0, 255) / 255.0 without the copies
+    with metrics.stage("normalize", image_canvas):
+        if device is not None:
+            images.clamp_(0, 1)
+        elif precision == "uint8":
+            images = torch.from_numpy(normalize_image(image_canvas))
+        else:
+            np.clip(image_canvas, 0, 1, out=image_canvas)
+    return images, masks
+
+def quantize_into(image, out):
+    # quantize_image into a uint8 view, image is used as scratch
+    np.multiply(image, 255, out=image)
+    image += 0.5
+    np.clip(image, 0, 255, out=image)
+    out[...] = image
+    return out
+
+def fill_panel(value):
+    def write(view):
+        if torch.is_tensor(view):
+            view[...] = torch.as_tensor(value, device=view.device)
+        elif view.dtype == np.uint8 and isinstance(value, np.ndarray) and value.dtype != np.uint8:
+            view[...] = quantize_image(value)
+        else:
+            view[...] = value
+    return write
+
+def fit_panel(image, plan, resize=resize, interpolation=INTER_CUBIC, value=0):
+    # float sources of a uint8 view are quantized where it is cheaper, sources up to the panel size
+    # before the resize, larger ones after it, quantizing them would cost more than the sparse cubic reads
+    def write(view):
+        resize_ = metrics.timed("resize", resize)
+        if torch.is_tensor(view):
+            # torch backend, views of a device canvas, torch_backend.resize takes the dst keyword as well
+            apply_plan_into(image, plan, view, resize_, interpolation, torch.as_tensor(value, dtype=view.dtype, device=view.device))
+        elif view.dtype != np.uint8 or image.dtype == np.uint8:
+            apply_plan_into(image, plan, view, resize_, interpolation, value, scratch_pool)
+        elif image.shape[0] * image.shape[1] <= view.shape[0] * view.shape[1]:
+            apply_plan_into(quantize_image(image), plan, view, resize_, interpolation, value, scratch_pool)
+        else:
+            with scratch_pool.borrow(view.shape, np.float32) as scratch:
+                quantize_into(apply_plan_into(image, plan, scratch, resize_, interpolation, value, scratch_pool), view)
+    return write
+
+def get_color(color):
+    # RGB values of a patch color, in the 0-255 range like create_image_from_color
+    return create_image_from_color(1, 1, color)[0, 0]
+
+def stack_with_padding(items):
+    # pad each item on the bottom/right with zeros to the largest height/width of the batch
+    max_height = max(item.shape[0] for item in items)
+    max_width = max(item.shape[1] for item in items)
+    if torch.is_tensor(items[0]):
+        stacked = items[0].new_zeros((len(items), max_height, max_width) + tuple(items[0].shape[2:]))
+    else:
+        stacked = np.zeros((len(items), max_height, max_width) + items[0].shape[2:], dtype=items[0].dtype)
+    for i, item in enumerate(items):
+        stacked[i, :item.shape[0], :item.shape[1]] = item
+    return stacked
+
+def normalize_image(image):
+    # uint8 results of the uint8 precision mode are already in range, they are only scaled
+    if torch.is_tensor(image):
+        if image.dtype == torch.uint8:
+            return image.float() / 255.0
+        return torch.clamp(255. * image, 0, 255).float() / 255.0
+    if image.dtype == np.uint8:
+        return np.multiply(image, np.float32(1 / 255), dtype=np.float32)
+    return np.clip(255. * image, 0, 255).astype(np.float32) / 255.0
+
+def quantize_image(image):
+    # float [0, 1] pixels rounded to uint8, a quarter of the bytes for crop, resize, pad and concat
+    # the outputs then stay within about 2 / 255 of the float32 path, the quantization step plus the
+    # cubic kernel overshoot on it
+    if torch.is_tensor(image):
+        return (image * 255 + 0.5).clamp_(0, 255).to(torch.uint8)
+    return np.clip(image * 255 + 0.5, 0, 255).astype(np.uint8)
+
+def as_output_dtype(image, output_dtype="float32"):
+    # float16 halves the IMAGE tensors handed to the VAE encoder, only the prepared panels and canvases are cast,
+    # the crop outputs stay float32 for the nodes that resize them again
+    return image.to(torch.float16) if output_dtype == "float16" else image
+
+def binarize_mask(mask):
+    # binary masks are kept as uint8 (a quarter of float32) and only turned into floats for the node outputs
+    if torch.is_tensor(mask):
+        return (mask > 0).to(torch.uint8)
+    return (mask > 0).astype(np.uint8)
+
+def get_latent_mask(masks, factor=8):
+    # [B,H,W] masks area averaged down to the latent resolution, so inpaint conditioning does not resize them again
+    _, height, width = masks.shape
+    latent_size = (max(width // factor, 1), max(height // factor, 1))
+    return torch_backend.resize(masks[:, None].float(), latent_size, cv2.INTER_AREA, layout="NCHW")[:, 0]
+
+def find_mask_regions(mask, bbox, region_mode="single", pixel_buffer=64, region_distance=0):
+    # bounding boxes (x, y, width, height) of the mask regions, empty for an empty mask
+    # bbox is the overall box from get_mask_bboxes, it is the only region in single mode
+    if bbox is None:
+        return []
+    if region_mode != "multi":
+        return [bbox]
+    # contours are only searched inside the overall box
+    x, y, width, height = bbox
+    roi = mask[y:y + height, x:x + width] > 0
+    roi = roi.to(torch.uint8).cpu().numpy() if torch.is_tensor(roi) else roi.astype(np.uint8)
+    contours, _ = cv2.findContours(roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for contour in contours:
+        box_x, box_y, box_width, box_height = cv2.boundingRect(contour)
+        boxes.append((box_x + x, box_y + y, box_width, box_height))
+    return cluster_boxes(boxes, pixel_buffer, region_distance)
+
+def as_backend_batch(batch, backend="cv2"):
+    # node inputs for the compose nodes, numpy on the host for cv2, the tensor on its own device for torch
+    if batch is None:
+        return None
+    if backend == "torch":
+        return batch.detach()
+    return batch.detach().cpu().numpy()
+
+def as_numpy(image):
+    if torch.is_tensor(image):
+        return image.detach().cpu().numpy()
+    return image
+
+def crop_to_plan(image, mask, plan, backend="cv2"):
+    # cuts the crop rectangle of the plan, for the cv2 backend only that part is converted to numpy
+    if is_full_crop(plan):
+        image_part, mask_part = image, mask
+    else:
+        rows = slice(plan.crop_y, plan.crop_y + plan.crop_height)
+        cols = slice(plan.crop_x, plan.crop_x + plan.crop_width)
+        image_part, mask_part = image[rows, cols], mask[rows, cols]
+    if backend != "torch":
+        with metrics.stage("to_numpy", (image_part, mask_part)):
+            image_part, mask_part = as_numpy(image_part), as_numpy(mask_part)
+    return image_part, mask_part
+
+def prepare_context_window(image, mask, bbox, output_length, patch_mode, patch_type, pixel_buffer, backend="cv2", transform="resize", policy="quality", precision="float32", bucket=None):
+    # bbox is None for an empty mask, only the window of the mask is converted and binarized
+    image_height, image_width, _ = image.shape
+    plan = plan_context_window(image_width, image_height, bbox, output_length, patch_mode, patch_type, pixel_buffer, bucket)
+    # warpAffine has no area mode, area downscales keep crop and resize
+    if transform == "affine" and backend != "torch" and get_interpolation(policy, plan.scale) != cv2.INTER_AREA:
+        return warp_context_window(image, mask, plan, bbox is None, policy, precision)
+    fit_image_part, fit_mask_part = crop_to_plan(image, mask, plan, backend)
+    return render_context_window(fit_image_part, fit_mask_part, plan, backend, bbox is None, policy=policy, precision=precision)
+
+def warp_context_window(image, mask, plan, empty_mask=False, policy="quality", precision="float32"):
+    # render_context_window as a single warp from the whole source into the panel, cv2 only
+    # the crop outputs are still cut from the source, they are returned as they are
+    image = as_numpy(image)
+    warp_ = metrics.timed("warp", warp)
+    source, source_plan = image, plan
+    if precision == "uint8":
+        # only the window is quantized, the warp reads nothing outside of it
+        source = quantize_image(image[plan.crop_y:plan.crop_y + plan.crop_height, plan.crop_x:plan.crop_x + plan.crop_width])
+        source_plan = crop_local_plan(plan)
+    prepared_image = np.empty((plan.target_height, plan.target_width, image.shape[2]), dtype=source.dtype)
+    if empty_mask:
+        warp_plan_into(source, source_plan, prepared_image, warp_, get_interpolation(policy, plan.scale), (255, 255, 255))
+        with metrics.stage("normalize", prepared_image, empty_mask=True):
+            prepared_image = normalize_image(prepared_image)
+        prepared_mask = np.ones((plan.target_height, plan.target_width), dtype=np.uint8)
+        return (prepared_image, prepared_mask, plan.patch_mode, 0, 0, 1, prepared_image, prepared_mask, plan, )
+    
+    mask = as_numpy(mask)
+    warp_plan_into(source, source_plan, prepared_image, warp_, get_interpolation(policy, plan.scale))
+    prepared_mask = np.empty((plan.target_height, plan.target_width), dtype=mask.dtype)
+    warp_plan_into(mask, plan, prepared_mask, warp_, get_interpolation(policy, plan.scale, True))
+    fit_image_part, fit_mask_part = crop_to_plan(image, mask, plan)
+    with metrics.stage("binarize", fit_mask_part):
+        prepared_mask = binarize_mask(prepared_mask)
+        fit_mask_part = binarize_mask(fit_mask_part)
+    with metrics.stage("normalize", (prepared_image, fit_image_part)):
+        prepared_image = normalize_image(prepared_image)
+        fit_image_part = normalize_image(fit_image_part)
+    return (prepared_image, prepared_mask, plan.patch_mode, plan.crop_x, plan.crop_y, plan.scale, fit_image_part, fit_mask_part, plan, )
+
+def render_context_window(fit_image_part, fit_mask_part, plan, backend="cv2", empty_mask=False, batched=False, policy="quality", precision="float32"):
+    # the parts are the crop rectangle of plan, already converted for the backend
+    # batched parts are torch batches of frames sharing the plan
+    # uint8 precision resizes a quantized copy of the crop, the crop output keeps the float pixels
+    resize, pad = get_backend_ops(backend)
+    resize, pad = metrics.timed("resize", resize), metrics.timed("pad", pad)
+    local_plan = crop_local_plan(plan)
+    
+    if empty_mask:
+        # no mask, the whole image is fitted and the mask is all ones
+        image1, image1_mask, _, _, _ = fit_image(fit_image_part,None,backend=backend,plan=local_plan,policy=policy,precision=precision)
+    
+        with metrics.stage("normalize", image1, empty_mask=True):
+            image1 = normalize_image(image1)
+        return (image1, image1_mask, plan.patch_mode, 0, 0, 1, image1, image1_mask, plan, )
+    
+    source_part = fit_image_part
+    if precision == "uint8" and backend != "torch":
+        with metrics.stage("quantize", fit_image_part):
+            source_part = quantize_image(fit_image_part)
+    resized_image_part = apply_plan(source_part, local_plan, resize, pad, get_interpolation(policy, plan.scale), batched=batched)
+    with metrics.stage("binarize", fit_mask_part):
+        fit_mask_part = binarize_mask(fit_mask_part)
+    # nearest sampling picks source pixels, so resizing the binarized mask is the same as binarizing after
+    resized_mask_part = apply_plan(fit_mask_part, local_plan, resize, pad, get_interpolation(policy, plan.scale, True), batched=batched)
+    
+    with metrics.stage("normalize", (resized_image_part, fit_image_part)):
+        resized_image_part = normalize_image(resized_image_part)
+        fit_image_part = normalize_image(fit_image_part)
+    
+    return (resized_image_part, resized_mask_part, plan.patch_mode, plan.crop_x, plan.crop_y, plan.scale, fit_image_part, fit_mask_part, plan, )
+    
+def prepare_sequence(images, masks, bboxes, output_length, patch_mode, patch_type, pixel_buffer, backend="cv2", threads=0, transform="resize", policy="quality", precision="float32", bucket=None):
+    # bboxes holds one tracked box per frame, frames with the same box share one plan
+    # the torch backend crops and resizes those frames as one batch, cv2 has no batched resize
+    frames_by_box = {}
+    for i, bbox in enumerate(bboxes):
+        frames_by_box.setdefault(bbox, []).append(i)
+    
+    results = [None] * len(bboxes)
+    single_frames = []
+    for bbox, frames in frames_by_box.items():
+        if backend != "torch" or bbox is None or len(frames) == 1:
+            single_frames.extend(frames)
+            continue
+        _, image_height, image_width, _ = images.shape
+        plan = plan_context_window(image_width, image_height, bbox, output_length, patch_mode, patch_type, pixel_buffer, bucket)
+        rows = slice(plan.crop_y, plan.crop_y + plan.crop_height)
+        cols = slice(plan.crop_x, plan.crop_x + plan.crop_width)
+        image_index = torch.tensor([broadcast_index(images, i) for i in frames], device=images.device)
+        mask_index = torch.tensor([broadcast_index(masks, i) for i in frames], device=masks.device)
+        # advanced indexing copies the crop rectangles only
+        image_parts = images[image_index, rows, cols]
+        mask_parts = masks[mask_index, rows, cols]
+        prepared_images, prepared_masks, _, _, _, _, crop_images, crop_masks, _ = render_context_window(image_parts, mask_parts, plan, backend, batched=True, policy=policy, precision=precision)
+        for k, i in enumerate(frames):
+            results[i] = (prepared_images[k], prepared_masks[k], plan.patch_mode, plan.crop_x, plan.crop_y, plan.scale, crop_images[k], crop_masks[k], plan, )
+    
+    def prepare_frame(index):
+        i = single_frames[index]
+        return prepare_context_window(images[broadcast_index(images, i)], masks[broadcast_index(masks, i)], bboxes[i], output_length, patch_mode, patch_type, pixel_buffer, backend, transform, policy, precision, bucket)
+    for i, result in zip(single_frames, map_items(prepare_frame, len(single_frames), threads)):
+        results[i] = result
+    return results
+
 # make the perfect mask for in context lora
 # scale the mask to maximum 4x and minium 0.25x
 # full pixel usage with 768x1024 context window
@@ -122,7 +414,7 @@ class CreateContextWindow:
                     "patch_mode": (["auto", "patch_right", "patch_bottom"], {
                         "default": "auto",
                     }),
-                    "patch_type": (["3:4","1:1", "9:16"], {
+                    "patch_type": (["3:4","1:1", "9:16", "auto"], {
                         "default": "3:4",
                     }),
                     
@@ -134,229 +426,346 @@ class CreateContextWindow:
                     "pixel_buffer": ("INT", {
                         "default": 64,
                     }),
+                    "backend": (["cv2", "torch"], {
+                        "default": "cv2",
+                    }),
+                    # multi: one context window per cluster of mask regions
+                    "region_mode": (["single", "multi"], {
+                        "default": "single",
+                    }),
+                    "region_distance": ("INT", {
+                        "default": 0,
+                        "min": 0,
+                    }),
+                    # coarse: find the mask box on every scan_factor-th pixel and refine its edges, for very large images
+                    "scan_mode": (["full", "coarse"], {
+                        "default": "full",
+                    }),
+                    "scan_factor": ("INT", {
+                        "default": 16,
+                        "min": 1,
+                    }),
+                    # sequence: the batch is a clip, the window only moves when the mask leaves it by more than
+                    # sequence_margin pixels, keep the margin at or below pixel_buffer / 2
+                    "sequence_mode": ("BOOLEAN", {
+                        "default": False,
+                    }),
+                    "sequence_margin": ("INT", {
+                        "default": 32,
+                        "min": 0,
+                    }),
+                    # weight of the previous window when the window moves
+                    "sequence_smoothing": ("FLOAT", {
+                        "default": 0.5,
+                        "min": 0.0,
+                        "max": 1.0,
+                        "step": 0.05,
+                    }),
+                    # CPU threads for the batch items and the cv2 / torch kernels, 0 uses ICLORA_THREADS or all cores
+                    "threads": ("INT", {
+                        "default": 0,
+                        "min": 0,
+                    }),
+                    # affine: crop, resize and pad as one cv2.warpAffine into the panel, the cv2 backend only,
+                    # windows that interpolation auto downscales with area averaging keep the resize path
+                    "transform": (["resize", "affine"], {
+                        "default": "resize",
+                    }),
+                    # quality: cubic, fast: linear and nearest for masks, auto: area averaging for 2x and larger downscales
+                    "interpolation": (["quality", "fast", "auto"], {
+                        "default": "quality",
+                    }),
+                    # uint8: crop, resize and pad on 8 bit pixels, the cv2 backend only, float16: half size prepared_image, the crop outputs stay float32
+                    "precision": (["float32", "uint8"], {
+                        "default": "float32",
+                    }),
+                    "output_dtype": (["float32", "float16"], {
+                        "default": "float32",
+                    }),
+                    # pixel budget of the two panel canvas, 0 keeps output_length, otherwise the largest panels with mod 64
+                    # sides within it are used, latent tokens are 16x16 pixels, the tighter budget applies
+                    "max_pixels": ("INT", {
+                        "default": 0,
+                        "min": 0,
+                    }),
+                    "max_latent_tokens": ("INT", {
+                        "default": 0,
+                        "min": 0,
+                    }),
                 }
             }
-    RETURN_TYPES = ("IMAGE", "MASK",  "STRING", "INT", "INT", "FLOAT", "IMAGE", "MASK")
-    RETURN_NAMES = ("prepared_image", "prepared_mask", "patch_mode", "x_offset_of_ori", "y_offset_of_ori", "scale", "crop_area", "crop_mask")
+    RETURN_TYPES = ("IMAGE", "MASK",  "STRING", "INT", "INT", "FLOAT", "IMAGE", "MASK", "CONTEXT_WINDOW_PLAN", "INT", "FLOAT", "MASK", "AFFINE_MATRIX", "INT")
+    RETURN_NAMES = ("prepared_image", "prepared_mask", "patch_mode", "x_offset_of_ori", "y_offset_of_ori", "scale", "crop_area", "crop_mask", "plan", "source_index", "pixel_utilization", "latent_mask", "affine_matrix", "pixel_count")
     FUNCTION = "create_context_window"
     CATEGORY = "InContextUtils/CreateContextWindow"
     
     
-    def create_context_window(self, input_image, input_mask, patch_mode, patch_type,output_length=1536, pixel_buffer=64):
-        image = input_image[0].clone()
-        mask = input_mask[0].clone()
-        image = image.detach().cpu().numpy()
-        mask = mask.detach().cpu().numpy()
-        
-        # Convert the binary mask to 8-bit
-        mask = (mask > 0).astype(np.uint8)
-
-        # Alternatively, using OpenCV (if your mask is not binary, i.e., has non-1/0 values):
-        mask = cv2.convertScaleAbs(mask)
+    @cached_node
+    def create_context_window(self, input_image, input_mask, patch_mode, patch_type,output_length=1536, pixel_buffer=64, backend="cv2", region_mode="single", region_distance=0, scan_mode="full", scan_factor=16, sequence_mode=False, sequence_margin=32, sequence_smoothing=0.5, threads=0, transform="resize", interpolation="quality", precision="float32", output_dtype="float32", max_pixels=0, max_latent_tokens=0):
         if output_length % 64 != 0:
                 output_length = output_length - (output_length % 64)
-        output_length, patch_mode, target_width, target_height = get_target_width_height(image, output_length, patch_mode, patch_type)
-        
-        image_height, image_width, _ = image.shape
-        # Step 1: Find contours of the "1" shape
-        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        
-        if input_mask is None or np.all(mask == 0) or contours[0] is None:
-            print("Mask is not found. Return original image with mask all ones")
-            image1 = input_image[0].clone()
-            image1, image1_mask, target_width, target_height, patch_mode = fit_image(image1,None,output_length,patch_mode,patch_type)
-        
-            print("image1.shape",image1.shape)
-            print("image1_mask.shape",image1_mask.shape)
-            image1 = np.clip(255. * image1, 0, 255).astype(np.float32) / 255.0
-            image1 = torch.from_numpy(image1)[None,]
-            image1_mask = torch.from_numpy(image1_mask)[None,]
-            return (image1, image1_mask, patch_mode, 0, 0, 1, image1, image1_mask, )
-        
-        # Assume there is only one shape of interest
-        contour = contours[0]
-        # Step 2: Calculate the bounding box (x, y, width, height)
-        ori_x, ori_y, ori_bb_width, ori_bb_height = cv2.boundingRect(contour)
+        budget = get_pixel_budget(max_pixels, max_latent_tokens)
+        if budget:
+            output_length, patch_type = get_budget_panel(budget, patch_type)
+        with metrics.stage("to_numpy", (input_image, input_mask), backend=backend):
+            if backend == "torch" or scan_mode == "coarse":
+                # keep the batch on the device it arrived on, coarse mode only converts the crops later on
+                images = input_image.detach()
+                masks = input_mask.detach().to(images.device)
+            else:
+                # convert the whole batch once instead of once per item
+                images = input_image.detach().cpu().numpy()
+                masks = input_mask.detach().cpu().numpy()
+        if masks.ndim == 2:
+            masks = masks[None,]
+        batch_size = get_batch_size(images, masks)
+        image_height, image_width = images.shape[1:3]
         
-        # get center of the bounding box
-        center_x, center_y = ori_x + ori_bb_width // 2, ori_y + ori_bb_height // 2
-        # print("center_x, center_y", center_x, center_y)
+        # one reduction scan finds the boxes and empty masks of the whole batch
+        with metrics.stage("mask_scan", masks, scan_mode=scan_mode):
+            if scan_mode == "coarse":
+                bboxes = get_mask_bboxes_coarse(masks, scan_factor)
+            else:
+                bboxes = get_mask_bboxes(masks)
         
-        ori_x_with_buffer = max(int(ori_x - pixel_buffer//2), 0)
-        ori_y_with_buffer = max(int(ori_y - pixel_buffer//2), 0)
-        buffer_bb_width = min(int(ori_bb_width + pixel_buffer), image_width)
-        buffer_bb_height = min(int(ori_bb_height + pixel_buffer), image_height)
-        crop_image_part = image[ori_y_with_buffer:ori_y_with_buffer + buffer_bb_height, ori_x_with_buffer:ori_x_with_buffer + buffer_bb_width]
-        crop_mask_part = mask[ori_y_with_buffer:ori_y_with_buffer + buffer_bb_height, ori_x_with_buffer:ori_x_with_buffer + buffer_bb_width]
+        if sequence_mode:
+            # one window per frame from the tracked single box of every frame, region_mode does not apply
+            frame_bboxes = track_boxes([bboxes[broadcast_index(masks, i)] for i in range(batch_size)], sequence_margin, sequence_smoothing)
+            bucket = get_shared_bucket(image_width, image_height, frame_bboxes, output_length, patch_type, pixel_buffer)
+            results = prepare_sequence(images, masks, frame_bboxes, output_length, patch_mode, patch_type, pixel_buffer, backend, threads, transform, interpolation, precision, bucket)
+            source_indices = list(range(batch_size))
+        else:
+            def find_item_regions(i):
+                mask = masks[i if len(masks) > 1 else 0]
+                bbox = bboxes[i if len(masks) > 1 else 0]
+                with metrics.stage("bbox_search", mask, region_mode=region_mode):
+                    # every region cluster of the item becomes its own context window
+                    return find_mask_regions(mask, bbox, region_mode, pixel_buffer, region_distance) or [None]
+            windows = [(i, bbox) for i, regions in enumerate(map_items(find_item_regions, batch_size, threads)) for bbox in regions]
+            # the windows are planned together, an auto patch_type gives all of them one bucket
+            bucket = get_shared_bucket(image_width, image_height, [bbox for _, bbox in windows], output_length, patch_type, pixel_buffer)
+            def prepare_window(k):
+                i, bbox = windows[k]
+                image = images[i if len(images) > 1 else 0]
+                mask = masks[i if len(masks) > 1 else 0]
+                return prepare_context_window(image, mask, bbox, output_length, patch_mode, patch_type, pixel_buffer, backend, transform, interpolation, precision, bucket)
+            results = map_items(prepare_window, len(windows), threads)
+            source_indices = [i for i, _ in windows]
         
-        patch_ratio = [int(x) for x in patch_type.split(":")]
-        short_part = patch_ratio[0]
-        long_part = patch_ratio[1]
-        total = short_part * 2
-        crop_image_height, crop_image_width, _ = crop_image_part.shape
-        # print("ori crop_image_width, crop_image_height", crop_image_width, crop_image_height)
+        prepared_images, prepared_masks, patch_modes, x_offsets, y_offsets, scales, crop_images, crop_masks, plans = zip(*results)
         
-        if crop_image_width >= crop_image_height:
-            if (patch_mode == "auto" and image_width > image_height) or patch_mode == "patch_bottom":
-                patch_mode = "patch_bottom"
-                crop_output_length = int(crop_image_width / long_part * total)
-                crop_image_height = int(crop_output_length / total * short_part)
+        # prepared parts always share the target size, crop parts are padded to the largest crop in the batch
+        with metrics.stage("concat", (prepared_images, crop_images)):
+            if backend == "torch":
+                resized_image_part = torch.stack(prepared_images)
+                resized_mask_part = torch.stack(prepared_masks).float()
+                fit_image_part = stack_with_padding(crop_images)
+                fit_mask_part = stack_with_padding(crop_masks).float()
             else:
-                patch_mode = "patch_right"
-                crop_output_length = int(crop_image_width / short_part * total)
-                crop_image_height = int(crop_output_length / total * long_part)
-        else:
-            if (patch_mode == "auto" and image_width > image_height) or patch_mode == "patch_bottom":
-                patch_mode = "patch_bottom"
-                crop_output_length = int(crop_image_height / short_part * total)
-                crop_image_width = int(crop_output_length / total * long_part)
-            else:
-                patch_mode = "patch_right"
-                crop_output_length = int(crop_image_height / long_part * total)
-                crop_image_width = int(crop_output_length / total * short_part)
+                resized_image_part = torch.from_numpy(np.stack(prepared_images))
+                resized_mask_part = torch.from_numpy(np.stack(prepared_masks)).float()
+                fit_image_part = torch.from_numpy(stack_with_padding(crop_images))
+                fit_mask_part = torch.from_numpy(stack_with_padding(crop_masks)).float()
+        latent_mask = get_latent_mask(resized_mask_part)
+        resized_image_part = as_output_dtype(resized_image_part, output_dtype)
         
-        # based on center x,y and crop image width, calculate the x,y offset
-        new_x = int(center_x - crop_image_width // 2)
-        new_y = int(center_y - crop_image_height // 2)
+        # share of each prepared panel that is image content instead of padding
+        utilizations = [get_pixel_utilization(plan) for plan in plans]
+        # exact source to panel mapping, invert_affine_matrix maps panel pixels back
+        matrices = [get_affine_matrix(plan) for plan in plans]
+        # pixels of the two panel canvas of each window, the compute cost of sampling it
+        pixel_counts = [get_plan_pixels(plan) for plan in plans]
         
-        # print("new_x,new_y", new_x,new_y)
-        # print("crop_output_length", crop_output_length)
-        # print("crop_image_width, crop_image_height", crop_image_width, crop_image_height)
+        # a single window keeps scalar outputs, batches return one value per window
+        if len(results) == 1:
+            return (resized_image_part, resized_mask_part, patch_modes[0], x_offsets[0], y_offsets[0], scales[0], fit_image_part, fit_mask_part, plans[0], source_indices[0], utilizations[0], latent_mask, matrices[0], pixel_counts[0], )
+        return (resized_image_part, resized_mask_part, patch_modes[0], list(x_offsets), list(y_offsets), list(scales), fit_image_part, fit_mask_part, list(plans), source_indices, utilizations, latent_mask, matrices, pixel_counts, )
+# same outputs as CreateContextWindow, read straight from the image file
+# only the context window is decoded where the format allows it, see window_reader
+class LoadContextWindow:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+                "required": {
+                    "image_path": ("STRING", {
+                        "default": "",
+                    }),
+                    "patch_mode": (["auto", "patch_right", "patch_bottom"], {
+                        "default": "auto",
+                    }),
+                    "patch_type": (["3:4","1:1", "9:16", "auto"], {
+                        "default": "3:4",
+                    }),
+                },
+                "optional":{
+                    "input_mask": ("MASK",),
+                    # used when input_mask is not connected, a grayscale image or a .npy array
+                    "mask_path": ("STRING", {
+                        "default": "",
+                    }),
+                    "output_length": ("INT", {
+                        "default": 1536,
+                    }),
+                    "pixel_buffer": ("INT", {
+                        "default": 64,
+                    }),
+                    "backend": (["cv2", "torch"], {
+                        "default": "cv2",
+                    }),
+                    "scan_mode": (["full", "coarse"], {
+                        "default": "full",
+                    }),
+                    "scan_factor": ("INT", {
+                        "default": 16,
+                        "min": 1,
+                    }),
+                    "interpolation": (["quality", "fast", "auto"], {
+                        "default": "quality",
+                    }),
+                    # CPU threads for the windows of a mask batch and the cv2 / torch kernels, 0 uses ICLORA_THREADS or all cores
+                    "threads": ("INT", {
+                        "default": 0,
+                        "min": 0,
+                    }),
+                    # uint8: crop, resize and pad on 8 bit pixels, the cv2 backend only, float16: half size prepared_image, the crop outputs stay float32
+                    "precision": (["float32", "uint8"], {
+                        "default": "float32",
+                    }),
+                    "output_dtype": (["float32", "float16"], {
+                        "default": "float32",
+                    }),
+                    # pixel budget of the two panel canvas, 0 keeps output_length, otherwise the largest panels with mod 64
+                    # sides within it are used, latent tokens are 16x16 pixels, the tighter budget applies
+                    "max_pixels": ("INT", {
+                        "default": 0,
+                        "min": 0,
+                    }),
+                    "max_latent_tokens": ("INT", {
+                        "default": 0,
+                        "min": 0,
+                    }),
+                }
+            }
+    RETURN_TYPES = CreateContextWindow.RETURN_TYPES
+    RETURN_NAMES = CreateContextWindow.RETURN_NAMES
+    FUNCTION = "load_context_window"
+    CATEGORY = "InContextUtils/LoadContextWindow"
+
+    def load_context_window(self, image_path, patch_mode, patch_type, input_mask=None, mask_path="", output_length=1536, pixel_buffer=64, backend="cv2", scan_mode="full", scan_factor=16, interpolation="quality", precision="float32", output_dtype="float32", threads=0, max_pixels=0, max_latent_tokens=0):
+        if output_length % 64 != 0:
+            output_length = output_length - (output_length % 64)
+        budget = get_pixel_budget(max_pixels, max_latent_tokens)
+        if budget:
+            output_length, patch_type = get_budget_panel(budget, patch_type)
+        if input_mask is None and not mask_path:
+            raise ValueError("LoadContextWindow needs input_mask or mask_path")
         
-        if new_y+crop_image_height > image_height:
-            new_y = image_height - crop_image_height
-        if new_x+crop_image_width > image_width:
-            new_x = image_width - crop_image_width
-        if new_x < 0:
-            new_x = 0
-        if new_y < 0:
-            new_y = 0
+        image_reader = open_reader(os.path.expanduser(image_path))
+        mask_reader = None
+        try:
+            if input_mask is not None:
+                # a [K,H,W] mask batch fans out into K windows of the one image
+                masks = as_numpy(input_mask.detach())
+            else:
+                mask_reader = open_reader(os.path.expanduser(mask_path), "L")
+                # npy masks stay memory mapped, the other formats are single channel and decoded whole
+                mask = mask_reader.array if hasattr(mask_reader, "array") else mask_reader.read(0, 0, mask_reader.width, mask_reader.height)
+                if mask.ndim == 3:
+                    mask = mask[..., 0]
+                masks = mask
+            if masks.ndim == 2:
+                masks = masks[None,]
+            image_width, image_height = image_reader.width, image_reader.height
+            if masks.shape[1:] != (image_height, image_width):
+                raise ValueError(f"Mask size {masks.shape[2]}x{masks.shape[1]} does not match image size {image_width}x{image_height}")
             
+            with metrics.stage("mask_scan", masks, scan_mode=scan_mode):
+                if scan_mode == "coarse":
+                    bboxes = get_mask_bboxes_coarse(masks, scan_factor)
+                else:
+                    bboxes = get_mask_bboxes(masks)
+            bucket = get_shared_bucket(image_width, image_height, bboxes, output_length, patch_type, pixel_buffer)
+            plans = [plan_context_window(image_width, image_height, bbox, output_length, patch_mode, patch_type, pixel_buffer, bucket) for bbox in bboxes]
+            
+            # the windows of all masks are decoded once, as the rectangle around them
+            left, top = min(plan.crop_x for plan in plans), min(plan.crop_y for plan in plans)
+            right = max(plan.crop_x + plan.crop_width for plan in plans)
+            bottom = max(plan.crop_y + plan.crop_height for plan in plans)
+            with metrics.stage("read", None, width=right - left, height=bottom - top):
+                window = as_float_array(image_reader.read(left, top, right - left, bottom - top))
+                image_parts = [window[plan.crop_y - top:plan.crop_y - top + plan.crop_height, plan.crop_x - left:plan.crop_x - left + plan.crop_width] for plan in plans]
+                mask_parts = [as_float_array(mask[plan.crop_y:plan.crop_y + plan.crop_height, plan.crop_x:plan.crop_x + plan.crop_width], None) for mask, plan in zip(masks, plans)]
+        finally:
+            image_reader.close()
+            if mask_reader is not None:
+                mask_reader.close()
         
-        fit_image_part = image[new_y:new_y+crop_image_height, new_x:new_x+crop_image_width]
-        fit_mask_part = mask[new_y:new_y+crop_image_height, new_x:new_x+crop_image_width]
-        
-        up_scale = crop_image_width / target_width
-        
-        resized_image_part = resize(fit_image_part, (target_width,target_height))
-        resized_mask_part = resize(fit_mask_part, (target_width,target_height), cv2.INTER_NEAREST_EXACT)
-        
-        resized_image_part = np.clip(255. * resized_image_part, 0, 255).astype(np.float32) / 255.0
-        resized_image_part = torch.from_numpy(resized_image_part)[None,]
-        resized_mask_part = torch.from_numpy(resized_mask_part)[None,]
-        
-        fit_image_part = np.clip(255. * fit_image_part, 0, 255).astype(np.float32) / 255.0
-        fit_image_part = torch.from_numpy(fit_image_part)[None,]
-        fit_mask_part = torch.from_numpy(fit_mask_part)[None,]
+        def render_item(i):
+            image_part, mask_part = image_parts[i], mask_parts[i]
+            if backend == "torch":
+                image_part, mask_part = torch.from_numpy(image_part), torch.from_numpy(mask_part)
+            return render_context_window(image_part, mask_part, plans[i], backend, bboxes[i] is None, policy=interpolation, precision=precision)
+        results = map_items(render_item, len(plans), threads)
         
-        # output_patch_mode = (["auto", "patch_right", "patch_bottom"], {
-        #     "default": patch_mode,
-        # })
-        return (resized_image_part, resized_mask_part, patch_mode, new_x, new_y, up_scale, fit_image_part, fit_mask_part, )
-def fit_image(image,mask=None,output_length=1536,patch_mode="auto",patch_type="3:4",target_width=None,target_height=None):
-    if torch.is_tensor(image):
-        image = image.detach().cpu().numpy()
-    if mask is not None:
-        if torch.is_tensor(mask):
-            mask = mask.detach().cpu().numpy()
-    image_height, image_width, _ = image.shape
-    if target_width is None or target_height is None:
-        output_length, patch_mode, target_width, target_height = get_target_width_height(image, output_length, patch_mode, patch_type)
-    
-    # up_scale = 1
-    # pad_x = 0
-    # pad_y = 0
-    # crop_x = 0
-    # crop_y = 0
-    if image_width < target_width or image_height < target_height:
-        # print("image too small, resize to ", target_width, target_height)
-        if image_height > image_width:
-            new_width = int(image_width*(target_height/image_height))
-            new_height = target_height
-            # print(new_width,new_height)
-            image = resize(image, (new_width,new_height))
-            # print("mask",mask)
-            # print("mask.shape",mask.shape)
-            if mask is not None:
-                mask = resize(mask, (new_width,new_height),cv2.INTER_NEAREST_EXACT)
-        else:
-            new_width = target_width
-            new_height = int(image_height*(target_width/image_width))
-            # print(new_width,new_height)
-            image = resize(image, (new_width,new_height))
-            
-            # print("mask",mask)
-            # print("mask.shape",mask.shape)
-            if mask is not None:
-                mask = resize(mask, (new_width,new_height),cv2.INTER_NEAREST_EXACT)
-            
-        image_height, image_width, _ = image.shape
+        prepared_images, prepared_masks, patch_modes, x_offsets, y_offsets, scales, crop_images, crop_masks, plans = zip(*results)
+        with metrics.stage("concat", (prepared_images, crop_images)):
+            if backend == "torch":
+                prepared_image = torch.stack(prepared_images)
+                prepared_mask = torch.stack(prepared_masks).float()
+                crop_image = stack_with_padding(crop_images)
+                crop_mask = stack_with_padding(crop_masks).float()
+            else:
+                prepared_image = torch.from_numpy(np.stack(prepared_images))
+                prepared_mask = torch.from_numpy(np.stack(prepared_masks)).float()
+                crop_image = torch.from_numpy(stack_with_padding(crop_images))
+                crop_mask = torch.from_numpy(stack_with_padding(crop_masks)).float()
+        latent_mask = get_latent_mask(prepared_mask)
+        prepared_image = as_output_dtype(prepared_image, output_dtype)
+        utilizations = [get_pixel_utilization(plan) for plan in plans]
+        matrices = [get_affine_matrix(plan) for plan in plans]
+        pixel_counts = [get_plan_pixels(plan) for plan in plans]
         
-        diff_x = target_width - image_width
-        # print("diff_x",diff_x)
-        diff_y = target_height - image_height
-        # print("diff_y",diff_y)
-        pad_x = abs(diff_x) // 2
-        pad_y = abs(diff_y) // 2
-        # add white pixels for padding
-        if diff_x > 0 or diff_y > 0:
-            resized_image = cv2.copyMakeBorder(
-                image,
-                pad_y, abs(diff_y) - pad_y,
-                pad_x, abs(diff_x) - pad_x,
-                cv2.BORDER_CONSTANT, value=(255, 255, 255)
-            )
+        # a single mask keeps scalar outputs, mask batches return one value per window like CreateContextWindow
+        if len(plans) == 1:
+            return (prepared_image, prepared_mask, patch_modes[0], x_offsets[0], y_offsets[0], scales[0], crop_image, crop_mask, plans[0], 0, utilizations[0], latent_mask, matrices[0], pixel_counts[0], )
+        return (prepared_image, prepared_mask, patch_modes[0], list(x_offsets), list(y_offsets), list(scales), crop_image, crop_mask, list(plans), list(range(len(plans))), utilizations, latent_mask, matrices, pixel_counts, )
+
+def fit_image(image,mask=None,output_length=1536,patch_mode="auto",patch_type="3:4",target_width=None,target_height=None,backend="cv2",plan=None,policy="quality",precision="float32"):
+    resize, pad = get_backend_ops(backend)
+    resize, pad = metrics.timed("resize", resize), metrics.timed("pad", pad)
+    with metrics.stage("to_numpy", (image, mask), backend=backend):
+        if backend == "torch":
+            image = torch_backend.as_tensor(image)
             if mask is not None:
-                resized_mask = cv2.copyMakeBorder(
-                    mask,
-                    pad_y, abs(diff_y) - pad_y,
-                    pad_x, abs(diff_x) - pad_x,
-                    cv2.BORDER_CONSTANT, value=(0, 0, 0)
-                )
-        # crop extra pixels for square
+                mask = torch_backend.as_tensor(mask, image.device)
         else:
-            resized_image = image[pad_y:image_height-pad_y, pad_x:image_width-pad_x]
+            if torch.is_tensor(image):
+                image = image.detach().cpu().numpy()
             if mask is not None:
-                resized_mask = mask[pad_y:image_height-pad_y, pad_x:image_width-pad_x]
+                if torch.is_tensor(mask):
+                    mask = mask.detach().cpu().numpy()
+    if precision == "uint8" and backend != "torch":
+        image = quantize_image(image)
+    image_height, image_width, _ = image.shape
+    if plan is None:
+        plan = plan_fit(image_width, image_height, output_length, patch_mode, patch_type, target_width, target_height)
+    
+    # add white pixels for padding, black for the mask
+    resized_image = apply_plan(image, plan, resize, pad, get_interpolation(policy, plan.scale), (255, 255, 255))
+    if mask is not None:
+        resized_mask = apply_plan(mask, plan, resize, pad, get_interpolation(policy, plan.scale, True), (0, 0, 0))
     else:
-        # get resized image size
-        image_height, image_width, _ = image.shape
-        # print("new size",image_height, image_width)
-        # simple center crop
-        scale_ratio = target_width / target_height
-        image_ratio = image_width / image_height
-        # referenced kohya ss code
-        if image_ratio > scale_ratio: 
-            up_scale = image_height / target_height
-        else:
-            up_scale = image_width / target_width
-        expanded_closest_size = (int(target_width * up_scale + 0.5), int(target_height * up_scale + 0.5))
-        diff_x = abs(expanded_closest_size[0] - image_width)
-        diff_y = abs(expanded_closest_size[1] - image_height)
-        
-        crop_x =  diff_x // 2
-        crop_y =  diff_y // 2
-        cropped_image = image[crop_y:image_height-crop_y, crop_x:image_width-crop_x]
-        resized_image = resize(cropped_image, (target_width,target_height))
-        
-        if mask is not None:
-            # print("mask",mask)
-            # print("mask.shape",mask.shape)
-            cropped_mask = mask[crop_y:image_height-crop_y, crop_x:image_width-crop_x]
-            resized_mask = resize(cropped_mask, (target_width,target_height),cv2.INTER_NEAREST_EXACT)
-
-    if mask is None:
-        resized_mask = torch.ones((target_height,target_width))
+        resized_mask = torch.ones((plan.target_height,plan.target_width), dtype=torch.uint8, device=resized_image.device if backend == "torch" else None)
+    
+    if backend == "torch":
+        return resized_image, resized_mask, plan.target_width, plan.target_height, plan.patch_mode
     
     if torch.is_tensor(resized_image):
         resized_image = resized_image.detach().cpu().numpy()
     if torch.is_tensor(resized_mask):
         resized_mask = resized_mask.detach().cpu().numpy()
     
-    print("torch.is_tensor(resized_image)",torch.is_tensor(resized_image))
-    print("torch.is_tensor(resized_mask)",torch.is_tensor(resized_mask))
-    return resized_image, resized_mask, target_width, target_height, patch_mode
+    return resized_image, resized_mask, plan.target_width, plan.target_height, plan.patch_mode
 
 class ConcatContextWindow:
     @classmethod
@@ -367,7 +776,7 @@ class ConcatContextWindow:
                         "patch_mode": (["auto", "patch_right", "patch_bottom"], {
                             "default": "auto",
                         }),
-                        "patch_type": (["3:4","1:1", "9:16"], {
+                        "patch_type": (["3:4","1:1", "9:16", "auto"], {
                             "default": "3:4",
                         }),
                         "output_length": ("INT", {
@@ -381,60 +790,259 @@ class ConcatContextWindow:
                         # "first_mask": ("MASK",),
                         "second_image": ("IMAGE",),
                         "second_mask": ("MASK",),
+                        # quality: cubic, fast: linear and nearest for masks, auto: area averaging for 2x and larger downscales
+                        "interpolation": (["quality", "fast", "auto"], {
+                            "default": "quality",
+                        }),
+                        # uint8: fit and concatenate 8 bit pixels, float16: half size IMAGE output
+                        "precision": (["float32", "uint8"], {
+                            "default": "float32",
+                        }),
+                        "output_dtype": (["float32", "float16"], {
+                            "default": "float32",
+                        }),
+                        # CPU threads for the batch items and the cv2 / torch kernels, 0 uses ICLORA_THREADS or all cores
+                        "threads": ("INT", {
+                            "default": 0,
+                            "min": 0,
+                        }),
+                        # pixel budget of the two panel canvas, 0 keeps output_length, otherwise the largest panels with mod 64
+                        # sides within it are used, latent tokens are 16x16 pixels, the tighter budget applies
+                        "max_pixels": ("INT", {
+                            "default": 0,
+                            "min": 0,
+                        }),
+                        "max_latent_tokens": ("INT", {
+                            "default": 0,
+                            "min": 0,
+                        }),
+                        # torch: fit and concatenate on the device of the inputs, uint8 precision is cv2 only
+                        "backend": (["cv2", "torch"], {
+                            "default": "cv2",
+                        }),
                     }
                 }
-    RETURN_TYPES = ("IMAGE", "MASK", "INT", "INT", "INT", "INT", "INT", "INT")
-    RETURN_NAMES = ("IMAGE", "MASK", "target_width", "target_height", "x_offset", "y_offset", "total_width", "total_height")
+    RETURN_TYPES = ("IMAGE", "MASK", "INT", "INT", "INT", "INT", "INT", "INT", "FLOAT", "MASK", "INT")
+    RETURN_NAMES = ("IMAGE", "MASK", "target_width", "target_height", "x_offset", "y_offset", "total_width", "total_height", "pixel_utilization", "latent_mask", "pixel_count")
     FUNCTION = "concat_context_window"
 
     CATEGORY = "InContextUtils/ConcatContextWindow"
-    def concat_context_window(self, first_image, patch_mode, patch_type, output_length, patch_color, second_image=None, second_mask=None):
+    @cached_node
+    def concat_context_window(self, first_image, patch_mode, patch_type, output_length, patch_color, second_image=None, second_mask=None, threads=0, interpolation="quality", precision="float32", output_dtype="float32", max_pixels=0, max_latent_tokens=0, backend="cv2"):
         if output_length % 64 != 0:
             output_length = output_length - (output_length % 64)
-        image1 = first_image[0].clone()
-        image1, _, target_width, target_height, patch_mode = fit_image(image1, None, output_length, patch_mode, patch_type)
+        budget = get_pixel_budget(max_pixels, max_latent_tokens)
+        if budget:
+            output_length, patch_type = get_budget_panel(budget, patch_type)
+        batch_size = get_batch_size(*[batch for batch in (first_image, second_image, second_mask) if batch is not None])
         
-        image1_mask = torch.zeros((target_height,target_width))
-        if second_image is None:
-            # create blank image with patch color
-            image2 = create_image_from_color(target_width,target_height, color=patch_color)
-            image2 = torch.from_numpy(image2)
-            if second_mask is None:
-                image2_mask = torch.zeros((image2.shape[0], image2.shape[1]))
-            else:
-                image2_mask = second_mask[0].clone()
-            image2,image2_mask,_,_,_ = fit_image(image2, image2_mask, output_length, patch_mode, patch_type)
+        with metrics.stage("to_numpy", (first_image, second_image, second_mask), backend=backend):
+            first_images = as_backend_batch(first_image, backend)
+            second_images = as_backend_batch(second_image, backend)
+            second_masks = as_backend_batch(second_mask, backend)
+        resize_, _ = get_backend_ops(backend)
+        _, image_height, image_width, _ = first_images.shape
+        if patch_type == "auto" and second_images is not None:
+            # the window already has the bucket CreateContextWindow picked for it, the source is fitted to the same one
+            bucket = (second_images.shape[2], second_images.shape[1])
+            first_plan = plan_fit(image_width, image_height, output_length, get_bucket_patch_mode(bucket, patch_mode), patch_type, *bucket)
+        else:
+            first_plan = plan_fit(image_width, image_height, output_length, patch_mode, patch_type)
+        target_width, target_height, fitted_patch_mode = first_plan.target_width, first_plan.target_height, first_plan.patch_mode
+        if second_images is None:
+            second_size = (target_width, target_height)
         else:
-            image2 = second_image[0]
-            if second_mask is None:
-                image2_mask = torch.ones((image1.shape[0], image1.shape[1]))
+            second_size = (second_images.shape[2], second_images.shape[1])
+        # the blank patch is already at the target size, its mask is fitted to it
+        blank_plan = plan_fit(target_width, target_height, output_length, fitted_patch_mode, patch_type, target_width, target_height)
+        
+        slots = []
+        for i in range(batch_size):
+            first_index = broadcast_index(first_image, i)
+            first_writers = (fit_panel(first_images[first_index], first_plan, resize_, get_interpolation(interpolation, first_plan.scale), (255, 255, 255)), fill_panel(0))
+            
+            second_key = (broadcast_index(second_image, i), broadcast_index(second_mask, i))
+            if second_images is None:
+                # blank image with patch color
+                write_image = fill_panel(get_color(patch_color))
+                if second_masks is None:
+                    write_mask = fill_panel(0)
+                else:
+                    write_mask = fit_panel(second_masks[second_key[1]], blank_plan, resize_, get_interpolation(interpolation, blank_plan.scale, True), 0)
             else:
-                image2_mask = second_mask[0].clone()
+                write_image = fill_panel(second_images[second_key[0]])
+                if second_masks is None:
+                    write_mask = fill_panel(1)
+                else:
+                    write_mask = fill_panel(second_masks[second_key[1]])
+            slots.append((first_index, second_key, first_writers, (write_image, write_mask)))
+        
+        device = first_images.device if backend == "torch" else None
+        return_images, return_masks = compose_batch(slots, fitted_patch_mode, (target_width, target_height), second_size, threads, precision, device)
+        return_images = as_output_dtype(return_images, output_dtype)
         min_y = 0
         min_x = 0
-        
-        # print("image1.shape",image1.shape)
-        # print("image2.shape",image2.shape)
-        # print("image1_mask.shape",image1_mask.shape)
-        # print("image2_mask.shape",image2_mask.shape)
-        if patch_mode == "patch_right":
-            concatenated_image = np.hstack((image1, image2))
-            concatenated_mask = np.hstack((image1_mask, image2_mask))
+        if fitted_patch_mode == "patch_right":
             min_x = 50
         else:
-            concatenated_image = np.vstack((image1, image2))
-            concatenated_mask = np.vstack((image1_mask, image2_mask))
             min_y = 50
-        min_y = int(min_y / 100.0 * concatenated_image.shape[0])
-        min_x = int(min_x / 100.0 * concatenated_image.shape[1])
+        min_y = int(min_y / 100.0 * return_images.shape[1])
+        min_x = int(min_x / 100.0 * return_images.shape[2])
         
-        return_masks = torch.from_numpy(concatenated_mask)[None,]
-        
-        concatenated_image = np.clip(255. * concatenated_image, 0, 255).astype(np.float32) / 255.0
-        concatenated_image = torch.from_numpy(concatenated_image)[None,]
-        
-        return_images = concatenated_image
-        return (return_images, return_masks, target_width, target_height, min_x, min_y, concatenated_image.shape[1], concatenated_image.shape[0], )
+        return (return_images, return_masks, target_width, target_height, min_x, min_y, return_images.shape[2], return_images.shape[1], get_pixel_utilization(first_plan), get_latent_mask(return_masks), return_images.shape[1] * return_images.shape[2], )
+
+def per_item(value, index):
+    # offsets and scales are lists for batched context windows
+    if isinstance(value, (list, tuple)):
+        return value[index if len(value) > 1 else 0]
+    return value
+
+def get_generated_panel(panel, patch_mode, width, height):
+    # the generated panel is the second half of the concatenated canvas, panels at their own size are kept
+    panel_height, panel_width = panel.shape[:2]
+    if patch_mode == "patch_bottom" and panel_height > height:
+        return panel[panel_height // 2:]
+    if patch_mode != "patch_bottom" and panel_width > width:
+        return panel[:, panel_width // 2:]
+    return panel
+
+# paste the generated context window back into the original image
+# only the window region is resized and blended, the rest of the original is left untouched
+class StitchContextWindow:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+                "required": {
+                    "original_image": ("IMAGE",),
+                    "generated_image": ("IMAGE",),
+                    "patch_mode": ("STRING", {
+                        "default": "patch_right",
+                    }),
+                    "target_width": ("INT", {
+                        "default": 768,
+                    }),
+                    "target_height": ("INT", {
+                        "default": 1024,
+                    }),
+                    "x_offset_of_ori": ("INT", {
+                        "default": 0,
+                    }),
+                    "y_offset_of_ori": ("INT", {
+                        "default": 0,
+                    }),
+                    "scale": ("FLOAT", {
+                        "default": 1.0,
+                    }),
+                },
+                "optional": {
+                    "mask": ("MASK",),
+                    "plan": ("CONTEXT_WINDOW_PLAN",),
+                    # the affine_matrix of the window, pastes back through the inverse of the window's mapping,
+                    # it takes precedence over plan and the int inputs
+                    "affine_matrix": ("AFFINE_MATRIX",),
+                    # paste every window into the original image it was cut from instead of one output per window
+                    "source_index": ("INT", {
+                        "forceInput": True,
+                    }),
+                    "feather": ("INT", {
+                        "default": 0,
+                        "min": 0,
+                    }),
+                    "in_place": ("BOOLEAN", {
+                        "default": False,
+                    }),
+                }
+            }
+    RETURN_TYPES = ("IMAGE",)
+    RETURN_NAMES = ("stitched_image",)
+    FUNCTION = "stitch_context_window"
+    CATEGORY = "InContextUtils/StitchContextWindow"
+
+    def stitch_context_window(self, original_image, generated_image, patch_mode, target_width, target_height, x_offset_of_ori, y_offset_of_ori, scale, mask=None, plan=None, source_index=None, feather=0, in_place=False, affine_matrix=None):
+        if source_index is None:
+            batch_size = get_batch_size(*[batch for batch in (original_image, generated_image, mask) if batch is not None])
+            output_size = batch_size
+        else:
+            batch_size = get_batch_size(*[batch for batch in (generated_image, mask) if batch is not None])
+            output_size = len(original_image)
+        if in_place and len(original_image) == output_size:
+            # writes into the upstream tensor, only use it when nothing else reads the original
+            stitched = original_image
+        else:
+            # one output buffer, the original is written into it once and the windows are blended in place
+            stitched = torch.empty((output_size, ) + tuple(original_image.shape[1:]), dtype=original_image.dtype, device=original_image.device)
+            stitched.copy_(original_image.expand(output_size, -1, -1, -1))
+        _, image_height, image_width, _ = stitched.shape
+
+        for i in range(batch_size):
+            output_index = i if source_index is None else per_item(source_index, i)
+            # the plan is the exact geometry, the int outputs are used when it is not connected
+            item_plan = per_item(plan, i) if plan is not None else None
+            item_patch_mode = item_plan.patch_mode if item_plan is not None else patch_mode
+            item_width = item_plan.target_width if item_plan is not None else target_width
+            item_height = item_plan.target_height if item_plan is not None else target_height
+
+            # float16 outputs of the context window nodes are blended in the dtype of the original
+            generated = generated_image[broadcast_index(generated_image, i)].to(stitched.device, stitched.dtype)
+            generated = get_generated_panel(generated, item_patch_mode, item_width, item_height)
+            if mask is None:
+                panel_mask = torch.ones(generated.shape[:2], dtype=stitched.dtype, device=stitched.device)
+            else:
+                # a mask of the whole canvas is split like the image
+                panel_mask = mask[broadcast_index(mask, i)].to(stitched.device, stitched.dtype)
+                panel_mask = get_generated_panel(panel_mask, item_patch_mode, item_width, item_height)
+
+            # a batch has one matrix per window, a single window is the matrix itself
+            item_matrix = per_item(affine_matrix, i) if isinstance(affine_matrix, list) else affine_matrix
+            if item_matrix is not None:
+                x, y, source_right, source_bottom = get_matrix_source_rect(item_matrix, item_width, item_height, image_width, image_height)
+                crop_width = source_right - x
+                crop_height = source_bottom - y
+            elif item_plan is None:
+                x = per_item(x_offset_of_ori, i)
+                y = per_item(y_offset_of_ori, i)
+                item_scale = per_item(scale, i)
+                # windows larger than the image were clipped by CreateContextWindow before resizing
+                crop_width = min(int(round(item_width * item_scale)), image_width - x)
+                crop_height = min(int(round(item_height * item_scale)), image_height - y)
+            else:
+                # drop the padding of the panel, keep the content that maps back to the source
+                if generated.shape[:2] != (item_height, item_width):
+                    generated = torch_backend.resize(generated, (item_width, item_height))
+                if panel_mask.shape != (item_height, item_width):
+                    panel_mask = torch_backend.resize(panel_mask, (item_width, item_height), cv2.INTER_LINEAR)
+                (left, top, right, bottom), (x, y, source_right, source_bottom) = get_content_rects(item_plan)
+                generated = generated[top:bottom, left:right]
+                panel_mask = panel_mask[top:bottom, left:right]
+                crop_width = source_right - x
+                crop_height = source_bottom - y
+            if crop_width <= 0 or crop_height <= 0:
+                continue
+            if item_matrix is not None:
+                with metrics.stage("warp", generated):
+                    rect, size = (x, y, x + crop_width, y + crop_height), (item_width, item_height)
+                    region = torch_backend.warp_affine(generated, item_matrix, rect, size).clamp(0, 1)
+                    region_mask = torch_backend.warp_affine(panel_mask, item_matrix, rect, size, cv2.INTER_LINEAR)
+                    region_mask = torch_backend.feather(region_mask, feather).clamp(0, 1)
+            else:
+                with metrics.stage("resize", generated):
+                    region = torch_backend.resize(generated, (crop_width, crop_height)).clamp(0, 1)
+                    region_mask = torch_backend.resize(panel_mask, (crop_width, crop_height), cv2.INTER_LINEAR)
+                    region_mask = torch_backend.feather(region_mask, feather).clamp(0, 1)
+
+            # blend inside the bounding box of the mask only
+            with metrics.stage("blend", region):
+                rows = torch.nonzero(region_mask.any(dim=1)).flatten()
+                cols = torch.nonzero(region_mask.any(dim=0)).flatten()
+                if len(rows) == 0:
+                    continue
+                top, bottom = rows[0].item(), rows[-1].item() + 1
+                left, right = cols[0].item(), cols[-1].item() + 1
+                alpha = region_mask[top:bottom, left:right, None]
+                target = stitched[output_index, y + top:y + bottom, x + left:x + right]
+                target.lerp_(region[top:bottom, left:right], alpha)
+
+        return (stitched, )
 
 # NODE_CLASS_MAPPINGS = {
 #     "ConcatContextWindow": ConcatContextWindow,
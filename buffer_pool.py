@@ -0,0 +1,46 @@
+import threading
+from contextlib import contextmanager
+
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# Small pool of scratch arrays keyed by shape and dtype. Fixed output sizes reuse their
+# intermediate buffers across node calls instead of allocating new ones every time.
+# Buffers are checked out while borrowed, so concurrent callers never share one.
+
+class BufferPool:
+    def __init__(self, max_buffers=8):
+        self.max_buffers = max_buffers
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def borrow(self, shape, dtype="float32"):
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.lock:
+            free = self.buffers.pop(key, [])
+            buffer = free.pop() if free else None
+            if free:
+                self.buffers[key] = free
+        if buffer is None:
+            buffer = np.empty(shape, dtype=dtype)
+        try:
+            yield buffer
+        finally:
+            with self.lock:
+                # most recently used sizes move to the end, the oldest sizes are dropped first
+                free = self.buffers.pop(key, [])
+                free.append(buffer)
+                self.buffers[key] = free
+                while sum(len(free) for free in self.buffers.values()) > self.max_buffers:
+                    oldest = next(iter(self.buffers))
+                    self.buffers[oldest].pop(0)
+                    if not self.buffers[oldest]:
+                        del self.buffers[oldest]
+
+    def clear(self):
+        with self.lock:
+            self.buffers.clear()
+
+scratch_pool = BufferPool()
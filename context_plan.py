@@ -0,0 +1,471 @@
+import bisect
+import math
+from dataclasses import dataclass, replace
+from functools import lru_cache
+
+# cv2.INTER_CUBIC, the flag values are fixed by the cv2 API, defaults use the value so cv2 loads lazily
+INTER_CUBIC = 2
+
+# Geometry shared by fit_image, CreateContextWindow and StitchContextWindow.
+# A plan maps an image_width x image_height source to a target panel in three steps:
+#   1. crop (crop_x, crop_y, crop_width, crop_height) from the source, a full size crop also
+#      accepts masks of a different size than the image, they are resized as a whole
+#   2. resize the crop to (resize_width, resize_height)
+#   3. pad the resized crop to (target_width, target_height), negative padding crops instead
+# The planners are memoized, repeated runs over same shaped inputs skip the arithmetic entirely.
+
+@dataclass(frozen=True, slots=True)
+class ContextWindowPlan:
+    image_width: int
+    image_height: int
+    output_length: int
+    patch_mode: str
+    target_width: int
+    target_height: int
+    crop_x: int
+    crop_y: int
+    crop_width: int
+    crop_height: int
+    resize_width: int
+    resize_height: int
+    pad_left: int
+    pad_top: int
+    pad_right: int
+    pad_bottom: int
+    # source pixels per target pixel
+    scale: float
+
+def closest_mod_64(value):
+    return value - (value % 64)
+
+@lru_cache(maxsize=None)
+def parse_patch_type(patch_type):
+    short_part, long_part = [int(x) for x in patch_type.split(":")]
+    return short_part, long_part
+
+def is_patch_bottom(image_width, image_height, patch_mode):
+    return (patch_mode == "auto" and image_width > image_height) or patch_mode == "patch_bottom"
+
+def get_bucket_area(output_length):
+    # pixel area of a 3:4 panel, 768x1024 for an output_length of 1536
+    return output_length * output_length // 3
+
+@lru_cache(maxsize=None)
+def get_buckets(area, max_ratio=4):
+    # mod 64 (width, height) pairs of at most area pixels with an aspect ratio up to max_ratio,
+    # sorted by aspect ratio with the log ratios alongside for the nearest bucket lookup
+    buckets = set()
+    for width in range(64, area // 64 + 1, 64):
+        height = closest_mod_64(area // width)
+        if height >= 64 and max(width, height) <= max_ratio * min(width, height):
+            buckets.add((width, height))
+    # the largest area wins among buckets of the same aspect ratio
+    buckets = sorted(buckets, key=lambda bucket: (bucket[0] / bucket[1], -bucket[0] * bucket[1]))
+    return tuple(buckets), tuple(math.log(width / height) for width, height in buckets)
+
+@lru_cache(maxsize=1024)
+def select_bucket(width, height, area):
+    # bucket with the aspect ratio closest to width x height, the one that needs the least padding
+    buckets, log_ratios = get_buckets(area)
+    log_ratio = math.log(width / height)
+    index = bisect.bisect_left(log_ratios, log_ratio)
+    candidates = [i for i in (index - 1, index) if 0 <= i < len(buckets)]
+    best = min(candidates, key=lambda i: (abs(log_ratios[i] - log_ratio), -buckets[i][0] * buckets[i][1]))
+    return buckets[best]
+
+# latent tokens of the sampler, 8x VAE downscale and 2x2 patches
+LATENT_TOKEN_PIXELS = 16 * 16
+
+def get_pixel_budget(max_pixels=0, max_latent_tokens=0):
+    # the tighter of the two budgets, 0 when neither is set
+    budgets = [budget for budget in (max_pixels, max_latent_tokens * LATENT_TOKEN_PIXELS) if budget > 0]
+    return min(budgets) if budgets else 0
+
+def get_canvas_pixels(output_length, patch_type):
+    # pixels of the two panel canvas, the orientation of the panels does not change them
+    # auto buckets hold at most the bucket area, so every window of an output_length stays within it
+    if patch_type == "auto":
+        return 2 * get_bucket_area(output_length)
+    short_part, long_part = parse_patch_type(patch_type)
+    total = short_part * 2
+    return 2 * int(output_length / total * short_part) * int(output_length / total * long_part)
+
+@lru_cache(maxsize=None)
+def get_budget_length(max_pixels, patch_type):
+    # largest output_length, a multiple of 64, whose two panel canvas stays within max_pixels
+    # it only depends on the budget and patch_type, so the nodes of one workflow agree on the panel size
+    # every patch type has at least output_length ** 2 / 2 canvas pixels, the search starts right above that
+    output_length = closest_mod_64(math.isqrt(2 * max_pixels)) + 64
+    while output_length > 64 and get_canvas_pixels(output_length, patch_type) > max_pixels:
+        output_length -= 64
+    return output_length
+
+@lru_cache(maxsize=None)
+def get_budget_panel(max_pixels, patch_type):
+    # output_length and patch_type of the largest two panel canvas within max_pixels with mod 64 panel sides,
+    # the sides are written as the patch_type in pixels, short:long, with an output_length of twice the short side,
+    # so get_target_size returns exactly those sides and every node of a workflow agrees on them
+    if patch_type == "auto":
+        # buckets are mod 64 already
+        return get_budget_length(max_pixels, patch_type), patch_type
+    short_part, long_part = parse_patch_type(patch_type)
+    # the long side is the multiple of 64 closest to the ratio of patch_type
+    panels = [(short_side, max(64 * round(short_side * long_part / short_part / 64), 64)) for short_side in range(64, math.isqrt(max_pixels // 2) + 1, 64)]
+    panels = [(short_side, long_side) for short_side, long_side in panels if 2 * short_side * long_side <= max_pixels]
+    short_side, long_side = max(panels, key=lambda panel: panel[0] * panel[1], default=(64, 64 * max(round(long_part / short_part), 1)))
+    return 2 * short_side, f"{short_side}:{long_side}"
+
+def get_plan_pixels(plan):
+    # pixels of the two panel canvas the window of plan is concatenated into
+    return 2 * plan.target_width * plan.target_height
+
+@lru_cache(maxsize=1024)
+def get_target_size(image_width, image_height, output_length, patch_mode, patch_type):
+    output_length = closest_mod_64(output_length)
+    if patch_type == "auto":
+        patch_mode = "patch_bottom" if is_patch_bottom(image_width, image_height, patch_mode) else "patch_right"
+        target_width, target_height = select_bucket(image_width, image_height, get_bucket_area(output_length))
+        return output_length, patch_mode, target_width, target_height
+    short_part, long_part = parse_patch_type(patch_type)
+    total = short_part * 2
+
+    if is_patch_bottom(image_width, image_height, patch_mode):
+        patch_mode = "patch_bottom"
+        target_width = int(output_length / total * long_part)
+        target_height = int(output_length / total * short_part)
+    else:
+        patch_mode = "patch_right"
+        target_width = int(output_length / total * short_part)
+        target_height = int(output_length / total * long_part)
+
+    return output_length, patch_mode, target_width, target_height
+
+def split_padding(diff):
+    # positive differences are padded, negative differences are cropped, both centered
+    half = abs(diff) // 2
+    if diff >= 0:
+        return half, diff - half
+    return -half, -(abs(diff) - half)
+
+@lru_cache(maxsize=1024)
+def plan_fit(image_width, image_height, output_length, patch_mode, patch_type, target_width=None, target_height=None):
+    # fit_image in InContextUtils: small images are resized along one side and padded, large images are center cropped
+    if target_width is None or target_height is None:
+        output_length, patch_mode, target_width, target_height = get_target_size(image_width, image_height, output_length, patch_mode, patch_type)
+
+    if image_width < target_width or image_height < target_height:
+        if image_height > image_width:
+            new_width = int(image_width*(target_height/image_height))
+            new_height = target_height
+        else:
+            new_width = target_width
+            new_height = int(image_height*(target_width/image_width))
+        pad_left, pad_right = split_padding(target_width - new_width)
+        pad_top, pad_bottom = split_padding(target_height - new_height)
+        return ContextWindowPlan(image_width, image_height, output_length, patch_mode, target_width, target_height,
+                                 0, 0, image_width, image_height, new_width, new_height,
+                                 pad_left, pad_top, pad_right, pad_bottom, image_width / new_width)
+
+    # referenced kohya ss code
+    if image_width / image_height > target_width / target_height:
+        up_scale = image_height / target_height
+    else:
+        up_scale = image_width / target_width
+    expanded_closest_size = (int(target_width * up_scale + 0.5), int(target_height * up_scale + 0.5))
+    crop_x = abs(expanded_closest_size[0] - image_width) // 2
+    crop_y = abs(expanded_closest_size[1] - image_height) // 2
+    crop_width = image_width - 2 * crop_x
+    crop_height = image_height - 2 * crop_y
+    return ContextWindowPlan(image_width, image_height, output_length, patch_mode, target_width, target_height,
+                             crop_x, crop_y, crop_width, crop_height, target_width, target_height,
+                             0, 0, 0, 0, crop_width / target_width)
+
+@lru_cache(maxsize=1024)
+def plan_letterbox(image_width, image_height, output_length, patch_mode, patch_type="3:4", target_width=None, target_height=None):
+    # fit_image in InContextLoraUtils: scale down to fit and pad the rest, 3:4 panels unless patch_type is auto
+    if target_width is None or target_height is None:
+        output_length, patch_mode, target_width, target_height = get_target_size(image_width, image_height, output_length, patch_mode, patch_type)
+    scale_ratio = min(target_width / image_width, target_height / image_height)
+    new_width = int(image_width * scale_ratio)
+    new_height = int(image_height * scale_ratio)
+    pad_left, pad_right = split_padding(target_width - new_width)
+    pad_top, pad_bottom = split_padding(target_height - new_height)
+    return ContextWindowPlan(image_width, image_height, output_length, patch_mode, target_width, target_height,
+                             0, 0, image_width, image_height, new_width, new_height,
+                             pad_left, pad_top, pad_right, pad_bottom, image_width / new_width)
+
+def get_buffered_size(image_width, image_height, bbox, pixel_buffer):
+    # size of the mask box grown by pixel_buffer and clipped to the image, the whole image for an empty mask
+    if bbox is None:
+        return image_width, image_height
+    ori_x, ori_y, ori_bb_width, ori_bb_height = bbox
+    ori_x_with_buffer = max(int(ori_x - pixel_buffer//2), 0)
+    ori_y_with_buffer = max(int(ori_y - pixel_buffer//2), 0)
+    buffer_bb_width = min(int(ori_bb_width + pixel_buffer), image_width)
+    buffer_bb_height = min(int(ori_bb_height + pixel_buffer), image_height)
+    return min(buffer_bb_width, image_width - ori_x_with_buffer), min(buffer_bb_height, image_height - ori_y_with_buffer)
+
+def get_shared_bucket(image_width, image_height, bboxes, output_length, patch_type, pixel_buffer):
+    # one bucket for every window of a call, so the panels stack into one batch and concatenate with the
+    # source, the bucket closest to the mean aspect ratio of the windows on a log scale, None unless auto
+    if patch_type != "auto" or not bboxes:
+        return None
+    sizes = [get_buffered_size(image_width, image_height, bbox, pixel_buffer) for bbox in bboxes]
+    log_ratio = sum(math.log(width / height) for width, height in sizes) / len(sizes)
+    return select_bucket(math.exp(log_ratio), 1, get_bucket_area(closest_mod_64(output_length)))
+
+def get_bucket_patch_mode(bucket, patch_mode):
+    # auto stacks the panels of wide buckets and puts tall ones side by side
+    if patch_mode != "auto":
+        return patch_mode
+    return "patch_bottom" if bucket[0] > bucket[1] else "patch_right"
+
+@lru_cache(maxsize=1024)
+def plan_context_window(image_width, image_height, bbox, output_length, patch_mode, patch_type, pixel_buffer, bucket=None):
+    # bbox is (x, y, width, height) of the mask, None for an empty mask which falls back to fitting the whole image
+    # bucket is the (width, height) an auto patch_type uses, the one closest to the window when it is None
+    output_length, fitted_patch_mode, target_width, target_height = get_target_size(image_width, image_height, output_length, patch_mode, patch_type)
+    if patch_type == "auto":
+        crop_image_width, crop_image_height = get_buffered_size(image_width, image_height, bbox, pixel_buffer)
+        target_width, target_height = bucket or select_bucket(crop_image_width, crop_image_height, get_bucket_area(output_length))
+        fitted_patch_mode = get_bucket_patch_mode((target_width, target_height), patch_mode)
+    patch_mode = fitted_patch_mode
+    if bbox is None:
+        return plan_fit(image_width, image_height, output_length, patch_mode, patch_type, target_width, target_height)
+
+    ori_x, ori_y, ori_bb_width, ori_bb_height = bbox
+    # get center of the bounding box
+    center_x, center_y = ori_x + ori_bb_width // 2, ori_y + ori_bb_height // 2
+    crop_image_width, crop_image_height = get_buffered_size(image_width, image_height, bbox, pixel_buffer)
+
+    if patch_type == "auto":
+        # the window grows along one side to the aspect ratio of the bucket
+        if crop_image_width * target_height >= crop_image_height * target_width:
+            crop_image_height = int(round(crop_image_width * target_height / target_width))
+        else:
+            crop_image_width = int(round(crop_image_height * target_width / target_height))
+    else:
+        short_part, long_part = parse_patch_type(patch_type)
+        total = short_part * 2
+
+        if crop_image_width >= crop_image_height:
+            if patch_mode == "patch_bottom":
+                crop_output_length = int(crop_image_width / long_part * total)
+                crop_image_height = int(crop_output_length / total * short_part)
+            else:
+                crop_output_length = int(crop_image_width / short_part * total)
+                crop_image_height = int(crop_output_length / total * long_part)
+        else:
+            if patch_mode == "patch_bottom":
+                crop_output_length = int(crop_image_height / short_part * total)
+                crop_image_width = int(crop_output_length / total * long_part)
+            else:
+                crop_output_length = int(crop_image_height / long_part * total)
+                crop_image_width = int(crop_output_length / total * short_part)
+
+    # based on center x,y and crop image width, calculate the x,y offset
+    new_x = int(center_x - crop_image_width // 2)
+    new_y = int(center_y - crop_image_height // 2)
+    new_x = max(min(new_x, image_width - crop_image_width), 0)
+    new_y = max(min(new_y, image_height - crop_image_height), 0)
+
+    # windows larger than the image are clipped to it and stretched to the target size
+    crop_width = min(crop_image_width, image_width - new_x)
+    crop_height = min(crop_image_height, image_height - new_y)
+    return ContextWindowPlan(image_width, image_height, output_length, patch_mode, target_width, target_height,
+                             new_x, new_y, crop_width, crop_height, target_width, target_height,
+                             0, 0, 0, 0, crop_image_width / target_width)
+
+@lru_cache(maxsize=1024)
+def pack_grid(count, cell_width, cell_height):
+    # (columns, rows) of a canvas holding count cells, trading squareness against empty trailing cells,
+    # the smallest grid alone turns prime counts into 1 x N strips
+    def cost(columns):
+        rows = -(-count // columns)
+        return abs(math.log(columns * cell_width / (rows * cell_height))) + math.log(columns * rows / count), columns * rows
+    columns = min(range(1, count + 1), key=cost)
+    return columns, -(-count // columns)
+
+def get_pixel_utilization(plan):
+    # share of the target panel covered by image content instead of padding
+    content_width = plan.target_width - max(plan.pad_left, 0) - max(plan.pad_right, 0)
+    content_height = plan.target_height - max(plan.pad_top, 0) - max(plan.pad_bottom, 0)
+    return content_width * content_height / (plan.target_width * plan.target_height)
+
+def is_full_crop(plan):
+    return (plan.crop_x, plan.crop_y, plan.crop_width, plan.crop_height) == (0, 0, plan.image_width, plan.image_height)
+
+def crop_local_plan(plan):
+    # the same plan for a source that was already cut to the crop rectangle
+    return replace(plan, image_width=plan.crop_width, image_height=plan.crop_height, crop_x=0, crop_y=0)
+
+def apply_plan(image, plan, resize, pad, interpolation=INTER_CUBIC, value=0, batched=False):
+    # resize and pad are the backend ops, see get_backend_ops in InContextUtils
+    # batched applies the plan to every item of a [N,H,W,C] or [N,H,W] torch batch at once
+    if batched and image.dim() == 3:
+        return apply_plan(image[..., None], plan, resize, pad, interpolation, value, batched)[..., 0]
+    batch = (slice(None),) if batched else ()
+    if not is_full_crop(plan):
+        image = image[batch + (slice(plan.crop_y, plan.crop_y + plan.crop_height), slice(plan.crop_x, plan.crop_x + plan.crop_width))]
+    if image.shape[len(batch)] != plan.resize_height or image.shape[len(batch) + 1] != plan.resize_width:
+        image = resize(image, (plan.resize_width, plan.resize_height), interpolation)
+    # negative padding crops the resized image
+    image = image[batch + (slice(max(-plan.pad_top, 0), plan.resize_height - max(-plan.pad_bottom, 0)),
+                           slice(max(-plan.pad_left, 0), plan.resize_width - max(-plan.pad_right, 0)))]
+    if plan.pad_top > 0 or plan.pad_bottom > 0 or plan.pad_left > 0 or plan.pad_right > 0:
+        image = pad(image, max(plan.pad_top, 0), max(plan.pad_bottom, 0), max(plan.pad_left, 0), max(plan.pad_right, 0), value=value)
+    return image
+
+def apply_plan_into(image, plan, out, resize, interpolation=INTER_CUBIC, value=0, pool=None):
+    # same as apply_plan, but writes into out, a target sized view of a preallocated canvas
+    # resize needs the dst keyword of cv2.resize, pool lends the scratch buffer when one is needed
+    top, left = max(plan.pad_top, 0), max(plan.pad_left, 0)
+    bottom = plan.target_height - max(plan.pad_bottom, 0)
+    right = plan.target_width - max(plan.pad_right, 0)
+    out[:top] = value
+    out[bottom:] = value
+    out[top:bottom, :left] = value
+    out[top:bottom, right:] = value
+    content = out[top:bottom, left:right]
+
+    if not is_full_crop(plan):
+        image = image[plan.crop_y:plan.crop_y + plan.crop_height, plan.crop_x:plan.crop_x + plan.crop_width]
+    # negative padding crops the resized image
+    content_rows = slice(max(-plan.pad_top, 0), plan.resize_height - max(-plan.pad_bottom, 0))
+    content_cols = slice(max(-plan.pad_left, 0), plan.resize_width - max(-plan.pad_right, 0))
+    if image.shape[0] == plan.resize_height and image.shape[1] == plan.resize_width:
+        content[...] = image[content_rows, content_cols]
+    elif content.shape == (plan.resize_height, plan.resize_width) + image.shape[2:] and content.dtype == image.dtype:
+        # resize straight into the canvas
+        resized = resize(image, (plan.resize_width, plan.resize_height), interpolation, dst=content)
+        if resized is not content:
+            content[...] = resized
+    else:
+        if pool is None:
+            resized = resize(image, (plan.resize_width, plan.resize_height), interpolation)
+            content[...] = resized[content_rows, content_cols]
+        else:
+            with pool.borrow((plan.resize_height, plan.resize_width) + image.shape[2:], image.dtype) as scratch:
+                resized = resize(image, (plan.resize_width, plan.resize_height), interpolation, dst=scratch)
+                content[...] = resized[content_rows, content_cols]
+    return out
+
+def get_affine_matrix(plan):
+    # 2x3 matrix from source to target pixel coordinates, the same mapping as crop, resize and pad
+    # cv2.resize samples target pixel u at source (u + 0.5) * scale - 0.5
+    scale_x = plan.crop_width / plan.resize_width
+    scale_y = plan.crop_height / plan.resize_height
+    return ((1 / scale_x, 0.0, (0.5 - plan.crop_x) / scale_x - 0.5 + plan.pad_left),
+            (0.0, 1 / scale_y, (0.5 - plan.crop_y) / scale_y - 0.5 + plan.pad_top))
+
+def invert_affine_matrix(matrix):
+    # target to source coordinates, for pasting a generated panel back into the original
+    (a, b, c), (d, e, f) = matrix
+    determinant = a * e - b * d
+    return ((e / determinant, -b / determinant, (b * f - c * e) / determinant),
+            (-d / determinant, a / determinant, (c * d - a * f) / determinant))
+
+def get_matrix_source_rect(matrix, target_width, target_height, image_width, image_height):
+    # source pixels whose centers the source to target matrix maps into the target panel, clipped to the image
+    (a, b, c), (d, e, f) = invert_affine_matrix(matrix)
+    corners = [(u, v) for u in (-0.5, target_width - 0.5) for v in (-0.5, target_height - 0.5)]
+    xs = [a * u + b * v + c for u, v in corners]
+    ys = [d * u + e * v + f for u, v in corners]
+    left, top = max(math.ceil(min(xs)), 0), max(math.ceil(min(ys)), 0)
+    right, bottom = min(math.floor(max(xs)) + 1, image_width), min(math.floor(max(ys)) + 1, image_height)
+    return left, top, right, bottom
+
+def warp_plan_into(image, plan, out, warp, interpolation=INTER_CUBIC, value=0):
+    # same as apply_plan_into with one affine warp instead of resize and pad
+    # the warp only covers the content rectangle and replicates the crop edges like resize does,
+    # a constant border would blend the fill value into the outer content pixels
+    (left, top, right, bottom), _ = get_content_rects(plan)
+    out[:top] = value
+    out[bottom:] = value
+    out[top:bottom, :left] = value
+    out[top:bottom, right:] = value
+    if not is_full_crop(plan):
+        # warp from a view of the crop, the cubic kernel must not read the pixels around it
+        image = image[plan.crop_y:plan.crop_y + plan.crop_height, plan.crop_x:plan.crop_x + plan.crop_width]
+        plan = crop_local_plan(plan)
+    (a, b, c), (d, e, f) = get_affine_matrix(plan)
+    content = out[top:bottom, left:right]
+    warped = warp(image, ((a, b, c - left), (d, e, f - top)), (right - left, bottom - top), interpolation, dst=content)
+    if warped is not content:
+        content[...] = warped
+    return out
+
+def get_content_rects(plan):
+    # the part of the target panel holding image content, and the source rectangle it maps back to
+    left, top = max(plan.pad_left, 0), max(plan.pad_top, 0)
+    right = plan.target_width - max(plan.pad_right, 0)
+    bottom = plan.target_height - max(plan.pad_bottom, 0)
+    scale_x = plan.crop_width / plan.resize_width
+    scale_y = plan.crop_height / plan.resize_height
+    source_left = plan.crop_x + round(max(-plan.pad_left, 0) * scale_x)
+    source_top = plan.crop_y + round(max(-plan.pad_top, 0) * scale_y)
+    source_right = plan.crop_x + plan.crop_width - round(max(-plan.pad_right, 0) * scale_x)
+    source_bottom = plan.crop_y + plan.crop_height - round(max(-plan.pad_bottom, 0) * scale_y)
+    return (left, top, right, bottom), (source_left, source_top, source_right, source_bottom)
+
+def get_box_gap(box1, box2):
+    # largest axis gap between two (x0, y0, x1, y1) boxes, 0 or less when they overlap
+    return max(box2[0] - box1[2], box1[0] - box2[2], box2[1] - box1[3], box1[1] - box2[3])
+
+def cluster_boxes(boxes, pixel_buffer=64, distance=0):
+    # merge (x, y, width, height) boxes whose buffered windows overlap or lie within distance of each other
+    # merged boxes can reach new neighbours, so sweep until nothing changes
+    max_gap = pixel_buffer + distance
+    clusters = [(x, y, x + width, y + height) for x, y, width, height in boxes]
+    merged = True
+    while merged and len(clusters) > 1:
+        merged = False
+        clusters.sort()
+        result = []
+        for box in clusters:
+            for k in range(len(result) - 1, -1, -1):
+                other = result[k]
+                if get_box_gap(box, other) <= max_gap:
+                    result[k] = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
+                    merged = True
+                    break
+            else:
+                result.append(box)
+        clusters = result
+    # top to bottom, left to right
+    clusters.sort(key=lambda box: (box[1], box[0]))
+    return [(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in clusters]
+
+def needs_new_box(held, bbox, margin):
+    held_x, held_y, held_width, held_height = held
+    x, y, width, height = bbox
+    outside = (x < held_x - margin or y < held_y - margin or
+               x + width > held_x + held_width + margin or y + height > held_y + held_height + margin)
+    # a mask that shrank to less than half of the box gets a tighter window
+    shrunk = width * 2 < held_width or height * 2 < held_height
+    return outside or shrunk
+
+def smooth_box(held, bbox, smoothing):
+    # blend the previous box into the new one edge by edge, grown to still contain the new box
+    if held is None:
+        return bbox
+    x, y, width, height = bbox
+    held_x, held_y, held_width, held_height = held
+    left = min(int(round(smoothing * held_x + (1 - smoothing) * x)), x)
+    top = min(int(round(smoothing * held_y + (1 - smoothing) * y)), y)
+    right = max(int(round(smoothing * (held_x + held_width) + (1 - smoothing) * (x + width))), x + width)
+    bottom = max(int(round(smoothing * (held_y + held_height) + (1 - smoothing) * (y + height))), y + height)
+    return (left, top, right - left, bottom - top)
+
+def track_boxes(bboxes, margin=32, smoothing=0.5):
+    # one box per frame of a sequence, it only moves when the mask box leaves it by more than margin
+    # pixels or shrinks below half of it, so unchanged boxes keep their (cached) plan.
+    # Empty frames hold the current box, leading empty frames take the first box of the clip.
+    held = None
+    tracked = []
+    for bbox in bboxes:
+        if bbox is not None and (held is None or needs_new_box(held, bbox, margin)):
+            held = smooth_box(held, bbox, smoothing)
+        tracked.append(held)
+    first = next((box for box in tracked if box is not None), None)
+    return [first if box is None else box for box in tracked]
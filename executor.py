@@ -0,0 +1,70 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+torch = lazy_import("torch")
+
+# Per item execution for the preprocessing nodes, on a bounded thread pool under one CPU thread budget.
+# cv2 and torch both start a thread per core by default, several ComfyUI workers on one host then run
+# many times more threads than cores. The budget is split between the item threads and the library
+# threads, item threads x library threads stays within it.
+#
+# The budget is the node's threads input, ICLORA_THREADS when that is 0, all cores when both are unset.
+# Without a set budget the library counts are only ever lowered, a process that set them itself (the
+# dataset workers, a host running several ComfyUI instances) keeps its own counts.
+# Results always come back in item order, whatever order the threads finish in.
+
+MAX_WORKERS = 64
+
+def get_requested_budget(threads=0):
+    # the node's threads input, ICLORA_THREADS when that is 0, 0 when both are unset
+    if threads > 0:
+        return threads
+    return max(int(os.environ.get("ICLORA_THREADS", 0)), 0)
+
+def get_budget(threads=0):
+    return get_requested_budget(threads) or os.cpu_count() or 1
+
+def split_budget(budget, count):
+    # item threads first, cv2 and torch kernels of an item are short and scale worse than whole items
+    workers = max(min(budget, count, MAX_WORKERS), 1)
+    return workers, max(budget // workers, 1)
+
+# cv2 and torch thread counts are process wide, nested or concurrent budgets keep the first one and
+# the counts from before it come back when the last caller leaves
+budget_lock = threading.Lock()
+budget_depth = 0
+previous_threads = None
+
+@contextmanager
+def library_threads(threads, lower_only=False):
+    # lower_only keeps counts that are already below threads
+    global budget_depth, previous_threads
+    with budget_lock:
+        if budget_depth == 0:
+            previous_threads = (cv2.getNumThreads(), torch.get_num_threads())
+            cv2.setNumThreads(min(threads, previous_threads[0]) if lower_only else threads)
+            torch.set_num_threads(min(threads, previous_threads[1]) if lower_only else threads)
+        budget_depth += 1
+    try:
+        yield
+    finally:
+        with budget_lock:
+            budget_depth -= 1
+            if budget_depth == 0:
+                cv2.setNumThreads(previous_threads[0])
+                torch.set_num_threads(previous_threads[1])
+
+def map_items(function, count, threads=0):
+    # [function(0), ..., function(count - 1)] within the thread budget, the first error is raised
+    requested = get_requested_budget(threads)
+    workers, per_worker = split_budget(get_budget(threads), count)
+    with library_threads(per_worker, lower_only=requested == 0):
+        if workers == 1:
+            return [function(i) for i in range(count)]
+        with ThreadPoolExecutor(workers, thread_name_prefix="iclora") as pool:
+            return list(pool.map(function, range(count)))
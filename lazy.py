@@ -0,0 +1,50 @@
+import importlib.util
+import sys
+import threading
+import types
+
+# Deferred imports for the heavy libraries, ComfyUI imports every custom node package on startup and
+# only a few of them ever run. lazy_import returns the module object right away and runs the module
+# the first time one of its attributes is read, modules already imported are returned as they are.
+#
+# Module level code must not touch a lazy module, that would import it on startup again. Defaults use
+# the plain values instead (see INTER_CUBIC in context_plan).
+#
+# LazyLoader is not thread safe before Python 3.12, it turns the module into a plain one before running it
+# and a thread reading the module meanwhile finds it empty. The executor threads often touch a module first,
+# so LazyModule runs the module under a lock and only becomes a plain module once it has been loaded.
+
+load_lock = threading.RLock()
+loading = set()
+
+class LazyModule(types.ModuleType):
+    def __getattribute__(self, attr):
+        if type(self) is LazyModule:
+            with load_lock:
+                # the loading thread reads the module itself while it runs, those reads skip the load
+                if type(self) is LazyModule and id(self) not in loading:
+                    loading.add(id(self))
+                    try:
+                        spec = types.ModuleType.__getattribute__(self, "__spec__")
+                        spec.loader.exec_module(self)
+                        self.__class__ = types.ModuleType
+                    finally:
+                        loading.discard(id(self))
+        return types.ModuleType.__getattribute__(self, attr)
+
+    def __delattr__(self, attr):
+        self.__getattribute__(attr)
+        types.ModuleType.__delattr__(self, attr)
+
+
+def lazy_import(name):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    module.__class__ = LazyModule
+    return module
@@ -0,0 +1,76 @@
+from .lazy import lazy_import
+
+torch = lazy_import("torch")
+
+# Mask bounding boxes from row/column reductions instead of a full resolution findContours scan.
+# Works on [B,H,W] or [H,W] numpy arrays and torch tensors, torch tensors stay on their device
+# and only the per row occupancy and the final coordinates are read back.
+# Masks are expected to be non-negative, any non-zero pixel counts as masked.
+
+def first_and_last(occupied):
+    # index of the first and last True along the last axis of a bool array / tensor
+    length = occupied.shape[-1]
+    if torch.is_tensor(occupied):
+        occupied = occupied.to(torch.uint8)
+        return occupied.argmax(dim=-1), length - 1 - occupied.flip(-1).argmax(dim=-1)
+    return occupied.argmax(axis=-1), length - 1 - occupied[..., ::-1].argmax(axis=-1)
+
+def get_mask_bboxes(masks):
+    # returns one (x, y, width, height) per mask, None for empty masks
+    if masks.ndim == 2:
+        masks = masks[None,]
+    if torch.is_tensor(masks):
+        rows = masks.any(dim=2)
+        occupied = rows.any(dim=1).tolist()
+    else:
+        rows = masks.any(axis=2)
+        occupied = rows.any(axis=1).tolist()
+    tops, bottoms = first_and_last(rows)
+    tops, bottoms = tops.tolist(), bottoms.tolist()
+
+    bboxes = []
+    for i, is_occupied in enumerate(occupied):
+        if not is_occupied:
+            bboxes.append(None)
+            continue
+        top, bottom = tops[i], bottoms[i]
+        # columns only need the band of occupied rows
+        band = masks[i, top:bottom + 1]
+        cols = band.any(dim=0) if torch.is_tensor(band) else band.any(axis=0)
+        left, right = first_and_last(cols)
+        left, right = int(left), int(right)
+        bboxes.append((left, top, right - left + 1, bottom - top + 1))
+    return bboxes
+
+def get_mask_bboxes_coarse(masks, factor=16):
+    # bboxes of a [B,H,W] batch from every factor-th row and column, the sampled boxes of all masks come
+    # from one scan, the edges are then refined at full resolution in a factor wide band around each one,
+    # so only a fraction of the masks is read.
+    # Mask parts thinner than factor that fall between the sampled rows and columns can be missed,
+    # a sample without any masked pixel falls back to the full scan.
+    if factor <= 1:
+        return get_mask_bboxes(masks)
+    coarse_bboxes = get_mask_bboxes(masks[:, ::factor, ::factor])
+    return [refine_coarse_bbox(mask, coarse, factor) for mask, coarse in zip(masks, coarse_bboxes)]
+
+def refine_coarse_bbox(mask, coarse, factor):
+    if coarse is None:
+        return get_mask_bboxes(mask)[0]
+    height, width = mask.shape
+    x, y, coarse_width, coarse_height = coarse
+    # sampled edges in full resolution, the true edges are at most factor - 1 pixels further out
+    left, top = x * factor, y * factor
+    right, bottom = (x + coarse_width - 1) * factor, (y + coarse_height - 1) * factor
+    band_left, band_top = max(left - factor + 1, 0), max(top - factor + 1, 0)
+    band_right, band_bottom = min(right + factor, width), min(bottom + factor, height)
+
+    # every band contains a sampled masked pixel, so none of the lookups below is empty
+    _, band_y, _, _ = get_mask_bboxes(mask[band_top:top + 1, band_left:band_right])[0]
+    top = band_top + band_y
+    _, band_y, _, band_height = get_mask_bboxes(mask[bottom:band_bottom, band_left:band_right])[0]
+    bottom = bottom + band_y + band_height - 1
+    band_x, _, _, _ = get_mask_bboxes(mask[top:bottom + 1, band_left:left + 1])[0]
+    left = band_left + band_x
+    band_x, _, band_width, _ = get_mask_bboxes(mask[top:bottom + 1, right:band_right])[0]
+    right = right + band_x + band_width - 1
+    return (left, top, right - left + 1, bottom - top + 1)
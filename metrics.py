@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+from .lazy import lazy_import
+
+torch = lazy_import("torch")
+
+# Opt-in per stage timing for the nodes. Every stage records its duration and the bytes it was handed.
+# Disabled by default, stage() then hands out a shared no-op context and timed() returns the function
+# untouched, so the only cost is one global lookup per call.
+#
+# Enable it with the ICLORA_METRICS environment variable:
+#   ICLORA_METRICS=log                 records go to the "InContextUtils.metrics" logger
+#   ICLORA_METRICS=memory              records are kept in memory_sink.records
+#   ICLORA_METRICS=jsonl:<path>        one JSON object per line, appended to path
+# or from code with configure(sink), where a sink is any callable taking the record dict.
+
+NULL_STAGE = nullcontext()
+
+class LoggerSink:
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("InContextUtils.metrics")
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(self.level, json.dumps(record))
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(line)
+
+class MemorySink:
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+memory_sink = MemorySink()
+sink = None
+
+def create_sink(setting):
+    if not setting or setting in ("0", "off"):
+        return None
+    if setting == "log":
+        return LoggerSink()
+    if setting == "memory":
+        return memory_sink
+    if setting.startswith("jsonl:"):
+        return JsonLinesSink(setting[len("jsonl:"):])
+    raise ValueError(f"Unknown ICLORA_METRICS setting: {setting}, expected log, memory or jsonl:<path>")
+
+def configure(new_sink):
+    # None disables the instrumentation, returns the previous sink so tests can restore it
+    global sink
+    previous, sink = sink, new_sink
+    return previous
+
+def enabled():
+    return sink is not None
+
+def get_nbytes(data):
+    if data is None:
+        return 0
+    if torch.is_tensor(data):
+        return data.element_size() * data.nelement()
+    if isinstance(data, (list, tuple)):
+        return sum(get_nbytes(item) for item in data)
+    return getattr(data, "nbytes", 0)
+
+class Stage:
+    def __init__(self, sink, name, data, fields):
+        self.sink = sink
+        self.name = name
+        self.data = data
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self.start
+        self.sink(dict(stage=self.name, seconds=seconds, bytes=get_nbytes(self.data), **self.fields))
+
+def stage(name, data=None, **fields):
+    # with stage("resize", image): ... records the time spent inside the block
+    current = sink
+    if current is None:
+        return NULL_STAGE
+    return Stage(current, name, data, fields)
+
+def timed(name, function):
+    # wraps a backend op so every call is recorded as a stage, the first argument is the data
+    if sink is None:
+        return function
+    def wrapper(data, *args, **kwargs):
+        with stage(name, data):
+            return function(data, *args, **kwargs)
+    return wrapper
+
+configure(create_sink(os.environ.get("ICLORA_METRICS")))
@@ -1,14 +1,20 @@
-from .InContextLoraUtils import AddMaskForICLora
-from .InContextUtils import CreateContextWindow, ConcatContextWindow
+from .InContextLoraUtils import AddMaskForICLora, ConcatReferenceGrid
+from .InContextUtils import CreateContextWindow, ConcatContextWindow, LoadContextWindow, StitchContextWindow
 
 NODE_CLASS_MAPPINGS = {
     "AddMaskForICLora": AddMaskForICLora,
     "CreateContextWindow": CreateContextWindow,
-    "ConcatContextWindow": ConcatContextWindow
+    "ConcatContextWindow": ConcatContextWindow,
+    "StitchContextWindow": StitchContextWindow,
+    "LoadContextWindow": LoadContextWindow,
+    "ConcatReferenceGrid": ConcatReferenceGrid,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
     "AddMaskForICLora": "Add Mask For IC Lora",
     "CreateContextWindow": "Create Context Window",
     "ConcatContextWindow": "Concatenate Context Window",
+    "StitchContextWindow": "Stitch Context Window",
+    "LoadContextWindow": "Load Context Window",
+    "ConcatReferenceGrid": "Concatenate Reference Grid",
 }
@@ -0,0 +1,148 @@
+import hashlib
+import inspect
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from functools import wraps
+
+from .lazy import lazy_import
+
+torch = lazy_import("torch")
+
+try:
+    xxhash = lazy_import("xxhash")
+except ImportError:
+    xxhash = None
+
+from . import metrics
+
+# In-process cache of node results, keyed by a digest of the input pixels and every widget value.
+# ComfyUI runs a node again whenever an upstream node ran again, even when the pixels did not change,
+# the same reference image queued with hundreds of prompts then only goes through the node once.
+# Hits return the stored output tuple itself without copying, outputs have to be treated as read only
+# (StitchContextWindow with in_place writes into its original_image).
+#
+# The key reads every input pixel once. That costs about as much as a small node run, so the cache is
+# off by default. ICLORA_CACHE_BYTES turns it on with a budget in bytes (1073741824 for 1 GiB), it pays
+# off for large sources queued again and again. The pixels are hashed with xxh3 when xxhash is installed,
+# several times faster than the sha256 fallback.
+
+DEFAULT_MAX_BYTES = 0
+
+class ResultCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        nbytes = metrics.get_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, nbytes)
+            self.size += nbytes
+            self.evict()
+
+    def evict(self):
+        # least recently used first, the lock is held by the caller
+        while self.size > self.max_bytes:
+            _, (_, nbytes) = self.entries.popitem(last=False)
+            self.size -= nbytes
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+result_cache = ResultCache(int(os.environ.get("ICLORA_CACHE_BYTES", DEFAULT_MAX_BYTES)))
+
+# digests of tensors seen before, ComfyUI hands the same tensor object to every node reading an output
+# keyed by id, the weak reference drops the entry with the tensor and the version counter changes on
+# in-place writes, which invalidates the stored digest
+tensor_digests = {}
+tensor_digests_lock = threading.Lock()
+
+def forget_tensor(key):
+    with tensor_digests_lock:
+        tensor_digests.pop(key, None)
+
+def hash_bytes(data):
+    if xxhash is not None:
+        return xxhash.xxh3_128_digest(data)
+    return hashlib.sha256(data).digest()
+
+def get_tensor_digest(tensor):
+    key = id(tensor)
+    with tensor_digests_lock:
+        known = tensor_digests.get(key)
+    if known is not None and known[0]() is tensor and known[1] == tensor._version:
+        return known[2]
+    data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+    digest = (tuple(tensor.shape), str(tensor.dtype), str(tensor.device), hash_bytes(data))
+    reference = weakref.ref(tensor, lambda _, key=key: forget_tensor(key))
+    with tensor_digests_lock:
+        tensor_digests[key] = (reference, tensor._version, digest)
+    return digest
+
+def get_digest(value):
+    if torch.is_tensor(value):
+        return get_tensor_digest(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(get_digest(item) for item in value)
+    # widget values and plans are hashable as they are
+    return value
+
+def cached_node(function):
+    # caches a node function by the digest of all of its bound arguments, defaults included
+    signature = inspect.signature(function)
+    name = function.__qualname__
+
+    @wraps(function)
+    def wrapper(self, *args, **kwargs):
+        if result_cache.max_bytes <= 0:
+            return function(self, *args, **kwargs)
+        arguments = signature.bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        with metrics.stage("cache_key", (args, tuple(kwargs.values()))):
+            key = (name, ) + tuple((parameter, get_digest(value)) for parameter, value in arguments.arguments.items() if parameter != "self")
+        result = result_cache.get(key)
+        if result is None:
+            result = function(self, *args, **kwargs)
+            result_cache.put(key, result)
+        return result
+    return wrapper
@@ -0,0 +1,313 @@
+"""Headless benchmark for AddMaskForICLora, CreateContextWindow and ConcatContextWindow.
+
+Runs on synthetic images and masks, ComfyUI is not needed.
+
+  python scripts/benchmark.py --preset quick --output before.json
+  python scripts/benchmark.py --preset quick --output after.json
+  python scripts/benchmark.py --compare before.json after.json
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import itertools
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+
+from package_loader import load_module
+
+RESOLUTIONS = {
+    "small": (512, 512),
+    "1mp_portrait": (768, 1024),
+    "1mp_landscape": (1024, 768),
+    "12mp_portrait": (3000, 4000),
+    "12mp_landscape": (4000, 3000),
+    "24mp_landscape": (6000, 4000),
+    "50mp_portrait": (5773, 8660),
+    "50mp_landscape": (8660, 5773),
+}
+
+PRESETS = {
+    "quick": {
+        "resolutions": ["small", "1mp_portrait"],
+        "batch_sizes": [1],
+        "output_lengths": [1536],
+        "repeat": 3,
+    },
+    "default": {
+        "resolutions": ["small", "1mp_portrait", "1mp_landscape", "12mp_portrait", "12mp_landscape"],
+        "batch_sizes": [1, 4],
+        "output_lengths": [1024, 1536, 2048],
+        "repeat": 5,
+    },
+    "full": {
+        "resolutions": list(RESOLUTIONS),
+        "batch_sizes": [1, 4],
+        "output_lengths": [1024, 1536, 2048, 3072],
+        "repeat": 5,
+    },
+}
+
+MASKS = ["tiny", "huge", "empty"]
+PATCH_MODES = ["auto", "patch_right", "patch_bottom"]
+PATCH_TYPES = ["3:4", "1:1", "9:16", "auto"]
+ADD_MASK_PATCH_TYPES = ["3:4", "auto"]
+NODES = ["add_mask", "create_context_window", "concat_context_window"]
+INTERPOLATIONS = ["quality", "fast", "auto"]
+
+def make_image(width, height, batch_size, seed=0):
+    # smooth gradients plus noise, closer to photos than pure noise for the resize kernels
+    generator = torch.Generator().manual_seed(seed)
+    coarse = torch.rand((batch_size, 3, 16, 16), generator=generator)
+    image = torch.nn.functional.interpolate(coarse, size=(height, width), mode="bilinear", align_corners=False)
+    image = image.permute(0, 2, 3, 1).contiguous()
+    image.add_(torch.rand(image.shape, generator=generator).mul_(0.05)).clamp_(0, 1)
+    return image
+
+def make_mask(width, height, batch_size, kind):
+    mask = torch.zeros((batch_size, height, width), dtype=torch.float32)
+    if kind == "tiny":
+        # about 1% of the frame, off center
+        mask_width, mask_height = max(width // 10, 1), max(height // 10, 1)
+        mask[:, height // 3:height // 3 + mask_height, width // 2:width // 2 + mask_width] = 1
+    elif kind == "huge":
+        # about 60% of the frame
+        mask[:, height // 10:height * 9 // 10, width // 8:width * 7 // 8] = 1
+    return mask
+
+def read_rss():
+    # resident set size in bytes, Linux only
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+def release_free_memory():
+    # hands the free heap pages back to the system, glibc only, so a following run faults in what it uses
+    try:
+        ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim(0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+class PeakRssSampler:
+    # polls the resident set size in the background to get the peak of a single case
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak = None
+        self.running = False
+        self.thread = None
+
+    def sample(self):
+        rss = read_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def run(self):
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = None
+        self.running = True
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.sample()
+
+def percentile(values, q):
+    return float(np.percentile(np.array(values), q))
+
+def build_cases(nodes, resolutions, batch_sizes, output_lengths, masks, patch_modes, patch_types, interpolations):
+    for node, resolution, batch_size, output_length, mask, patch_mode, interpolation in itertools.product(
+            nodes, resolutions, batch_sizes, output_lengths, masks, patch_modes, interpolations):
+        # AddMaskForICLora only offers 3:4 and auto panels
+        for patch_type in ([patch_type for patch_type in patch_types if patch_type in ADD_MASK_PATCH_TYPES] if node == "add_mask" else patch_types):
+            yield {
+                "node": node,
+                "resolution": resolution,
+                "width": RESOLUTIONS[resolution][0],
+                "height": RESOLUTIONS[resolution][1],
+                "batch_size": batch_size,
+                "output_length": output_length,
+                "mask": mask,
+                "patch_mode": patch_mode,
+                "patch_type": patch_type,
+                "interpolation": interpolation,
+            }
+
+def make_call(case, nodes):
+    image = make_image(case["width"], case["height"], case["batch_size"])
+    mask = make_mask(case["width"], case["height"], case["batch_size"], case["mask"])
+    args = (case["patch_mode"], case["patch_type"], case["output_length"])
+    interpolation = case["interpolation"]
+    if case["node"] == "add_mask":
+        node = nodes.AddMaskForICLora()
+        return lambda: node.add_mask(image, case["patch_mode"], case["output_length"], "#FF0000", first_mask=mask, patch_type=case["patch_type"], interpolation=interpolation)
+    create = nodes.CreateContextWindow()
+    if case["node"] == "create_context_window":
+        return lambda: create.create_context_window(image, mask, *args, interpolation=interpolation)
+    # concatenate the source with its prepared window, like the example workflows do
+    prepared = create.create_context_window(image, mask, *args, interpolation=interpolation)
+    concat = nodes.ConcatContextWindow()
+    return lambda: concat.concat_context_window(image, prepared[2], case["patch_type"], case["output_length"], "#FF0000",
+                                                second_image=prepared[0], second_mask=prepared[1], interpolation=interpolation)
+
+def collect_stages(call):
+    # one extra run with the metrics layer on, summed per stage
+    metrics = load_module("metrics")
+    sink = metrics.MemorySink()
+    previous = metrics.configure(sink)
+    try:
+        call()
+    finally:
+        metrics.configure(previous)
+    stages = {}
+    for record in sink.records:
+        total = stages.setdefault(record["stage"], {"calls": 0, "seconds": 0.0, "bytes": 0})
+        total["calls"] += 1
+        total["seconds"] += record["seconds"]
+        total["bytes"] += record["bytes"]
+    return stages
+
+def run_case(case, nodes, repeat, warmup, stages=False):
+    call = make_call(case, nodes)
+    for _ in range(warmup):
+        call()
+    timings = []
+    with PeakRssSampler() as sampler:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+    # the resident set growth of a single run, it sees the torch and cv2 buffers that tracemalloc misses
+    # free heap pages are released first, otherwise the run reuses the memory of the earlier runs
+    release_free_memory()
+    baseline = read_rss()
+    with PeakRssSampler() as call_sampler:
+        call()
+    rss_growth = None if baseline is None or call_sampler.peak is None else max(call_sampler.peak - baseline, 0)
+    extra = {"stages": collect_stages(call)} if stages else {}
+    return dict(case, **extra,
+                repeat=repeat,
+                time_min=min(timings),
+                time_mean=float(np.mean(timings)),
+                time_p50=percentile(timings, 50),
+                time_p90=percentile(timings, 90),
+                time_p99=percentile(timings, 99),
+                peak_rss_bytes=sampler.peak,
+                peak_rss_growth_bytes=rss_growth)
+
+def get_meta():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "opencv": load_module("InContextUtils").cv2.__version__,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+def case_key(result):
+    # reports from before the interpolation policies ran everything as quality
+    return tuple(result[key] for key in ("node", "resolution", "batch_size", "output_length", "mask", "patch_mode", "patch_type")) + \
+        (result.get("interpolation", "quality"), )
+
+def compare(before_path, after_path):
+    with open(before_path) as file:
+        before = {case_key(result): result for result in json.load(file)["results"]}
+    with open(after_path) as file:
+        after = {case_key(result): result for result in json.load(file)["results"]}
+    rows = []
+    for key in sorted(before.keys() & after.keys()):
+        speedup = before[key]["time_p50"] / after[key]["time_p50"]
+        rows.append((speedup, key, before[key]["time_p50"], after[key]["time_p50"]))
+        print(f"{speedup:6.2f}x  {before[key]['time_p50'] * 1000:9.2f} ms -> {after[key]['time_p50'] * 1000:9.2f} ms  {' '.join(str(part) for part in key)}")
+    if rows:
+        geomean = float(np.exp(np.mean(np.log([row[0] for row in rows]))))
+        print(f"geometric mean speedup over {len(rows)} cases: {geomean:.2f}x")
+
+def summarize_interpolations(results):
+    # median latency of every interpolation policy against quality on the same cases
+    by_case = {}
+    for result in results:
+        by_case.setdefault(case_key(result)[:-1], {})[result.get("interpolation", "quality")] = result["time_p50"]
+    for interpolation in INTERPOLATIONS:
+        ratios = [timings["quality"] / timings[interpolation] for timings in by_case.values()
+                  if "quality" in timings and interpolation in timings]
+        if ratios:
+            geomean = float(np.exp(np.mean(np.log(ratios))))
+            print(f"interpolation {interpolation}: {geomean:.2f}x the speed of quality over {len(ratios)} cases", file=sys.stderr)
+
+def parse_list(value, cast=str):
+    return [cast(item) for item in value.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=list(PRESETS), default="quick")
+    parser.add_argument("--nodes", type=parse_list, default=NODES)
+    parser.add_argument("--resolutions", type=parse_list, help=f"comma separated, from {', '.join(RESOLUTIONS)}")
+    parser.add_argument("--batch-sizes", type=lambda value: parse_list(value, int))
+    parser.add_argument("--output-lengths", type=lambda value: parse_list(value, int))
+    parser.add_argument("--masks", type=parse_list, default=MASKS)
+    parser.add_argument("--patch-modes", type=parse_list, default=PATCH_MODES)
+    parser.add_argument("--patch-types", type=parse_list, default=PATCH_TYPES)
+    parser.add_argument("--interpolations", type=parse_list, default=INTERPOLATIONS)
+    parser.add_argument("--repeat", type=int)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--stages", action="store_true", help="add per stage timings from the metrics layer")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two JSON reports")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    preset = PRESETS[args.preset]
+    # repeated runs on the same inputs would only measure cache hits
+    load_module("result_cache").result_cache.resize(0)
+    nodes = load_module("nodes")
+    nodes = type("Nodes", (), nodes.NODE_CLASS_MAPPINGS)
+    cases = list(build_cases(args.nodes,
+                             args.resolutions or preset["resolutions"],
+                             args.batch_sizes or preset["batch_sizes"],
+                             args.output_lengths or preset["output_lengths"],
+                             args.masks, args.patch_modes, args.patch_types, args.interpolations))
+    repeat = args.repeat or preset["repeat"]
+
+    results = []
+    for index, case in enumerate(cases):
+        result = run_case(case, nodes, repeat, args.warmup, args.stages)
+        results.append(result)
+        print(f"[{index + 1}/{len(cases)}] {' '.join(str(part) for part in case_key(result))}: "
+              f"p50 {result['time_p50'] * 1000:.2f} ms", file=sys.stderr)
+    summarize_interpolations(results)
+
+    report = {
+        "meta": dict(get_meta(), max_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+# Startup benchmark, imports the package in fresh interpreters the way ComfyUI does on startup and
+# reports the import time, the number of modules it pulled in and which heavy libraries were loaded.
+#
+#   python scripts/import_benchmark.py
+#   python scripts/import_benchmark.py --max-seconds 0.5 --max-modules 150     exits with 1 above either
+#
+# Heavy libraries stay lazy until a node runs, a module that loads one at import time shows up in
+# heavy_loaded.
+
+HEAVY_MODULES = ["torch", "numpy", "cv2", "PIL.Image", "tifffile", "skimage", "safetensors"]
+
+PROBE = """
+import json, sys, time
+sys.path.insert(0, {scripts_dir!r})
+before = set(sys.modules)
+start = time.perf_counter()
+from package_loader import load_package
+package = load_package()
+seconds = time.perf_counter() - start
+# lazy modules are registered in sys.modules before they run, their class tells them apart
+heavy = [name for name in {heavy!r} if name in sys.modules and type(sys.modules[name]).__name__ != "LazyModule"]
+print(json.dumps({{"seconds": seconds, "modules": len(set(sys.modules) - before), "heavy_loaded": heavy,
+                  "nodes": len(package.NODE_CLASS_MAPPINGS)}}))
+"""
+
+def run_probe():
+    code = PROBE.format(scripts_dir=os.path.dirname(os.path.abspath(__file__)), heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of the node package")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters to run")
+    parser.add_argument("--max-seconds", type=float, help="fail when the median import time is above this")
+    parser.add_argument("--max-modules", type=int, help="fail when more modules than this are imported")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    runs = [run_probe() for _ in range(args.repeat)]
+    seconds = [run["seconds"] for run in runs]
+    report = {
+        "python": sys.version.split()[0],
+        "repeat": args.repeat,
+        "seconds_min": min(seconds),
+        "seconds_median": float(np.median(seconds)),
+        "modules": runs[-1]["modules"],
+        "heavy_loaded": runs[-1]["heavy_loaded"],
+        "nodes": runs[-1]["nodes"],
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    failures = []
+    if args.max_seconds is not None and report["seconds_median"] > args.max_seconds:
+        failures.append(f"median import time {report['seconds_median']:.3f} s above {args.max_seconds} s")
+    if args.max_modules is not None and report["modules"] > args.max_modules:
+        failures.append(f"{report['modules']} modules imported, more than {args.max_modules}")
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import importlib
+import importlib.util
+import os
+import sys
+
+# Import the custom node package without ComfyUI, the folder name is not a valid module name
+# so it is registered under an alias instead.
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE_NAME = "iclora_utils"
+
+def load_package(name=PACKAGE_NAME, path=PACKAGE_DIR):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(path, "__init__.py"), submodule_search_locations=[path])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[name] = package
+    spec.loader.exec_module(package)
+    return package
+
+def load_module(module, name=PACKAGE_NAME, path=PACKAGE_DIR):
+    load_package(name, path)
+    return importlib.import_module(f"{name}.{module}")
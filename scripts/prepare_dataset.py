@@ -0,0 +1,230 @@
+import argparse
+import concurrent.futures
+import dataclasses
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from package_loader import load_module
+
+# Offline preparation of IC-LoRA training pairs, runs CreateContextWindow (through LoadContextWindow, which
+# only decodes the window) and ConcatContextWindow on image/mask pairs without ComfyUI.
+#
+#   python scripts/prepare_dataset.py --images data/images --masks data/masks --output out
+#   python scripts/prepare_dataset.py --manifest pairs.jsonl --output out --workers 8
+#   python scripts/prepare_dataset.py --manifest pairs.jsonl --output out --num-shards 4 --shard-index 0
+#
+# A manifest has one JSON object per line with "image" and "mask" paths, an optional "reference" image for
+# the first panel (the whole source image is used without it) and an optional "id".
+# Every finished pair appends a line to the output manifest, a run started again with the same output skips
+# the ids already recorded there. Shards split the sorted items by index and write their own manifest.
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff", ".npy")
+
+def find_pairs(images_dir, masks_dir, references_dir=None):
+    # pairs files by their path relative to the directories, without the extension
+    def index(directory):
+        files = {}
+        for root, _, names in os.walk(directory):
+            for name in names:
+                stem, extension = os.path.splitext(name)
+                if extension.lower() in IMAGE_EXTENSIONS:
+                    files[os.path.relpath(os.path.join(root, stem), directory)] = os.path.join(root, name)
+        return files
+    images = index(images_dir)
+    masks = index(masks_dir)
+    references = index(references_dir) if references_dir else {}
+    pairs = []
+    for key in sorted(images):
+        if key not in masks:
+            print(f"skipping {images[key]}: no mask", file=sys.stderr)
+            continue
+        pairs.append({"id": key, "image": images[key], "mask": masks[key], "reference": references.get(key)})
+    return pairs
+
+def read_manifest(path):
+    base = os.path.dirname(os.path.abspath(path))
+    pairs = []
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            pair = json.loads(line)
+            for key in ("image", "mask", "reference"):
+                if pair.get(key):
+                    pair[key] = os.path.join(base, os.path.expanduser(pair[key]))
+            pair.setdefault("id", os.path.splitext(os.path.relpath(pair["image"], base))[0])
+            pairs.append(pair)
+    return sorted(pairs, key=lambda pair: pair["id"])
+
+def read_done(path):
+    # ids already written by an earlier run, a line cut off by a killed run is ignored and done again
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as file:
+        for line in file:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                continue
+    return done
+
+def save_image(array, path):
+    # written next to the target and renamed, so a killed run never leaves a half written file behind
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = path + ".tmp"
+    Image.fromarray(np.clip(array * 255 + 0.5, 0, 255).astype(np.uint8)).save(temporary, format="PNG")
+    os.replace(temporary, path)
+
+worker = {}
+
+def init_worker(threads):
+    # the pool runs the parallelism, every worker keeps the libraries at a few threads
+    utils = load_module("InContextUtils")
+    utils.cv2.setNumThreads(threads)
+    torch.set_num_threads(threads)
+    # every pair is seen once, caching them would only hold memory
+    load_module("result_cache").result_cache.resize(0)
+    worker["utils"] = utils
+    worker["load"] = utils.LoadContextWindow()
+    worker["concat"] = utils.ConcatContextWindow()
+
+def load_image(path):
+    utils = worker["utils"]
+    reader = utils.open_reader(path)
+    try:
+        return torch.from_numpy(utils.as_float_array(reader.read(0, 0, reader.width, reader.height)))[None,]
+    finally:
+        reader.close()
+
+def prepare_pair(pair, options):
+    if not worker:
+        init_worker(options["threads"])
+    prepared = worker["load"].load_context_window(pair["image"], options["patch_mode"], options["patch_type"],
+                                                  mask_path=pair["mask"], output_length=options["output_length"],
+                                                  pixel_buffer=options["pixel_buffer"], backend=options["backend"],
+                                                  threads=options["threads"])
+    prepared_image, prepared_mask, patch_mode, x_offset, y_offset, scale = prepared[:6]
+    plan = prepared[8]
+    first_image = load_image(pair.get("reference") or pair["image"])
+    concat = worker["concat"].concat_context_window(first_image, patch_mode, options["patch_type"], options["output_length"],
+                                                    options["patch_color"], second_image=prepared_image, second_mask=prepared_mask,
+                                                    threads=options["threads"])
+    image, mask = concat[0], concat[1]
+
+    output = os.path.join(options["output"], pair["id"] + ".png")
+    output_mask = os.path.join(options["output"], pair["id"] + "_mask.png")
+    save_image(image[0].numpy(), output)
+    save_image(mask[0].numpy(), output_mask)
+    return {
+        "id": pair["id"],
+        "image": pair["image"],
+        "mask": pair["mask"],
+        "reference": pair.get("reference"),
+        "output": os.path.relpath(output, options["output"]),
+        "output_mask": os.path.relpath(output_mask, options["output"]),
+        "patch_mode": patch_mode,
+        "x_offset_of_ori": x_offset,
+        "y_offset_of_ori": y_offset,
+        "scale": scale,
+        "target_width": concat[2],
+        "target_height": concat[3],
+        "x_offset": concat[4],
+        "y_offset": concat[5],
+        "total_width": concat[6],
+        "total_height": concat[7],
+        "plan": dataclasses.asdict(plan),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare IC-LoRA training pairs with CreateContextWindow and ConcatContextWindow")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--manifest", help="JSON lines with image, mask and optional reference and id")
+    source.add_argument("--images", help="directory of images, paired with --masks by relative path")
+    parser.add_argument("--masks", help="directory of masks")
+    parser.add_argument("--references", help="directory of first panel images, the source image is used when missing")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--patch-mode", choices=["auto", "patch_right", "patch_bottom"], default="auto")
+    parser.add_argument("--patch-type", choices=["3:4", "1:1", "9:16", "auto"], default="3:4")
+    parser.add_argument("--output-length", type=int, default=1536)
+    parser.add_argument("--pixel-buffer", type=int, default=64)
+    parser.add_argument("--patch-color", choices=["#FF0000", "#00FF00", "#0000FF", "#FFFFFF"], default="#FF0000")
+    parser.add_argument("--backend", choices=["cv2", "torch"], default="cv2")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threads", type=int, default=1, help="cv2 and torch threads per worker")
+    parser.add_argument("--num-shards", type=int, default=1)
+    parser.add_argument("--shard-index", type=int, default=0)
+    parser.add_argument("--log-every", type=float, default=10.0, help="seconds between progress lines")
+    args = parser.parse_args()
+
+    if args.images and not args.masks:
+        parser.error("--images needs --masks")
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error("--shard-index has to be in [0, --num-shards)")
+
+    pairs = read_manifest(args.manifest) if args.manifest else find_pairs(args.images, args.masks, args.references)
+    pairs = pairs[args.shard_index::args.num_shards]
+    os.makedirs(args.output, exist_ok=True)
+    if args.num_shards > 1:
+        manifest_path = os.path.join(args.output, f"manifest-{args.shard_index:05d}-of-{args.num_shards:05d}.jsonl")
+    else:
+        manifest_path = os.path.join(args.output, "manifest.jsonl")
+    done = read_done(manifest_path)
+    pending = [pair for pair in pairs if pair["id"] not in done]
+    print(f"{len(pairs)} pairs in shard, {len(pairs) - len(pending)} already done, {len(pending)} to go", file=sys.stderr)
+
+    options = {
+        "output": args.output,
+        "patch_mode": args.patch_mode,
+        "patch_type": args.patch_type,
+        "output_length": args.output_length,
+        "pixel_buffer": args.pixel_buffer,
+        "patch_color": args.patch_color,
+        "backend": args.backend,
+        "threads": args.threads,
+    }
+    finished = failed = 0
+    start = last_log = time.perf_counter()
+    with open(manifest_path, "a") as manifest, concurrent.futures.ProcessPoolExecutor(
+            args.workers, initializer=init_worker, initargs=(args.threads, )) as executor:
+        # a bounded number of pairs in flight keeps memory flat on large corpora
+        queue = iter(pending)
+        running = {}
+        def submit():
+            for pair in queue:
+                running[executor.submit(prepare_pair, pair, options)] = pair
+                if len(running) >= args.workers * 2:
+                    break
+        submit()
+        while running:
+            completed, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in completed:
+                pair = running.pop(future)
+                try:
+                    record = future.result()
+                except Exception as error:
+                    failed += 1
+                    print(f"failed {pair['id']}: {error!r}", file=sys.stderr)
+                    continue
+                manifest.write(json.dumps(record) + "\n")
+                manifest.flush()
+                finished += 1
+            submit()
+            now = time.perf_counter()
+            if now - last_log >= args.log_every:
+                last_log = now
+                print(f"{finished + failed}/{len(pending)} pairs, {finished / (now - start):.2f} items/s", file=sys.stderr)
+
+    seconds = time.perf_counter() - start
+    print(f"done: {finished} pairs in {seconds:.1f} s, {finished / seconds if seconds else 0:.2f} items/s, {failed} failed", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the package folder is not an importable name, the tests load it through scripts/package_loader
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
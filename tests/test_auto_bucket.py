@@ -0,0 +1,41 @@
+import torch
+
+from package_loader import load_module
+
+utils = load_module("InContextUtils")
+load_module("result_cache").result_cache.resize(0)
+
+def make_batch():
+    image = torch.rand(3, 900, 1300, 3)
+    mask = torch.zeros(3, 900, 1300)
+    # a tall box, a wide box and an empty mask pick different buckets on their own
+    mask[0, 100:400, 100:200] = 1
+    mask[1, 500:600, 100:1200] = 1
+    return image, mask
+
+def test_windows_of_a_batch_share_one_bucket():
+    image, mask = make_batch()
+    create = utils.CreateContextWindow()
+    for patch_mode in ("auto", "patch_right", "patch_bottom"):
+        window = create.create_context_window(image, mask, patch_mode, "auto")
+        assert window[0].shape[0] == 3
+        assert len({(plan.target_width, plan.target_height, plan.patch_mode) for plan in window[8]}) == 1
+        assert window[2] == window[8][0].patch_mode
+        canvas = utils.ConcatContextWindow().concat_context_window(image, window[2], "auto", 1536, "#FF0000",
+                                                                   second_image=window[0], second_mask=window[1])
+        assert canvas[0].shape[0] == 3
+
+def test_multi_region_windows_share_one_bucket():
+    image, mask = make_batch()
+    mask = mask[:1].clone()
+    mask[0, 600:700, 800:1250] = 1
+    window = utils.CreateContextWindow().create_context_window(image[:1], mask, "auto", "auto", region_mode="multi")
+    assert window[0].shape[0] == 2
+
+def test_single_window_concatenates_with_its_source():
+    image, mask = make_batch()
+    for i in range(3):
+        window = utils.CreateContextWindow().create_context_window(image[i:i + 1], mask[i:i + 1], "auto", "auto")
+        canvas = utils.ConcatContextWindow().concat_context_window(image[i:i + 1], window[2], "auto", 1536, "#FF0000",
+                                                                   second_image=window[0], second_mask=window[1])
+        assert canvas[2:4] == (window[0].shape[2], window[0].shape[1])
@@ -0,0 +1,36 @@
+import pytest
+import torch
+
+from package_loader import load_module
+
+utils = load_module("InContextUtils")
+lora_utils = load_module("InContextLoraUtils")
+load_module("result_cache").result_cache.resize(0)
+
+BUDGET = 10 ** 6
+
+def make_batch():
+    image = torch.rand(2, 900, 1300, 3)
+    mask = torch.zeros(2, 900, 1300)
+    mask[0, 100:400, 100:300] = 1
+    mask[1, 500:800, 200:1200] = 1
+    return image, mask
+
+@pytest.mark.parametrize("patch_type", ["3:4", "1:1", "9:16", "auto"])
+@pytest.mark.parametrize("patch_mode", ["auto", "patch_right", "patch_bottom"])
+def test_budget_panels_are_mod_64(patch_type, patch_mode):
+    image, mask = make_batch()
+    window = utils.CreateContextWindow().create_context_window(image, mask, patch_mode, patch_type, max_pixels=BUDGET)
+    height, width = window[0].shape[1:3]
+    assert height % 64 == 0 and width % 64 == 0
+    assert window[13] == [2 * width * height] * 2
+    assert 2 * width * height <= BUDGET
+    concat = utils.ConcatContextWindow().concat_context_window(image[:1], window[2], patch_type, 1536, "#FF0000", second_image=window[0][:1], second_mask=window[1][:1], max_pixels=BUDGET)
+    assert concat[10] == concat[0].shape[1] * concat[0].shape[2] == 2 * width * height
+
+@pytest.mark.parametrize("patch_type", ["3:4", "9:16", "auto"])
+def test_add_mask_budget(patch_type):
+    image, mask = make_batch()
+    result = lora_utils.AddMaskForICLora().add_mask(image, "auto", 1536, "#FF0000", first_mask=mask, patch_type=patch_type, max_pixels=BUDGET)
+    assert result[10] == result[0].shape[1] * result[0].shape[2] <= BUDGET
+    assert result[4] % 64 == 0 and result[5] % 64 == 0
@@ -0,0 +1,51 @@
+import numpy as np
+import torch
+
+from package_loader import load_module
+
+buffer_pool = load_module("buffer_pool")
+utils = load_module("InContextUtils")
+
+def test_returned_buffer_is_reused():
+    pool = buffer_pool.BufferPool()
+    with pool.borrow((4, 6, 3)) as first:
+        pass
+    with pool.borrow((4, 6, 3)) as second:
+        assert second is first
+    with pool.borrow((4, 6, 3), np.uint8) as other_dtype:
+        assert other_dtype is not first and other_dtype.dtype == np.uint8
+
+def test_borrowed_buffers_are_not_shared():
+    pool = buffer_pool.BufferPool()
+    with pool.borrow((4, 6)) as outer, pool.borrow((4, 6)) as inner:
+        assert inner is not outer
+    with pool.borrow((4, 6)) as first, pool.borrow((4, 6)) as second:
+        assert {id(first), id(second)} == {id(outer), id(inner)}
+
+def test_oldest_sizes_are_dropped_first():
+    pool = buffer_pool.BufferPool(max_buffers=2)
+    for shape in ((1, 1), (2, 2), (3, 3)):
+        with pool.borrow(shape):
+            pass
+    assert list(pool.buffers) == [((2, 2), "<f4"), ((3, 3), "<f4")]
+
+def test_node_calls_reuse_scratch_without_aliasing():
+    # a uint8 concat of a source larger than its panel resizes through a float scratch buffer
+    load_module("result_cache").result_cache.resize(0)
+    buffer_pool.scratch_pool.clear()
+    node = utils.ConcatContextWindow()
+    mask = torch.zeros(1, 1200, 1600)
+    first_image, second_image = torch.rand(1, 1200, 1600, 3), torch.rand(1, 1200, 1600, 3)
+    first = node.concat_context_window(first_image, mask, "3:4", 1024, "#FF0000", precision="uint8")
+    scratch = [id(buffer) for free in buffer_pool.scratch_pool.buffers.values() for buffer in free]
+    assert scratch
+    expected = first[0].clone()
+    second = node.concat_context_window(second_image, mask, "3:4", 1024, "#FF0000", precision="uint8")
+    # the second call borrowed the same buffers instead of allocating new ones
+    assert [id(buffer) for free in buffer_pool.scratch_pool.buffers.values() for buffer in free] == scratch
+    assert torch.equal(first[0], expected)
+    assert not torch.equal(first[0], second[0])
+    assert first[0].data_ptr() != second[0].data_ptr()
+    for buffers in buffer_pool.scratch_pool.buffers.values():
+        for buffer in buffers:
+            assert not np.shares_memory(buffer, first[0].numpy())
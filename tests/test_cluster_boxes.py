@@ -0,0 +1,47 @@
+import torch
+
+from package_loader import load_module
+
+plans = load_module("context_plan")
+utils = load_module("InContextUtils")
+load_module("result_cache").result_cache.resize(0)
+
+def test_far_regions_stay_separate():
+    boxes = [(500, 400, 50, 50), (10, 10, 40, 30)]
+    # sorted top to bottom
+    assert plans.cluster_boxes(boxes, pixel_buffer=64) == [(10, 10, 40, 30), (500, 400, 50, 50)]
+
+def test_regions_within_the_buffer_merge():
+    # 60 pixels apart, within the 64 pixel buffer, but not within 32
+    boxes = [(0, 0, 40, 40), (100, 10, 40, 40)]
+    assert plans.cluster_boxes(boxes, pixel_buffer=64) == [(0, 0, 140, 50)]
+    assert plans.cluster_boxes(boxes, pixel_buffer=32) == boxes
+    # the distance widens the gap that still merges
+    assert plans.cluster_boxes(boxes, pixel_buffer=32, distance=30) == [(0, 0, 140, 50)]
+
+def test_chains_of_regions_merge():
+    # the outer boxes are too far apart, the one between them joins them
+    boxes = [(0, 0, 20, 20), (200, 0, 20, 20), (70, 0, 100, 20)]
+    assert plans.cluster_boxes(boxes, pixel_buffer=50) == [(0, 0, 220, 20)]
+
+def test_single_and_empty_inputs():
+    assert plans.cluster_boxes([]) == []
+    assert plans.cluster_boxes([(5, 6, 7, 8)]) == [(5, 6, 7, 8)]
+
+def test_multi_region_mode_windows():
+    image = torch.rand(1, 900, 1200, 3)
+    mask = torch.zeros(1, 900, 1200)
+    mask[0, 50:150, 50:150] = 1
+    mask[0, 700:800, 1000:1100] = 1
+    node = utils.CreateContextWindow()
+    separate = node.create_context_window(image, mask, "auto", "3:4", pixel_buffer=16, region_mode="multi")
+    assert separate[0].shape[0] == 2
+    assert separate[9] == [0, 0]
+    # a large distance joins both regions into one window, like single mode
+    joined = node.create_context_window(image, mask, "auto", "3:4", pixel_buffer=16, region_mode="multi", region_distance=1000)
+    single = node.create_context_window(image, mask, "auto", "3:4", pixel_buffer=16)
+    assert joined[0].shape[0] == 1
+    assert torch.equal(joined[0], single[0])
+    # an empty mask still gives one window
+    empty = node.create_context_window(image, torch.zeros_like(mask), "auto", "3:4", region_mode="multi")
+    assert empty[0].shape[0] == 1
@@ -0,0 +1,62 @@
+import threading
+
+import cv2
+import torch
+
+from package_loader import load_module
+
+executor = load_module("executor")
+
+def test_thread_counts_come_back_after_the_last_caller():
+    original = (cv2.getNumThreads(), torch.get_num_threads())
+    cv2.setNumThreads(3)
+    torch.set_num_threads(3)
+    first_in, second_in, first_out = threading.Event(), threading.Event(), threading.Event()
+    seen = {}
+
+    def first():
+        with executor.library_threads(1):
+            first_in.set()
+            second_in.wait()
+        first_out.set()
+
+    def second():
+        first_in.wait()
+        with executor.library_threads(1):
+            second_in.set()
+            first_out.wait()
+            # the first caller left, this one still runs under the budget
+            seen["inside"] = (cv2.getNumThreads(), torch.get_num_threads())
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    after = (cv2.getNumThreads(), torch.get_num_threads())
+    cv2.setNumThreads(original[0])
+    torch.set_num_threads(original[1])
+    assert seen["inside"] == (1, 1)
+    assert after == (3, 3)
+
+def test_map_items_keeps_item_order():
+    assert executor.map_items(lambda i: i * i, 20, threads=4) == [i * i for i in range(20)]
+
+def test_default_budget_never_raises_the_library_counts(monkeypatch):
+    # a dataset worker lowered the counts itself, a node call without a budget must keep them
+    original = (cv2.getNumThreads(), torch.get_num_threads())
+    monkeypatch.delenv("ICLORA_THREADS", raising=False)
+    monkeypatch.setattr(executor.os, "cpu_count", lambda: 32)
+    cv2.setNumThreads(2)
+    torch.set_num_threads(2)
+    try:
+        seen = executor.map_items(lambda i: (cv2.getNumThreads(), torch.get_num_threads()), 1)
+        # a budget that was asked for still applies
+        requested = executor.map_items(lambda i: (cv2.getNumThreads(), torch.get_num_threads()), 1, threads=4)
+        after = (cv2.getNumThreads(), torch.get_num_threads())
+    finally:
+        cv2.setNumThreads(original[0])
+        torch.set_num_threads(original[1])
+    assert seen == [(2, 2)]
+    assert requested == [(4, 4)]
+    assert after == (2, 2)
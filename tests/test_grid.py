@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from package_loader import load_module
+
+plans = load_module("context_plan")
+lora_utils = load_module("InContextLoraUtils")
+load_module("result_cache").result_cache.resize(0)
+
+@pytest.mark.parametrize("count", range(2, 9))
+@pytest.mark.parametrize("cell_size", [(768, 1024), (1024, 768), (1024, 1024)])
+def test_pack_grid_stays_close_to_square(count, cell_size):
+    cell_width, cell_height = cell_size
+    columns, rows = plans.pack_grid(count, cell_width, cell_height)
+    assert columns * rows >= count
+    # only the last row has empty cells
+    assert columns * (rows - 1) < count
+    width, height = columns * cell_width, rows * cell_height
+    assert max(width, height) <= 2 * min(width, height)
+
+def test_empty_cells_are_white():
+    # 4 references and the target make 5 cells, a 3 x 2 grid with one empty cell
+    references = torch.rand(4, 400, 300, 3)
+    target = torch.rand(1, 400, 300, 3)
+    result = lora_utils.ConcatReferenceGrid().concat_reference_grid(references, "3:4", 1536, "#FF0000", target_image=target)
+    images, masks, target_x, target_y, cell_width, cell_height = result[:6]
+    assert (images.shape[2], images.shape[1]) == (3 * cell_width, 2 * cell_height)
+    assert (target_x, target_y) == (cell_width, cell_height)
+    assert torch.equal(images[0, cell_height:, 2 * cell_width:], torch.ones(cell_height, cell_width, 3))
+    assert masks[0, cell_height:, 2 * cell_width:].max() == 0
@@ -0,0 +1,30 @@
+import sys
+import threading
+
+from package_loader import load_module
+
+lazy = load_module("lazy")
+
+def test_first_access_from_several_threads(tmp_path, monkeypatch):
+    (tmp_path / "slow_lazy_module.py").write_text("import time\ntime.sleep(0.2)\nvalue = 42\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "slow_lazy_module", raising=False)
+    module = lazy.lazy_import("slow_lazy_module")
+    assert type(module) is lazy.LazyModule
+    values, errors = [], []
+
+    def read():
+        try:
+            values.append(module.value)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert values == [42] * 8
+    assert type(module) is not lazy.LazyModule
+    sys.modules.pop("slow_lazy_module", None)
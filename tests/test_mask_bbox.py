@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import torch
+
+from package_loader import load_module
+
+mask_bbox = load_module("mask_bbox")
+
+def reference_bbox(mask):
+    # the box of every non-zero pixel, what cv2.boundingRect returned for the binarized mask
+    ys, xs = np.nonzero(mask)
+    if len(ys) == 0:
+        return None
+    return int(xs.min()), int(ys.min()), int(xs.max() - xs.min() + 1), int(ys.max() - ys.min() + 1)
+
+def make_masks():
+    rng = np.random.default_rng(0)
+    masks = [
+        # sparse noise
+        (rng.random((120, 170)) > 0.995).astype(np.float32),
+        np.zeros((120, 170), dtype=np.float32),
+    ]
+    for y, x in ((0, 0), (119, 169), (60, 0), (0, 90), (37, 101)):
+        single = np.zeros((120, 170), dtype=np.float32)
+        single[y, x] = 1
+        masks.append(single)
+    # regions touching each edge
+    edges = np.zeros((120, 170), dtype=np.float32)
+    edges[0:10, 40:60] = 1
+    edges[100:120, 80:90] = 1
+    edges[50:60, 0:5] = 0.5
+    edges[70:75, 160:170] = 1
+    masks.append(edges)
+    return np.stack(masks)
+
+@pytest.mark.parametrize("as_tensor", [False, True])
+def test_bboxes_match_the_reference(as_tensor):
+    masks = make_masks()
+    expected = [reference_bbox(mask) for mask in masks]
+    batch = torch.from_numpy(masks) if as_tensor else masks
+    assert mask_bbox.get_mask_bboxes(batch) == expected
+    # a single [H,W] mask
+    assert mask_bbox.get_mask_bboxes(batch[0]) == expected[:1]
+
+def make_blob_masks(factor):
+    # rectangles of at least factor pixels a side at random places, some touching the edges
+    rng = np.random.default_rng(1)
+    masks = np.zeros((40, 300, 400), dtype=np.float32)
+    for mask in masks:
+        for _ in range(rng.integers(1, 4)):
+            height, width = rng.integers(factor, 80, size=2)
+            y = min(rng.integers(-20, 300), 300 - height) if rng.random() > 0.2 else 0
+            x = min(rng.integers(-20, 400), 400 - width) if rng.random() > 0.2 else 400 - width
+            mask[max(y, 0):y + height, max(x, 0):x + width] = 1
+    return masks
+
+@pytest.mark.parametrize("factor", [4, 16])
+@pytest.mark.parametrize("as_tensor", [False, True])
+def test_coarse_scan_matches_the_reference(factor, as_tensor):
+    # an empty mask and single pixels miss every sample and fall back to the full scan
+    extra = np.zeros((5, 300, 400), dtype=np.float32)
+    for mask, (y, x) in zip(extra[1:], ((0, 0), (299, 399), (150, 0), (7, 201))):
+        mask[y, x] = 1
+    masks = np.concatenate([make_blob_masks(factor), extra])
+    expected = [reference_bbox(mask) for mask in masks]
+    batch = torch.from_numpy(masks) if as_tensor else masks
+    assert mask_bbox.get_mask_bboxes_coarse(batch, factor) == expected
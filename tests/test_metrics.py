@@ -0,0 +1,70 @@
+import json
+import time
+
+import pytest
+import torch
+
+from package_loader import load_module
+
+metrics = load_module("metrics")
+utils = load_module("InContextUtils")
+load_module("result_cache").result_cache.resize(0)
+
+@pytest.fixture
+def sink():
+    # every test records into its own sink and leaves the instrumentation as it found it
+    previous = metrics.sink
+    def use(new_sink):
+        metrics.configure(new_sink)
+        return new_sink
+    yield use
+    metrics.configure(previous)
+
+def run_node():
+    image = torch.rand(1, 900, 1200, 3)
+    mask = torch.zeros(1, 900, 1200)
+    mask[0, 200:500, 300:700] = 1
+    start = time.perf_counter()
+    utils.CreateContextWindow().create_context_window(image, mask, "auto", "3:4")
+    return time.perf_counter() - start
+
+def test_memory_sink_records_the_stages_of_a_node_call(sink):
+    memory = sink(metrics.MemorySink())
+    total = run_node()
+    names = [record["stage"] for record in memory.records]
+    assert names == ["to_numpy", "mask_scan", "bbox_search", "to_numpy", "resize", "binarize", "resize", "normalize", "concat"]
+    for record in memory.records:
+        assert 0 <= record["seconds"] <= total
+        assert record["bytes"] > 0
+    # the first to_numpy is handed the whole image and mask
+    assert memory.records[0]["bytes"] == 900 * 1200 * 4 * 4
+    assert memory.records[0]["backend"] == "cv2"
+
+def test_jsonl_sink_appends_one_record_per_line(sink, tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    sink(metrics.create_sink(f"jsonl:{path}"))
+    run_node()
+    run_node()
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(records) == 18
+    assert {record["stage"] for record in records} == {"to_numpy", "mask_scan", "bbox_search", "resize", "binarize", "normalize", "concat"}
+
+def test_stage_and_timed(sink):
+    memory = sink(metrics.MemorySink())
+    with metrics.stage("sleep", torch.zeros(4), kind="test"):
+        time.sleep(0.01)
+    double = metrics.timed("double", lambda data, factor=2: data * factor)
+    assert torch.equal(double(torch.ones(3), factor=3), torch.full((3,), 3.0))
+    sleep, doubled = memory.records
+    assert sleep["stage"] == "sleep" and sleep["kind"] == "test" and sleep["bytes"] == 16
+    assert 0.01 <= sleep["seconds"] < 1
+    assert doubled["stage"] == "double" and doubled["bytes"] == 12
+
+def test_disabled_metrics_cost_nothing(sink):
+    sink(None)
+    function = lambda data: data
+    assert metrics.timed("noop", function) is function
+    assert metrics.stage("noop") is metrics.NULL_STAGE
+    assert metrics.create_sink("off") is None
+    with pytest.raises(ValueError):
+        metrics.create_sink("prometheus")
@@ -0,0 +1,61 @@
+import pytest
+import torch
+
+from package_loader import load_module
+
+utils = load_module("InContextUtils")
+lora_utils = load_module("InContextLoraUtils")
+load_module("result_cache").result_cache.resize(0)
+
+# the bound stated for precision=uint8, the image outputs stay within 2/255 of the float32 path
+BOUND = 2 / 255
+
+def make_batch():
+    generator = torch.Generator().manual_seed(0)
+    image = torch.rand(2, 3, 24, 24, generator=generator)
+    image = torch.nn.functional.interpolate(image, size=(900, 1300), mode="bicubic").permute(0, 2, 3, 1)
+    image = (image + torch.rand(image.shape, generator=generator) * 0.1).clamp(0, 1).contiguous()
+    mask = torch.zeros(2, 900, 1300)
+    mask[0, 100:300, 200:500] = 1
+    mask[1, 400:800, 700:1200] = 1
+    return image, mask
+
+def max_difference(a, b):
+    return float((a.float() - b.float()).abs().max())
+
+@pytest.mark.parametrize("options", [{}, {"transform": "affine"}, {"interpolation": "auto"}, {"sequence_mode": True}])
+@pytest.mark.parametrize("patch_type", ["3:4", "auto"])
+def test_create_context_window(options, patch_type):
+    image, mask = make_batch()
+    node = utils.CreateContextWindow()
+    exact = node.create_context_window(image, mask, "auto", patch_type, **options)
+    quantized = node.create_context_window(image, mask, "auto", patch_type, precision="uint8", **options)
+    assert max_difference(exact[0], quantized[0]) <= BOUND
+    assert torch.equal(exact[1], quantized[1])
+    assert torch.equal(exact[6], quantized[6])
+
+def test_create_context_window_empty_mask():
+    image, mask = make_batch()
+    node = utils.CreateContextWindow()
+    exact = node.create_context_window(image, torch.zeros_like(mask), "auto", "3:4")
+    quantized = node.create_context_window(image, torch.zeros_like(mask), "auto", "3:4", precision="uint8")
+    assert max_difference(exact[0], quantized[0]) <= BOUND
+
+@pytest.mark.parametrize("with_second_image", [False, True])
+def test_concat_context_window(with_second_image):
+    image, mask = make_batch()
+    window = utils.CreateContextWindow().create_context_window(image, mask, "auto", "3:4")
+    options = {"second_image": window[0], "second_mask": window[1]} if with_second_image else {}
+    node = utils.ConcatContextWindow()
+    exact = node.concat_context_window(image, window[2], "3:4", 1536, "#FF0000", **options)
+    quantized = node.concat_context_window(image, window[2], "3:4", 1536, "#FF0000", precision="uint8", **options)
+    assert max_difference(exact[0], quantized[0]) <= BOUND
+    assert torch.equal(exact[1], quantized[1])
+
+def test_add_mask():
+    image, mask = make_batch()
+    node = lora_utils.AddMaskForICLora()
+    exact = node.add_mask(image, "auto", 1024, "#FF0000", first_mask=mask)
+    quantized = node.add_mask(image, "auto", 1024, "#FF0000", first_mask=mask, precision="uint8")
+    assert max_difference(exact[0], quantized[0]) <= BOUND
+    assert torch.equal(exact[1], quantized[1])
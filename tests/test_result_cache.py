@@ -0,0 +1,32 @@
+import torch
+
+from package_loader import load_module
+
+result_cache = load_module("result_cache")
+utils = load_module("InContextUtils")
+
+def test_cache_is_off_by_default():
+    assert result_cache.DEFAULT_MAX_BYTES == 0
+
+def test_hits_by_content_and_misses_on_changed_pixels():
+    cache = result_cache.result_cache
+    previous = cache.max_bytes
+    cache.resize(1 << 30)
+    cache.clear()
+    try:
+        node = utils.CreateContextWindow()
+        image = torch.rand(1, 300, 400, 3)
+        mask = torch.zeros(1, 300, 400)
+        mask[0, 100:200, 100:200] = 1
+        first = node.create_context_window(image, mask, "auto", "3:4")
+        # new tensor objects with the same pixels, the way ComfyUI hands them over
+        assert node.create_context_window(image.clone(), mask.clone(), "auto", "3:4") is first
+        changed = image.clone()
+        changed[0, 150, 150, 0] += 0.5
+        assert node.create_context_window(changed, mask, "auto", "3:4") is not first
+        # in place writes invalidate the digest of the same tensor object
+        image[0, 150, 150, 0] += 0.5
+        assert node.create_context_window(image, mask, "auto", "3:4") is not first
+    finally:
+        cache.clear()
+        cache.resize(previous)
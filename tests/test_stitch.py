@@ -0,0 +1,69 @@
+import torch
+
+from package_loader import load_module
+
+utils = load_module("InContextUtils")
+load_module("result_cache").result_cache.resize(0)
+
+def make_canvas():
+    image = torch.rand(1, 900, 1200, 3)
+    mask = torch.zeros(1, 900, 1200)
+    mask[0, 300:500, 400:600] = 1
+    window = utils.CreateContextWindow().create_context_window(image, mask, "patch_right", "3:4")
+    canvas = utils.ConcatContextWindow().concat_context_window(image, window[2], "3:4", 1536, "#FF0000", second_image=window[0], second_mask=window[1])
+    generated = canvas[0].clone()
+    # the generated panel is flat grey
+    generated[:, :, window[0].shape[2]:] = 0.25
+    return image, window, generated, canvas[1]
+
+def stitch(image, window, generated, mask, **kwargs):
+    return utils.StitchContextWindow().stitch_context_window(image, generated, window[2], window[0].shape[2], window[0].shape[1],
+                                                             window[3], window[4], window[5], mask=mask, plan=window[8], **kwargs)[0]
+
+def test_canvas_mask_is_split_like_the_image():
+    image, window, generated, canvas_mask = make_canvas()
+    from_canvas = stitch(image, window, generated, canvas_mask)
+    from_panel = stitch(image, window, generated, window[1])
+    assert torch.allclose(from_canvas, from_panel, atol=1e-6)
+    assert (from_canvas[0, 320:480, 420:580] - 0.25).abs().max() < 1e-3
+    # outside the window the original is untouched
+    assert torch.equal(from_canvas[0, :250], image[0, :250])
+    assert torch.equal(from_canvas[0, 550:], image[0, 550:])
+
+def test_original_is_not_modified():
+    image, window, generated, canvas_mask = make_canvas()
+    original = image.clone()
+    stitch(image, window, generated, canvas_mask)
+    assert torch.equal(image, original)
+    stitched = stitch(image, window, generated, canvas_mask, in_place=True)
+    assert stitched is image
+
+def test_float16_outputs_chain_into_concat_and_stitch():
+    image, mask = make_canvas()[0], torch.zeros(1, 900, 1200)
+    mask[0, 300:500, 400:600] = 1
+    stitched = {}
+    for output_dtype in ("float32", "float16"):
+        window = utils.CreateContextWindow().create_context_window(image, mask, "patch_right", "3:4", output_dtype=output_dtype)
+        # the crop outputs stay float32 for the nodes that resize them again
+        assert window[6].dtype == torch.float32
+        utils.CreateContextWindow().create_context_window(window[6], window[7], "patch_right", "3:4")
+        utils.ConcatContextWindow().concat_context_window(window[6], window[2], "3:4", 1536, "#FF0000")
+        canvas = utils.ConcatContextWindow().concat_context_window(image, window[2], "3:4", 1536, "#FF0000", second_image=window[0], second_mask=window[1], output_dtype=output_dtype)
+        assert canvas[0].dtype == getattr(torch, output_dtype)
+        for plan in (window[8], None):
+            stitched[output_dtype, plan is None] = utils.StitchContextWindow().stitch_context_window(
+                image, canvas[0], window[2], window[0].shape[2], window[0].shape[1], window[3], window[4], window[5], mask=canvas[1], plan=plan)[0]
+    for without_plan in (False, True):
+        assert stitched["float16", without_plan].dtype == torch.float32
+        assert (stitched["float16", without_plan] - stitched["float32", without_plan]).abs().max() < 2e-3
+
+def test_affine_matrix_pastes_back_like_the_plan():
+    image, window, generated, canvas_mask = make_canvas()
+    from_plan = stitch(image, window, generated, canvas_mask)
+    from_matrix = utils.StitchContextWindow().stitch_context_window(image, generated, window[2], window[0].shape[2], window[0].shape[1],
+                                                                    0, 0, 1.0, mask=canvas_mask, affine_matrix=window[12])[0]
+    assert (from_matrix - from_plan).abs().max() < 1e-3
+    # a batch of windows passes a list with one matrix per window
+    from_list = utils.StitchContextWindow().stitch_context_window(image, generated, window[2], window[0].shape[2], window[0].shape[1],
+                                                                  0, 0, 1.0, mask=canvas_mask, affine_matrix=[window[12]])[0]
+    assert torch.equal(from_list, from_matrix)
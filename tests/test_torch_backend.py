@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from package_loader import load_module
+
+torch_backend = load_module("torch_backend")
+
+# the tolerances stated at the top of torch_backend.py
+
+@pytest.mark.parametrize("size", [(300, 200), (1200, 900), (517, 383)])
+def test_cubic_resize_matches_cv2(size):
+    image = np.random.default_rng(0).random((640, 480, 3), dtype=np.float32)
+    expected = cv2.resize(image, size, interpolation=cv2.INTER_CUBIC)
+    actual = torch_backend.resize(torch.from_numpy(image), size, cv2.INTER_CUBIC).numpy()
+    assert actual.shape == expected.shape
+    assert np.abs(actual - expected).max() < 1e-4
+
+def test_nearest_exact_resize_matches_cv2():
+    # a 3x upscale never samples a source coordinate on a pixel boundary
+    mask = (np.random.default_rng(1).random((97, 131)) > 0.5).astype(np.float32)
+    expected = cv2.resize(mask, (393, 291), interpolation=cv2.INTER_NEAREST_EXACT)
+    actual = torch_backend.resize(torch.from_numpy(mask), (393, 291), cv2.INTER_NEAREST_EXACT).numpy()
+    assert np.array_equal(actual, expected)
+
+def test_pad_matches_cv2():
+    image = np.random.default_rng(2).random((50, 70, 3), dtype=np.float32)
+    expected = cv2.copyMakeBorder(image, 3, 5, 7, 11, cv2.BORDER_CONSTANT, value=(1, 1, 1))
+    actual = torch_backend.pad(torch.from_numpy(image), 3, 5, 7, 11, (1, 1, 1)).numpy()
+    assert np.array_equal(actual, expected)
+
+def test_torch_context_window_matches_cv2():
+    load_module("result_cache").result_cache.resize(0)
+    create = load_module("InContextUtils").CreateContextWindow()
+    image = torch.rand(1, 900, 1200, 3)
+    mask = torch.zeros(1, 900, 1200)
+    mask[0, 200:500, 300:700] = 1
+    expected = create.create_context_window(image, mask, "auto", "3:4", backend="cv2")
+    actual = create.create_context_window(image, mask, "auto", "3:4", backend="torch")
+    assert (actual[0] - expected[0]).abs().max() < 1e-4
+    assert torch.equal(actual[6], expected[6])
+
+def test_torch_compose_nodes_match_cv2():
+    load_module("result_cache").result_cache.resize(0)
+    utils = load_module("InContextUtils")
+    lora_utils = load_module("InContextLoraUtils")
+    image = torch.rand(2, 900, 1200, 3)
+    mask = torch.zeros(2, 900, 1200)
+    mask[:, 200:500, 300:700] = 1
+    window = utils.CreateContextWindow().create_context_window(image, mask, "auto", "3:4")
+    concat = utils.ConcatContextWindow()
+    add_mask = lora_utils.AddMaskForICLora()
+    cases = [
+        lambda backend: concat.concat_context_window(image, window[2], "3:4", 1536, "#FF0000", second_image=window[0], second_mask=window[1], backend=backend),
+        lambda backend: concat.concat_context_window(image, window[2], "3:4", 1536, "#FF0000", second_mask=mask, backend=backend),
+        lambda backend: add_mask.add_mask(image, "auto", 1536, "#FF0000", first_mask=mask, second_image=image[:1, :700], second_mask=mask[:1, :700], backend=backend),
+        lambda backend: add_mask.add_mask(image, "auto", 1536, "#FF0000", backend=backend),
+    ]
+    for case in cases:
+        expected, actual = case("cv2"), case("torch")
+        assert actual[0].shape == expected[0].shape
+        assert (actual[0] - expected[0]).abs().max() < 1e-4
+        # nearest-exact differs only where a source coordinate falls on a pixel boundary
+        assert (actual[1] != expected[1]).float().mean() < 0.01
+        assert actual[2:9] == expected[2:9]
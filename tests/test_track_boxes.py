@@ -0,0 +1,59 @@
+import torch
+
+from package_loader import load_module
+
+plans = load_module("context_plan")
+utils = load_module("InContextUtils")
+load_module("result_cache").result_cache.resize(0)
+
+def moving_boxes(frames=30, step=4):
+    return [(100 + step * i, 200, 80, 60) for i in range(frames)]
+
+def test_boxes_hold_while_the_mask_stays_within_the_margin():
+    boxes = moving_boxes()
+    tracked = plans.track_boxes(boxes, margin=32, smoothing=0.5)
+    assert len(tracked) == len(boxes)
+    for (x, y, width, height), (held_x, held_y, held_width, held_height) in zip(boxes, tracked):
+        assert held_x - 32 <= x and x + width <= held_x + held_width + 32
+        assert held_y - 32 <= y and y + height <= held_y + held_height + 32
+    # 4 pixels a frame over 30 frames moves the box only a few times
+    changes = sum(1 for previous, box in zip(tracked, tracked[1:]) if box != previous)
+    assert 0 < changes <= 5
+
+def test_new_boxes_are_smoothed_and_contain_the_mask():
+    held, bbox = (0, 0, 100, 100), (60, 0, 100, 100)
+    assert plans.smooth_box(held, bbox, 0) == bbox
+    # half way between the two, grown to contain the new box
+    assert plans.smooth_box(held, bbox, 0.5) == (30, 0, 130, 100)
+    assert plans.track_boxes([held, bbox], margin=32, smoothing=0) == [held, bbox]
+
+def test_a_shrinking_mask_gets_a_tighter_box():
+    tracked = plans.track_boxes([(0, 0, 200, 200), (50, 50, 60, 60)], margin=32, smoothing=0)
+    assert tracked == [(0, 0, 200, 200), (50, 50, 60, 60)]
+
+def test_empty_frames_hold_the_current_box():
+    boxes = [None, None, (10, 10, 50, 50), None, (12, 10, 50, 50), None]
+    assert plans.track_boxes(boxes) == [(10, 10, 50, 50)] * 6
+    assert plans.track_boxes([None, None]) == [None, None]
+    assert plans.track_boxes([]) == []
+
+def test_sequence_mode_shares_plans_between_frames():
+    frames = 12
+    image = torch.rand(frames, 600, 800, 3)
+    mask = torch.zeros(frames, 600, 800)
+    for i in range(frames):
+        mask[i, 200:300, 100 + 5 * i:200 + 5 * i] = 1
+    # an empty frame in the middle keeps the window of the frame before it
+    mask[6] = 0
+    result = utils.CreateContextWindow().create_context_window(image, mask, "auto", "3:4", sequence_mode=True, sequence_margin=32)
+    plans_by_frame = result[8]
+    assert len(plans_by_frame) == frames
+    assert plans_by_frame[6] == plans_by_frame[5]
+    assert len(set(plans_by_frame)) < frames
+    # every frame's mask stays inside its window
+    for i, plan in enumerate(plans_by_frame):
+        if i == 6:
+            continue
+        ys, xs = torch.nonzero(mask[i], as_tuple=True)
+        assert plan.crop_x <= xs.min() and xs.max() < plan.crop_x + plan.crop_width
+        assert plan.crop_y <= ys.min() and ys.max() < plan.crop_y + plan.crop_height
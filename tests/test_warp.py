@@ -0,0 +1,26 @@
+import torch
+
+from package_loader import load_module
+
+utils = load_module("InContextUtils")
+
+def test_affine_transform_matches_resize_at_the_crop_edges():
+    # noise makes every pixel around the crop differ from the crop edge
+    image = torch.rand(1, 900, 700, 3, generator=torch.Generator().manual_seed(0))
+    mask = torch.zeros(1, 900, 700)
+    mask[0, 100:300, 200:400] = 1
+    node = utils.CreateContextWindow()
+    resized = node.create_context_window(image, mask, "auto", "3:4")
+    warped = node.create_context_window(image, mask, "auto", "3:4", transform="affine")
+    assert (resized[0] - warped[0]).abs().max() < 1e-3
+
+def test_area_downscales_keep_the_resize_path():
+    # warpAffine has no area mode, a 4x downscale with interpolation auto must not turn into linear
+    image = torch.rand(1, 1800, 1400, 3, generator=torch.Generator().manual_seed(0))
+    mask = torch.zeros(1, 1800, 1400)
+    mask[0, 200:1600, 200:1200] = 1
+    node = utils.CreateContextWindow()
+    resized = node.create_context_window(image, mask, "auto", "3:4", output_length=512, interpolation="auto")
+    warped = node.create_context_window(image, mask, "auto", "3:4", output_length=512, interpolation="auto", transform="affine")
+    assert resized[5] >= 2
+    assert torch.equal(resized[0], warped[0])
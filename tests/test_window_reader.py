@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from package_loader import load_module
+
+tifffile = pytest.importorskip("tifffile")
+
+window_reader = load_module("window_reader")
+utils = load_module("InContextUtils")
+load_module("result_cache").result_cache.resize(0)
+
+HEIGHT, WIDTH = 300, 410
+
+# windows inside the image, on segment boundaries and touching the right and bottom edges
+WINDOWS = [(0, 0, WIDTH, HEIGHT), (0, 0, 1, 1), (37, 61, 100, 90), (64, 32, 64, 32), (WIDTH - 50, HEIGHT - 7, 50, 7), (5, 150, WIDTH - 5, 150)]
+
+def make_image():
+    return (np.random.default_rng(0).random((HEIGHT, WIDTH, 3)) * 255).astype(np.uint8)
+
+@pytest.mark.parametrize("layout", [
+    {"rowsperstrip": 16, "compression": "zlib"},
+    {"rowsperstrip": 7},
+    {"tile": (64, 64), "compression": "zlib"},
+    # non square tiles, TIFF only needs multiples of 16
+    {"tile": (32, 48)},
+])
+@pytest.mark.parametrize("channels", [3, 1])
+def test_tiff_windows(tmp_path, layout, channels):
+    image = make_image() if channels == 3 else make_image()[..., 0]
+    path = str(tmp_path / "image.tif")
+    tifffile.imwrite(path, image, **layout)
+    reader = window_reader.open_reader(path)
+    assert isinstance(reader, window_reader.TiffReader)
+    assert (reader.width, reader.height) == (WIDTH, HEIGHT)
+    try:
+        for x, y, width, height in WINDOWS:
+            assert np.array_equal(reader.read(x, y, width, height), image[y:y + height, x:x + width])
+    finally:
+        reader.close()
+
+def test_npy_windows_are_memory_mapped(tmp_path):
+    image = make_image()
+    path = str(tmp_path / "image.npy")
+    np.save(path, image)
+    reader = window_reader.open_reader(path)
+    assert isinstance(reader.array, np.memmap)
+    for x, y, width, height in WINDOWS:
+        window = reader.read(x, y, width, height)
+        assert np.array_equal(window, image[y:y + height, x:x + width])
+        # the window is a copy, the map can be closed
+        assert not isinstance(window, np.memmap)
+    reader.close()
+
+def test_load_matches_create(tmp_path):
+    image = make_image()
+    mask = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    mask[100:160, 200:290] = 255
+    tifffile.imwrite(str(tmp_path / "strips.tif"), image, rowsperstrip=16, compression="zlib")
+    tifffile.imwrite(str(tmp_path / "tiles.tif"), image, tile=(64, 64))
+    np.save(str(tmp_path / "image.npy"), image)
+    Image.fromarray(image).save(str(tmp_path / "image.png"))
+    Image.fromarray(mask).save(str(tmp_path / "mask.png"))
+    image_tensor = torch.from_numpy(image.astype(np.float32) / 255)[None]
+    mask_tensor = torch.from_numpy((mask > 0).astype(np.float32))[None]
+    expected = utils.CreateContextWindow().create_context_window(image_tensor, mask_tensor, "auto", "3:4", output_length=512)
+    load = utils.LoadContextWindow()
+    for name in ("strips.tif", "tiles.tif", "image.npy", "image.png"):
+        for options in ({"input_mask": mask_tensor}, {"mask_path": str(tmp_path / "mask.png")}):
+            actual = load.load_context_window(str(tmp_path / name), "auto", "3:4", output_length=512, **options)
+            for expected_output, actual_output in zip(expected, actual):
+                if torch.is_tensor(expected_output):
+                    assert expected_output.shape == actual_output.shape
+                    assert torch.allclose(expected_output, actual_output, atol=1e-6)
+                else:
+                    assert expected_output == actual_output
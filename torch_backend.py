@@ -0,0 +1,122 @@
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# Torch implementation of the resize / pad helpers used by the backend input of CreateContextWindow,
+# LoadContextWindow, ConcatContextWindow and AddMaskForICLora, and of the affine paste back of StitchContextWindow.
+# Tensors stay on the device they arrived on, nothing is copied to the host.
+#
+# Accepted layouts: HW (mask), HWC (image), CHW, NHWC (comfy IMAGE batch) and NCHW.
+# 2D tensors are treated as HW, 3D as HWC and 4D as NHWC unless a layout is given.
+#
+# Tolerance against the cv2 path for float32 images in [0, 1]:
+# - INTER_CUBIC resize: max abs difference below 1e-4 (both use a = -0.75 without antialiasing)
+# - INTER_NEAREST_EXACT resize: identical except for output rows/columns whose source coordinate
+#   falls exactly on a pixel boundary, cv2 rounds those down with its fixed point math (one pixel shift)
+# - padding and cropping: identical
+
+INTERPOLATION_MODES = {
+    cv2.INTER_NEAREST: "nearest",
+    cv2.INTER_NEAREST_EXACT: "nearest-exact",
+    cv2.INTER_LINEAR: "bilinear",
+    cv2.INTER_CUBIC: "bicubic",
+    cv2.INTER_AREA: "area",
+}
+
+DEFAULT_LAYOUTS = {2: "HW", 3: "HWC", 4: "NHWC"}
+
+def as_tensor(image, device=None):
+    if not torch.is_tensor(image):
+        image = torch.from_numpy(np.ascontiguousarray(image))
+    if device is not None:
+        image = image.to(device)
+    return image
+
+def to_nchw(image, layout=None):
+    layout = layout or DEFAULT_LAYOUTS[image.dim()]
+    if layout == "HW":
+        return image[None, None], layout
+    if layout == "HWC":
+        return image.permute(2, 0, 1)[None], layout
+    if layout == "CHW":
+        return image[None], layout
+    if layout == "NHWC":
+        return image.permute(0, 3, 1, 2), layout
+    return image, layout
+
+def from_nchw(image, layout):
+    if layout == "HW":
+        return image[0, 0]
+    if layout == "HWC":
+        return image[0].permute(1, 2, 0).contiguous()
+    if layout == "CHW":
+        return image[0]
+    if layout == "NHWC":
+        return image.permute(0, 2, 3, 1).contiguous()
+    return image
+
+def resize(img, resolution, interpolation=cv2.INTER_CUBIC, layout=None, dst=None):
+    # dst follows cv2.resize, the result is copied into it
+    width, height = resolution
+    image, layout = to_nchw(img, layout)
+    dtype = image.dtype
+    if not image.is_floating_point():
+        image = image.float()
+    mode = INTERPOLATION_MODES.get(interpolation, "bicubic")
+    if mode in ("bilinear", "bicubic"):
+        image = F.interpolate(image, size=(height, width), mode=mode, align_corners=False)
+    else:
+        image = F.interpolate(image, size=(height, width), mode=mode)
+    if image.dtype != dtype:
+        # saturate like cv2 does for integer images
+        info = torch.iinfo(dtype)
+        image = image.round().clamp(info.min, info.max).to(dtype)
+    if dst is not None:
+        return dst.copy_(from_nchw(image, layout))
+    return from_nchw(image, layout)
+
+def warp_affine(img, matrix, rect, size, interpolation=cv2.INTER_CUBIC, layout=None):
+    # the pixels (left, top, right, bottom) of rect sample img at matrix x their center, like cv2.warpAffine
+    # with WARP_INVERSE_MAP, matrix is in pixel coordinates of a size (width, height) image, so img may have
+    # any resolution, the edges are replicated
+    image, layout = to_nchw(img, layout)
+    dtype = image.dtype
+    if not image.is_floating_point():
+        image = image.float()
+    left, top, right, bottom = rect
+    width, height = size
+    (a, b, c), (d, e, f) = matrix
+    ys, xs = torch.meshgrid(torch.arange(top, bottom, dtype=torch.float64, device=image.device),
+                            torch.arange(left, right, dtype=torch.float64, device=image.device), indexing="ij")
+    u, v = a * xs + b * ys + c, d * xs + e * ys + f
+    # normalized coordinates of align_corners=False, the same pixel centers as resize
+    grid = torch.stack(((2 * u + 1) / width - 1, (2 * v + 1) / height - 1), dim=-1).to(image.dtype)
+    mode = {cv2.INTER_LINEAR: "bilinear", cv2.INTER_CUBIC: "bicubic"}.get(interpolation, "nearest")
+    image = F.grid_sample(image, grid[None].expand(image.shape[0], -1, -1, -1), mode=mode, padding_mode="border", align_corners=False)
+    if image.dtype != dtype:
+        info = torch.iinfo(dtype)
+        image = image.round().clamp(info.min, info.max).to(dtype)
+    return from_nchw(image, layout)
+
+def pad(img, top, bottom, left, right, value=0, layout=None):
+    image, layout = to_nchw(img, layout)
+    batch_size, channels, height, width = image.shape
+    padded = image.new_empty((batch_size, channels, height + top + bottom, width + left + right))
+    # value follows cv2.copyMakeBorder, a scalar or one value per channel
+    fill = torch.as_tensor(value, dtype=padded.dtype, device=padded.device).flatten()
+    if fill.numel() >= channels:
+        fill = fill[:channels]
+    else:
+        fill = fill[:1].expand(channels)
+    padded[:] = fill.view(1, channels, 1, 1)
+    padded[:, :, top:top + height, left:left + width] = image
+    return from_nchw(padded, layout)
+
+def feather(mask, radius, layout=None):
+    # box blur with zeros outside the mask, so edges fade out towards the border of the region as well
+    if radius <= 0:
+        return mask
+    image, layout = to_nchw(mask, layout)
+    image = F.avg_pool2d(image.float(), 2 * radius + 1, stride=1, padding=radius, count_include_pad=True)
+    return from_nchw(image, layout)
@@ -0,0 +1,116 @@
+import os
+
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+ImageOps = lazy_import("PIL.ImageOps")
+
+try:
+    tifffile = lazy_import("tifffile")
+except ImportError:
+    tifffile = None
+
+# Readers that decode only a rectangle of an image file, used by LoadContextWindow.
+# - .npy files are memory mapped, only the window is copied
+# - TIFF files decode only the strips or tiles overlapping the window (needs tifffile, the codecs
+#   of compressed files may need imagecodecs)
+# - every other format PIL can open is decoded whole and cropped, PNG and JPEG have no random access
+# All readers return arrays in the file dtype, [H,W] or [H,W,C].
+
+EXIF_ORIENTATION = 0x0112
+
+class NpyReader:
+    def __init__(self, path):
+        self.array = np.load(path, mmap_mode="r")
+        self.height, self.width = self.array.shape[:2]
+
+    def read(self, x, y, width, height):
+        return np.array(self.array[y:y + height, x:x + width])
+
+    def close(self):
+        self.array = None
+
+class TiffReader:
+    def __init__(self, path):
+        self.tiff = tifffile.TiffFile(path)
+        self.page = self.tiff.pages[0]
+        self.height, self.width = self.page.imagelength, self.page.imagewidth
+
+    def read(self, x, y, width, height):
+        page = self.page
+        separate_samples, depth, _, _, samples = page.shaped
+        if separate_samples != 1 or depth != 1:
+            # planar or volume data, not worth a segment walk
+            return page.asarray()[y:y + height, x:x + width]
+        if page.is_tiled:
+            segment_height, segment_width = page.tilelength, page.tilewidth
+        else:
+            segment_height, segment_width = min(page.rowsperstrip, self.height), self.width
+        segments_across = -(-self.width // segment_width)
+
+        window = np.zeros((height, width, samples), dtype=page.dtype)
+        handle = self.tiff.filehandle
+        decode = page.decode
+        for row in range(y // segment_height, (y + height - 1) // segment_height + 1):
+            for column in range(x // segment_width, (x + width - 1) // segment_width + 1):
+                index = row * segments_across + column
+                data = None
+                if page.databytecounts[index] > 0:
+                    handle.seek(page.dataoffsets[index])
+                    data = handle.read(page.databytecounts[index])
+                segment, (_, _, top, left, _), _ = decode(data, index, jpegtables=page.jpegtables)
+                if segment is None:
+                    continue
+                segment = segment[0]
+                # edge tiles are padded past the image, the window bounds clip them
+                window_top, window_bottom = max(top, y), min(top + segment.shape[0], y + height)
+                window_left, window_right = max(left, x), min(left + segment.shape[1], x + width)
+                window[window_top - y:window_bottom - y, window_left - x:window_right - x] = \
+                    segment[window_top - top:window_bottom - top, window_left - left:window_right - left]
+        return window if samples > 1 else window[..., 0]
+
+    def close(self):
+        self.tiff.close()
+
+class PilReader:
+    def __init__(self, path, mode="RGB"):
+        # Image.open only reads the header, the pixels are decoded on the first read
+        self.image = Image.open(path)
+        self.mode = mode
+        self.width, self.height = self.image.size
+        # ComfyUI applies the exif orientation when loading, masks drawn on the image follow it
+        if self.image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            self.width, self.height = self.height, self.width
+
+    def read(self, x, y, width, height):
+        image = ImageOps.exif_transpose(self.image)
+        if image.mode != self.mode:
+            image = image.convert(self.mode)
+        return np.array(image.crop((x, y, x + width, y + height)))
+
+    def close(self):
+        self.image.close()
+
+def open_reader(path, mode="RGB"):
+    # mode is the PIL mode for formats decoded by PIL, RGB for images and L for masks
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        return NpyReader(path)
+    if extension in (".tif", ".tiff") and tifffile is not None:
+        return TiffReader(path)
+    return PilReader(path, mode)
+
+def as_float_array(array, channels=3):
+    # file pixels to float32 in [0, 1], with 3 channels for images and none for masks
+    if np.issubdtype(array.dtype, np.integer):
+        array = array.astype(np.float32) / np.iinfo(array.dtype).max
+    else:
+        array = array.astype(np.float32, copy=False)
+    if channels is None:
+        return array if array.ndim == 2 else array[..., 0]
+    if array.ndim == 2:
+        array = array[..., None]
+    if array.shape[2] == 1:
+        return np.repeat(array, channels, axis=2)
+    return np.ascontiguousarray(array[..., :channels])